@@ -0,0 +1,8 @@
+import os
+
+# ENG: Directory of the persistent local data (caches, search index, snapshot, model artifacts)
+# ESP: Directorio de los datos locales persistentes (cachés, índice de búsqueda, instantánea, artefactos del modelo)
+
+# Persistent data lives in the user's home, since the PyInstaller bundle directory is temporary
+# Los datos persistentes viven en el directorio del usuario, ya que el directorio del paquete es temporal
+data_dir = os.getenv('APP_DATA_DIR', os.path.join(os.path.expanduser('~'), '.softwarebertsaludcmv'))
@@ -0,0 +1,73 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from benchmarks import synthetic
+
+# ENG: Compare the full-document dict path with the projected SurveyRow path of the data explorer
+# ESP: Comparar el camino de diccionarios completos con el de filas SurveyRow proyectadas del explorador
+
+TARGET_TEXTS = database.TARGET_TEXTS
+
+def dict_rows(documents):
+    """ The former explorer path: full documents kept as dicts, converted per row when inserting. """
+    kept = list(documents)
+    return kept, [(doc['_id'], doc['edad'], doc['genero'], doc['cesfam'], doc['frecuencia'], doc['satisfaccion'],
+                   doc['recomendacion'], doc['razon'], doc['date'], TARGET_TEXTS.get(doc['target'], 'Desconocido'))
+                  for doc in kept]
+
+def slot_rows(documents):
+    """ The projected path: only displayed fields, decoded once into SurveyRow tuples. """
+    return [database.to_row({field: doc[field] for field in database.DISPLAY_FIELDS}) for doc in documents]
+
+def measure(function, source):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(source())
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return elapsed, current, peak
+
+def main():
+    parser = argparse.ArgumentParser(description="Dict vs SurveyRow explorer rows")
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--mongo', action='store_true',
+                        help="read from a scratch collection in MONGODB_URI instead of generating in memory")
+    args = parser.parse_args()
+
+    if args.mongo:
+        scratch = database.get_client()['benchmark']['explorer_rows']
+        scratch.drop()
+        batch = []
+        for doc in synthetic.documents(args.rows):
+            batch.append(doc)
+            if len(batch) == 5000:
+                scratch.insert_many(batch)
+                batch = []
+        if batch:
+            scratch.insert_many(batch)
+        full_source = lambda: scratch.find({})
+        projected_source = lambda: scratch.find({}, database.DISPLAY_PROJECTION)
+        slot_path = lambda documents: [database.to_row(doc) for doc in documents]
+    else:
+        # Documents are generated on the fly, like a cursor decoding BSON, so their memory is measured too
+        full_source = projected_source = lambda: synthetic.documents(args.rows)
+        slot_path = slot_rows
+
+    for name, function, source in (('dict', dict_rows, full_source), ('SurveyRow', slot_path, projected_source)):
+        elapsed, current, peak = measure(function, source)
+        print(f"{name:<10} {args.rows} rows: {elapsed:.3f}s, {current / 2**20:.1f} MiB retained, "
+              f"{peak / 2**20:.1f} MiB peak")
+
+    if args.mongo:
+        scratch.drop()
+
+if __name__ == '__main__':
+    main()
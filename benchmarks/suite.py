@@ -0,0 +1,300 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from benchmarks import synthetic
+
+# ENG: Throughput and latency benchmarks of the classifier and database hot paths, written to JSON
+# ESP: Benchmarks de rendimiento y latencia del clasificador y la base de datos, escritos en JSON
+
+SEARCHES = [('Todo', 'atención'), ('Comentario Abierto', 'esperar mucho'), ('Centro de Salud', 'placilla'),
+            ('Edad', '45')]
+# Metrics where a higher value is better; every other timing metric is better when lower
+HIGHER_IS_BETTER = ('docs_per_second',)
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of a list of numbers. """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else None
+
+def rss_bytes():
+    """ Current resident set size of this process, or None if it cannot be read here. """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class PeakRSS:
+    """ Sample the resident set size in the background and keep its maximum. """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = rss_bytes()
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            current = rss_bytes()
+            if current is not None:
+                self.peak = max(self.peak or 0, current)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+def timed_calls(function, arguments):
+    """ Call function once per argument and return the per-call latencies in seconds. """
+    latencies = []
+    for argument in arguments:
+        start = time.perf_counter()
+        function(argument)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def summarize(latencies, documents, peak=None):
+    total = sum(latencies)
+    result = {
+        'documents': documents,
+        'seconds': total,
+        'docs_per_second': documents / total if total else None,
+        'p50_seconds': percentile(latencies, 0.50),
+        'p99_seconds': percentile(latencies, 0.99)
+    }
+    if peak is not None:
+        result['peak_rss_mib'] = peak / 2**20
+    return result
+
+def tiny_model(directory, seed=0):
+    """ Save a small randomly initialized BERT classifier and a vocabulary built from the synthetic corpus. """
+    import torch
+    from transformers import BertConfig, BertForSequenceClassification, BertTokenizer
+    from transformers.models.bert.tokenization_bert import BasicTokenizer
+
+    basic = BasicTokenizer(do_lower_case=True)
+    words = set()
+    for text in synthetic.PHRASES + synthetic.SHORT_COMMENTS + synthetic.CESFAMS:
+        words.update(basic.tokenize(text))
+    vocab_path = os.path.join(directory, 'vocab.txt')
+    with open(vocab_path, 'w', encoding='utf-8') as vocab:
+        vocab.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + sorted(words)) + '\n')
+
+    torch.manual_seed(seed)
+    tokenizer = BertTokenizer(vocab_path)
+    config = BertConfig(vocab_size=tokenizer.vocab_size, hidden_size=64, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=128, max_position_embeddings=512, num_labels=3)
+    BertForSequenceClassification(config).save_pretrained(directory)
+    tokenizer.save_pretrained(directory)
+
+def bench_inference(args, directory):
+    """ classify_text one comment at a time vs classify_batch over chunks, on the tiny model. """
+    import classifier
+
+    tiny_model(directory)
+    # Point the classifier at the tiny model; derived backend artifacts stay in the scratch directory too
+    classifier.model_directory = directory
+    classifier.artifact_directory = directory
+    classifier._tokenizer = classifier._model = classifier._fingerprint = classifier._tokenizer_fingerprint = None
+    classifier._files_fingerprint = None
+    classifier.warm_up()
+
+    texts = [doc['razon'] for doc in synthetic.documents(args.inference_docs, seed=1)]
+    results = {'backend': classifier.backend, 'batch_size': args.batch_size}
+
+    with PeakRSS() as peak:
+        latencies = timed_calls(classifier.classify_text, texts)
+    results['classify_text'] = summarize(latencies, len(texts), peak.peak)
+
+    chunks = [texts[start:start + args.chunk_size] for start in range(0, len(texts), args.chunk_size)]
+    with PeakRSS() as peak:
+        latencies = timed_calls(lambda chunk: classifier.classify_batch(chunk, batch_size=args.batch_size), chunks)
+    results['classify_batch'] = summarize(latencies, len(texts), peak.peak)
+    results['classify_batch']['chunk_size'] = args.chunk_size
+    return results
+
+def scratch_client(args):
+    """ A local mongod from MONGODB_URI, or an in-memory mongomock client. """
+    if args.mongomock:
+        import mongomock
+        return mongomock.MongoClient()
+    return database.get_client()
+
+def use_collection(collection):
+    """ Route the database module to a scratch collection so the real survey data is never touched. """
+    database.get_collection = lambda: collection
+    database.get_log_collection = lambda: collection.database['benchmark_log']
+    database.get_watermark_collection = lambda: collection.database['benchmark_watermarks']
+    database.query_cache.clear()
+
+def fill(collection, count, seed=0):
+    collection.drop()
+    batch = []
+    for doc in synthetic.documents(count, seed=seed):
+        batch.append(doc)
+        if len(batch) == 5000:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+
+def bench_write_back(args, client):
+    """ One update_target per document vs BulkTargetUpdater. """
+    collection = client['benchmark']['write_back']
+    use_collection(collection)
+    results = {}
+    for name in ('update_target', 'bulk_write'):
+        fill(collection, args.write_docs)
+        ids = [doc['_id'] for doc in collection.find({}, {'_id': 1})]
+        if name == 'update_target':
+            latencies = timed_calls(lambda document_id: database.update_target(document_id, 2), ids)
+        else:
+            # One latency per flushed chunk of chunk_size documents
+            updater = database.BulkTargetUpdater(batch_size=len(ids) + 1)
+            chunks = [ids[start:start + args.chunk_size] for start in range(0, len(ids), args.chunk_size)]
+
+            def write_chunk(chunk):
+                for document_id in chunk:
+                    updater.add(document_id, 2)
+                updater.flush()
+            try:
+                latencies = timed_calls(write_chunk, chunks)
+            except (TypeError, NotImplementedError) as error:
+                if not args.mongomock:
+                    raise
+                # Recent pymongo versions pass arguments to bulk_write that mongomock does not accept
+                print(f"Skipping {name} on mongomock: {error}")
+                results[name] = {'skipped': str(error)}
+                continue
+        results[name] = summarize(latencies, len(ids))
+    collection.drop()
+    return results
+
+def bench_explorer(args, client, size, directory):
+    """ Search (first page and count) and export latencies over a collection of the given size. """
+    import export
+
+    collection = client['benchmark']['explorer']
+    use_collection(collection)
+    fill(collection, size)
+    database.ensure_indexes()
+
+    results = {'rows': size, 'search': {}, 'export': {}}
+    for column, query in SEARCHES:
+        latencies = []
+        for _ in range(args.repeat):
+            database.query_cache.clear()  # Measure the database, not the cache
+            start = time.perf_counter()
+            search_filter = database.build_search_filter(query, column)
+            if search_filter is not None:
+                database.get_page(search_filter, 200)
+                database.count_matching_documents(search_filter)
+            latencies.append(time.perf_counter() - start)
+        results['search'][f"{column}:{query}"] = {'p50_seconds': percentile(latencies, 0.50),
+                                                   'p99_seconds': percentile(latencies, 0.99)}
+
+    for file_format in args.export_formats:
+        path = os.path.join(directory, f"export.{file_format}")
+        with PeakRSS() as peak:
+            start = time.perf_counter()
+            written = export.export_rows(database.find_rows({}), path)
+            elapsed = time.perf_counter() - start
+        results['export'][file_format] = summarize([elapsed], written, peak.peak)
+        os.remove(path)
+    collection.drop()
+    return results
+
+def compare(results, baseline, tolerance):
+    """ Print every metric that got worse than the baseline by more than tolerance. """
+    regressions = []
+
+    def walk(current, previous, path):
+        for key, value in current.items():
+            if key not in previous:
+                continue
+            if isinstance(value, dict):
+                walk(value, previous[key], path + [key])
+            elif isinstance(value, (int, float)) and isinstance(previous[key], (int, float)) and previous[key]:
+                ratio = value / previous[key]
+                worse = ratio < 1 - tolerance if key in HIGHER_IS_BETTER else (
+                    key.endswith('seconds') or key.endswith('_mib')) and ratio > 1 + tolerance
+                if worse:
+                    regressions.append(f"{'.'.join(path + [key])}: {previous[key]:.4g} -> {value:.4g}")
+
+    walk(results, baseline, [])
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Classifier and database benchmarks")
+    parser.add_argument('--output', help="JSON results file (default benchmarks/results/<timestamp>.json)")
+    parser.add_argument('--baseline', help="previous results file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.15, help="allowed slowdown before reporting a regression")
+    parser.add_argument('--inference-docs', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--write-docs', type=int, default=5000)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help="collection sizes for the search and export benchmarks")
+    parser.add_argument('--export-formats', nargs='+', default=['csv', 'xlsx'], choices=['csv', 'xlsx', 'parquet'])
+    parser.add_argument('--repeat', type=int, default=20, help="runs of each search")
+    parser.add_argument('--mongomock', action='store_true', help="use an in-memory mongomock instead of MONGODB_URI")
+    parser.add_argument('--skip-inference', action='store_true')
+    parser.add_argument('--skip-database', action='store_true')
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'database': 'mongomock' if args.mongomock else 'mongod'
+        }
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        if not args.skip_inference:
+            results['inference'] = bench_inference(args, directory)
+            print(json.dumps(results['inference'], indent=2))
+        if not args.skip_database:
+            client = scratch_client(args)
+            results['write_back'] = bench_write_back(args, client)
+            print(json.dumps(results['write_back'], indent=2))
+            results['explorer'] = {}
+            for size in args.sizes:
+                results['explorer'][str(size)] = bench_explorer(args, client, size, directory)
+                print(json.dumps(results['explorer'][str(size)], indent=2, default=str))
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                         f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            if compare(results, json.load(baseline_file), args.tolerance):
+                sys.exit(1)
+
+if __name__ == '__main__':
+    main()
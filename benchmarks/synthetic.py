@@ -0,0 +1,49 @@
+import random
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+# ENG: Synthetic survey corpus shaped like the opinionSaludValparaiso collection, for offline benchmarks
+# ESP: Corpus sintético de encuestas con la forma de la colección opinionSaludValparaiso, para benchmarks
+
+CESFAMS = ['Cesfam Placilla', 'Cesfam Las Cañas', 'Cesfam Barón', 'Cesfam Cordillera', 'Cesfam Esperanza',
+           'Cesfam Marcelo Mena', 'Cesfam Quebrada Verde', 'Cesfam Reina Isabel II', 'Cesfam Rodelillo']
+GENEROS = ['Femenino', 'Masculino', 'Otro']
+FRECUENCIAS = ['Primera vez', 'Una vez al mes', 'Cada tres meses', 'Una vez al año']
+
+SHORT_COMMENTS = ['nada', 'buena atención', 'Buena atención', 'excelente', 'mala atención', 'todo bien', '', 'ok']
+PHRASES = [
+    'la atención fue muy buena', 'el médico fue amable', 'tuve que esperar mucho tiempo', 'no había horas disponibles',
+    'la enfermera me explicó todo', 'el trato del personal es excelente', 'llamé muchas veces y nadie contestó',
+    'los remedios no estaban en la farmacia', 'me atendieron rápido', 'el box estaba sucio',
+    'deberían contratar más médicos', 'la sala de espera es muy fría', 'agradezco la paciencia del personal'
+]
+
+def comment(rng):
+    """ Return a comment with a long-tailed length: many one-word answers, some paragraphs. """
+    roll = rng.random()
+    if roll < 0.35:
+        return rng.choice(SHORT_COMMENTS)
+    sentences = 1 if roll < 0.8 else rng.randint(2, 6) if roll < 0.97 else rng.randint(10, 30)
+    return '. '.join(rng.choice(PHRASES).capitalize() for _ in range(sentences)) + '.'
+
+def documents(count, seed=0, start=datetime(2023, 1, 1)):
+    """ Generate count survey documents with the fields used by the application. """
+    rng = random.Random(seed)
+    for index in range(count):
+        yield {
+            '_id': ObjectId(),
+            'edad': rng.randint(15, 90),
+            'genero': rng.choice(GENEROS),
+            'cesfam': rng.choice(CESFAMS),
+            'frecuencia': rng.choice(FRECUENCIAS),
+            'satisfaccion': rng.randint(1, 7),
+            'recomendacion': rng.randint(0, 10),
+            'razon': comment(rng),
+            'date': start + timedelta(minutes=7 * index),
+            'target': rng.choice([0, 1, 2, 3, 4]),
+            # Fields stored by the survey form but not shown in the explorer
+            'comuna': 'Valparaíso',
+            'telefono_contacto': f"+569{rng.randint(10000000, 99999999)}",
+            'respuestas': {f"p{question}": rng.randint(1, 7) for question in range(12)}
+        }
@@ -1,8 +1,15 @@
+import numpy as np
 import torch
-from transformers import BertTokenizer, BertForSequenceClassification
+from transformers import BertTokenizerFast, BertForSequenceClassification
 from torch.nn.functional import softmax
 import os
+import hashlib
 import sys
+import time
+import threading
+
+import instrumentation
+from app_data import data_dir
 
 # Determine if we're running in a bundle
 if getattr(sys, 'frozen', False):
@@ -16,15 +23,256 @@ else:
 # Set the model directory path
 model_directory = os.path.join(bundle_dir, 'model')
 
-tokenizer = BertTokenizer.from_pretrained(model_directory)
-model = BertForSequenceClassification.from_pretrained(model_directory)
+# Inference backends: 'torch' (fp32), 'quantized' (dynamic int8) or 'onnx' (ONNX Runtime)
+BACKENDS = ('torch', 'quantized', 'onnx')
+backend = os.getenv('CLASSIFIER_BACKEND', 'torch')
+
+# Derived artifacts are cached in the data directory, under a hash of the model files, since the bundle directory
+# is temporary (and may not be writable); a retrained model gets a directory of its own
+# Los artefactos derivados se guardan en el directorio de datos, bajo un hash de los archivos del modelo
+artifacts_path = os.path.join(data_dir, 'models')
+artifact_directory = None  # Overrides the hashed directory (the benchmarks use a scratch one)
+
+# Comments are truncated to this many tokens, including [CLS] and [SEP]
+MAX_LENGTH = 512
+# Files that determine the token ids of a text; the token cache is shared by every model with the same ones
+TOKENIZER_FILES = ('vocab.txt', 'tokenizer.json', 'tokenizer_config.json', 'special_tokens_map.json',
+                   'added_tokens.json')
+
+def _artifact_path(filename):
+    directory = artifact_directory or os.path.join(artifacts_path, model_files_fingerprint())
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, filename)
+
+def _load_torch():
+    return BertForSequenceClassification.from_pretrained(model_directory)
+
+def _load_quantized():
+    quantized_path = _artifact_path('model_quantized.pt')
+    if not os.path.exists(quantized_path):
+        quantized = torch.quantization.quantize_dynamic(_load_torch(), {torch.nn.Linear}, dtype=torch.qint8)
+        # Written under a temporary name, so another process never loads a partial file
+        temporary = f"{quantized_path}.{os.getpid()}.tmp"
+        torch.save(quantized.state_dict(), temporary)
+        os.replace(temporary, quantized_path)
+        return quantized
+    # Build the int8 skeleton from the config and fill it from the cache, without reading the fp32 weights
+    skeleton = BertForSequenceClassification(BertForSequenceClassification.config_class.from_pretrained(model_directory))
+    quantized = torch.quantization.quantize_dynamic(skeleton, {torch.nn.Linear}, dtype=torch.qint8)
+    quantized.load_state_dict(torch.load(quantized_path))
+    quantized.eval()
+    return quantized
+
+def _load_onnx():
+    # onnxruntime is optional (requirements-optional.txt)
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError("CLASSIFIER_BACKEND=onnx requires onnxruntime: pip install -r requirements-optional.txt")
+
+    onnx_path = _artifact_path('model.onnx')
+    if not os.path.exists(onnx_path):
+        fp32_model = _load_torch()
+        temporary = f"{onnx_path}.{os.getpid()}.tmp"
+        sample = get_tokenizer()(["texto de ejemplo"], return_tensors='pt')
+        # Positional order of BertForSequenceClassification.forward
+        input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in sample]
+        torch.onnx.export(
+            fp32_model, tuple(sample[name] for name in input_names), temporary,
+            input_names=input_names, output_names=['logits'],
+            dynamic_axes={**{name: {0: 'batch', 1: 'sequence'} for name in input_names}, 'logits': {0: 'batch'}},
+            opset_version=14
+        )
+        os.replace(temporary, onnx_path)
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = torch.get_num_threads()
+    return onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+
+def load_model(name):
+    """ Load the model for the given backend, building and caching its artifact if needed. """
+    if name == 'torch':
+        return _load_torch()
+    if name == 'quantized':
+        return _load_quantized()
+    if name == 'onnx':
+        return _load_onnx()
+    raise ValueError(f"Unknown classifier backend '{name}', expected one of {BACKENDS}")
+
+def _predict(loaded_model, inputs):
+    """ Run a tokenized batch through a loaded model and return the class probabilities. """
+    if isinstance(loaded_model, torch.nn.Module):
+        logits = loaded_model(**inputs).logits
+    else:
+        feed = {node.name: inputs[node.name].numpy() for node in loaded_model.get_inputs()}
+        logits = torch.from_numpy(loaded_model.run(['logits'], feed)[0])
+    return softmax(logits, dim=1)
+
+# The tokenizer and model are loaded on first use instead of at import time
+_load_lock = threading.RLock()
+_tokenizer = None
+_model = None
+
+def get_tokenizer():
+    """ Return the fast (Rust) tokenizer, loading it on first use. """
+    global _tokenizer
+    with _load_lock:
+        if _tokenizer is None:
+            # Built from vocab.txt when the model directory has no tokenizer.json
+            _tokenizer = BertTokenizerFast.from_pretrained(model_directory)
+    return _tokenizer
+
+def get_model():
+    """ Return the model for the configured backend, loading it on first use. """
+    global _model
+    with _load_lock:
+        if _model is None:
+            _model = load_model(backend)
+    return _model
+
+_fingerprint = None
+_files_fingerprint = None
+_tokenizer_fingerprint = None
+
+def _hash_model_files():
+    """ Hash the files in the model directory in one pass, with and without the backend. """
+    global _fingerprint, _files_fingerprint
+    with_backend = hashlib.sha256(backend.encode('utf-8'))
+    files_only = hashlib.sha256()
+    for name in sorted(os.listdir(model_directory)):
+        path = os.path.join(model_directory, name)
+        if not os.path.isfile(path):
+            continue
+        for digest in (with_backend, files_only):
+            digest.update(name.encode('utf-8'))
+        with open(path, 'rb') as model_file:
+            for block in iter(lambda: model_file.read(1 << 20), b''):
+                with_backend.update(block)
+                files_only.update(block)
+    _fingerprint = with_backend.hexdigest()[:16]
+    _files_fingerprint = files_only.hexdigest()[:16]
+
+def model_fingerprint():
+    """ Return a short hash of the backend and the files in the model directory. """
+    with _load_lock:
+        if _fingerprint is None:
+            _hash_model_files()
+    return _fingerprint
 
+def model_files_fingerprint():
+    """ Return a short hash of the files in the model directory alone, which keys the derived backend artifacts. """
+    with _load_lock:
+        if _files_fingerprint is None:
+            _hash_model_files()
+    return _files_fingerprint
+
+def tokenizer_fingerprint():
+    """ Return a short hash of the tokenizer files and truncation length, which alone determine the token ids. """
+    global _tokenizer_fingerprint
+    with _load_lock:
+        if _tokenizer_fingerprint is None:
+            digest = hashlib.sha256(f"max_length={MAX_LENGTH}".encode('utf-8'))
+            for name in TOKENIZER_FILES:
+                path = os.path.join(model_directory, name)
+                if os.path.isfile(path):
+                    digest.update(name.encode('utf-8'))
+                    with open(path, 'rb') as tokenizer_file:
+                        digest.update(tokenizer_file.read())
+            _tokenizer_fingerprint = digest.hexdigest()[:16]
+    return _tokenizer_fingerprint
+
+def warm_up():
+    """ Load the tokenizer and model and run one prediction so the first real batch is fast. """
+    classify_batch(["buena atención"])
+
+@instrumentation.timed('classifier.classify_text')
 def classify_text(text):
-    inputs = tokenizer(text, padding=True, truncation=True, max_length=512, return_tensors='pt')
+    inputs = get_tokenizer()(text, padding=True, truncation=True, max_length=MAX_LENGTH, return_tensors='pt')
     with torch.no_grad():
-        outputs = model(**inputs)
-    probabilities = softmax(outputs.logits, dim=1)
+        probabilities = _predict(get_model(), inputs)
     top_prob, top_pred = torch.max(probabilities, dim=1)
     confidence = top_prob.item()
     prediction = top_pred.item()
-    return prediction, confidence
\ No newline at end of file
+    return prediction, confidence
+
+def encode_texts(texts):
+    """ Tokenize texts in one batch call of the fast tokenizer, returning the unpadded token ids of each. """
+    texts = list(texts)
+    if not texts:
+        return []  # The fast tokenizer raises IndexError on an empty batch
+    with instrumentation.span('classifier.tokenize'):
+        return get_tokenizer()(texts, truncation=True, max_length=MAX_LENGTH)['input_ids']
+
+def predict_encoded(sequences, batch_size=32, loaded_model=None):
+    """ Return the class probability vector of each token id sequence, in input order. """
+    loaded_model = loaded_model if loaded_model is not None else get_model()
+    pad_id = get_tokenizer().pad_token_id
+    results = [None] * len(sequences)
+    if not sequences:
+        return results
+    instrumentation.count('classifier.texts', len(sequences))
+
+    # Sort by token length so every batch only pads up to its own longest sequence instead of MAX_LENGTH
+    order = sorted(range(len(sequences)), key=lambda i: len(sequences[i]))
+
+    with torch.inference_mode():
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            width = len(sequences[indices[-1]])
+            input_ids = np.full((len(indices), width), pad_id, dtype=np.int64)
+            attention_mask = np.zeros((len(indices), width), dtype=np.int64)
+            for row, i in enumerate(indices):
+                input_ids[row, :len(sequences[i])] = sequences[i]
+                attention_mask[row, :len(sequences[i])] = 1
+            # Same tensors as tokenizer.pad: right padding and a single segment
+            inputs = {
+                'input_ids': torch.from_numpy(input_ids),
+                'attention_mask': torch.from_numpy(attention_mask),
+                'token_type_ids': torch.zeros((len(indices), width), dtype=torch.int64)
+            }
+            with instrumentation.span('classifier.forward'):
+                probabilities = _predict(loaded_model, inputs)
+            for i, vector in zip(indices, probabilities.tolist()):
+                results[i] = tuple(vector)
+
+    return results
+
+def predict_batch(texts, batch_size=32, loaded_model=None):
+    """ Return the class probability vector of each text, in input order. """
+    return predict_encoded(encode_texts(texts), batch_size=batch_size, loaded_model=loaded_model)
+
+def top_prediction(probabilities):
+    """ Return (prediction, confidence) for a probability vector. """
+    confidence = max(probabilities)
+    return probabilities.index(confidence), confidence
+
+def classify_batch(texts, batch_size=32, loaded_model=None):
+    """ Classify many texts at once, returning (prediction, confidence) pairs in input order. """
+    vectors = predict_batch(texts, batch_size=batch_size, loaded_model=loaded_model)
+    return [top_prediction(vector) for vector in vectors]
+
+def check_backend_agreement(texts, candidate='quantized', batch_size=32):
+    """ Compare a backend against the fp32 model on sample texts: label agreement rate and timings. """
+    reference_model = get_model() if backend == 'torch' else load_model('torch')
+    candidate_model = get_model() if backend == candidate else load_model(candidate)
+
+    start = time.perf_counter()
+    reference = classify_batch(texts, batch_size=batch_size, loaded_model=reference_model)
+    reference_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = classify_batch(texts, batch_size=batch_size, loaded_model=candidate_model)
+    candidate_seconds = time.perf_counter() - start
+
+    matches = sum(1 for (expected, _), (predicted, _) in zip(reference, results) if expected == predicted)
+    return {
+        'backend': candidate,
+        'samples': len(texts),
+        'agreement': matches / len(texts) if texts else 1.0,
+        'reference_seconds': reference_seconds,
+        'backend_seconds': candidate_seconds,
+        'speedup': reference_seconds / candidate_seconds if candidate_seconds else None
+    }
+
+def set_num_threads(num_threads):
+    """ Limit the number of intra-op threads torch uses in this process. """
+    torch.set_num_threads(num_threads)
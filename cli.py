@@ -0,0 +1,194 @@
+import argparse
+import contextlib
+import multiprocessing
+import signal
+import threading
+import time
+
+import database
+import instrumentation
+import pipeline
+
+# ENG: Headless entry point for scheduled or continuous classification, without tkinter
+# ESP: Punto de entrada sin interfaz para clasificación programada o continua, sin tkinter
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Clasificador de Datos - clasificación sin interfaz gráfica")
+    parser.add_argument('--batch-size', type=int, default=pipeline.BATCH_SIZE, help="comments per forward pass")
+    parser.add_argument('--chunk-size', type=int, default=pipeline.CHUNK_SIZE,
+                        help="documents read and written back at a time")
+    parser.add_argument('--workers', type=int, default=pipeline.NUM_WORKERS, help="model replica processes")
+    parser.add_argument('--threads-per-worker', type=int, default=pipeline.THREADS_PER_WORKER,
+                        help="torch threads per worker (0 lets torch decide)")
+    parser.add_argument('--confidence-threshold', type=float, default=pipeline.CONFIDENCE_THRESHOLD,
+                        help="below this confidence the target is set to 4 (Error al clasificar)")
+    parser.add_argument('--max-documents', type=int, default=None, help="stop after this many documents per pass")
+    parser.add_argument('--dry-run', action='store_true', help="classify without writing anything to MongoDB")
+    parser.add_argument('--no-resume', action='store_true', help="start a new run instead of resuming an interrupted one")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only classify documents inserted after the last run of the current model")
+    parser.add_argument('--distributed', action='store_true',
+                        help="claim chunks under a lease so several nodes can share the backlog")
+    parser.add_argument('--worker-id', help="name of this node in --distributed mode (default: host-pid-random)")
+    parser.add_argument('--lease-seconds', type=int, default=pipeline.LEASE_SECONDS,
+                        help="lease of claimed chunks in --distributed mode; expired leases are reclaimed")
+    parser.add_argument('--watch', action='store_true',
+                        help="keep classifying new documents, from a change stream or by polling")
+    parser.add_argument('--poll-interval', type=float, default=30,
+                        help="seconds between polls in --watch mode when change streams are unavailable")
+    parser.add_argument('--check-backend', choices=['quantized', 'onnx'],
+                        help="report label agreement of a backend with the fp32 model and exit")
+    parser.add_argument('--samples', type=int, default=500, help="comments sampled by --check-backend")
+    parser.add_argument('--threshold-histogram', type=float, nargs='+', metavar='THRESHOLD',
+                        help="report how many documents each confidence threshold would label 4 and exit")
+    parser.add_argument('--rethreshold', type=float, metavar='THRESHOLD',
+                        help="re-apply a confidence threshold to the stored probabilities, without the model, and exit")
+    parser.add_argument('--profile', metavar='PATH',
+                        help="run under cProfile and write the stats to PATH (use --workers 1 to profile the model too)")
+    parser.add_argument('--metrics', metavar='PATH',
+                        help="write the instrumentation metrics to PATH, as JSON or Prometheus text for .prom "
+                             "(requires INSTRUMENTATION=1)")
+    parser.add_argument('--ensure-indexes', action='store_true', help="create the MongoDB indexes and exit")
+    parser.add_argument('--explain-searches', action='store_true',
+                        help="report whether each search mode uses an index and exit")
+    return parser.parse_args(argv)
+
+def check_backend(args):
+    """ Compare a backend with the fp32 model on a random sample of comments. """
+    import classifier
+
+    texts = [doc['razon'] for doc in database.get_collection().aggregate([
+        {'$match': {'razon': {'$type': 'string'}}},
+        {'$sample': {'size': args.samples}},
+        {'$project': {'_id': 0, 'razon': 1}}
+    ])]
+    report = classifier.check_backend_agreement(texts, candidate=args.check_backend, batch_size=args.batch_size)
+    print(f"Backend {report['backend']}: {report['agreement']:.2%} agreement on {report['samples']} comments, "
+          f"{report['reference_seconds']:.2f}s fp32 vs {report['backend_seconds']:.2f}s "
+          f"({report['speedup'] or 0:.2f}x)")
+
+def run(args, cancel_event):
+    """ Classify once, or continuously in --watch mode, and return the accumulated totals. """
+    totals = {'passes': 0, 'num_updated': 0, 'confidence_sum': 0, 'label_counts': {}, 'polling': False}
+
+    def record(summary):
+        if summary.get('polling') and not totals['polling']:
+            totals['polling'] = True
+            print(f"Change streams unavailable, polling every {args.poll_interval}s instead")
+        if summary['resumed_run'] is not None:
+            print(f"Resumed classification run {summary['resumed_run']} after {summary['resumed_after']} documents")
+        totals['passes'] += 1
+        totals['num_updated'] += summary['num_updated']
+        totals['confidence_sum'] += summary['average_confidence'] * summary['num_updated']
+        for label, count in summary['label_counts'].items():
+            totals['label_counts'][label] = totals['label_counts'].get(label, 0) + count
+        print(f"Classified {summary['num_updated']} documents at {summary['docs_per_second']:.1f} docs/s "
+              f"(average confidence {summary['average_confidence']:.2%})")
+        write_back = summary['write_back']
+        print(f"Bulk write-back: {write_back['matched']} matched, {write_back['modified']} modified")
+        for name in ('prediction_cache', 'token_cache'):
+            stats = summary[name]
+            if stats is not None:
+                print(f"{name.replace('_', ' ').capitalize()}: {stats['hits']} hits, {stats['misses']} misses "
+                      f"({stats['hit_rate']:.1%} hit rate)")
+        if summary['lease_heartbeat_failures']:
+            print(f"Lease heartbeat failed {summary['lease_heartbeat_failures']} times; "
+                  "other nodes may have reclaimed some chunks")
+
+    settings = {
+        'batch_size': args.batch_size,
+        'chunk_size': args.chunk_size,
+        'workers': args.workers,
+        'threads_per_worker': args.threads_per_worker,
+        'confidence_threshold': args.confidence_threshold,
+        'max_documents': args.max_documents,
+        'resume': not args.no_resume
+    }
+    if args.distributed:
+        settings.update(distributed=True, worker_id=args.worker_id, lease_seconds=args.lease_seconds)
+    # Distributed nodes do not keep a watermark, so they poll the shared backlog instead
+    if args.watch and not args.dry_run and not args.distributed:
+        # New documents are picked up from the watermark, so the collection is never rescanned
+        pipeline.follow_new_documents(cancel_event, poll_interval=args.poll_interval, on_summary=record,
+                                      catch_up=not args.incremental, **settings)
+        return totals
+
+    # A dry run writes no watermark, so later passes continue after the last seen document instead
+    after_id = None
+    while not cancel_event.is_set():
+        if database.has_uncategorized_after(after_id):
+            summary = pipeline.classify_pending(dry_run=args.dry_run, after_id=after_id, cancel_event=cancel_event,
+                                                incremental=args.incremental, **settings)
+            if args.dry_run:
+                after_id = summary['last_id']
+            record(summary)
+
+        if not args.watch:
+            break
+        cancel_event.wait(args.poll_interval)
+    return totals
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.check_backend:
+        check_backend(args)
+        return
+    if args.threshold_histogram or args.rethreshold is not None:
+        if args.threshold_histogram:
+            report = database.threshold_histogram(args.threshold_histogram)
+            print(f"{report['total']} documents with stored probabilities, "
+                  f"{report['current_error_count']} labeled 4 today")
+            for entry in report['thresholds']:
+                print(f"  threshold {entry['threshold']:.2f}: {entry['error_count']} labeled 4 ({entry['change']:+d})")
+        if args.rethreshold is not None:
+            changed = database.rethreshold(args.rethreshold)
+            print(f"Threshold {args.rethreshold:.2f} applied: {changed} targets changed")
+        return
+    if args.ensure_indexes or args.explain_searches:
+        if args.ensure_indexes:
+            print(f"Indexes ready: {', '.join(database.ensure_indexes())}")
+        if args.explain_searches:
+            for entry in database.explain_search_plans():
+                print(f"{entry['column']:<20} {'index' if entry['uses_index'] else 'COLLECTION SCAN':<16} "
+                      f"{' > '.join(entry['stages'])}")
+        return
+
+    # The first Ctrl+C or SIGTERM stops cleanly after the current chunk; a second one aborts
+    # El primer Ctrl+C o SIGTERM detiene limpiamente tras el bloque actual; un segundo aborta
+    cancel_event = threading.Event()
+
+    def request_stop(signum, frame):
+        if cancel_event.is_set():
+            raise KeyboardInterrupt
+        print("Stopping after the current chunk...")
+        cancel_event.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    if args.metrics and not instrumentation.ENABLED:
+        print("Instrumentation is disabled: set INSTRUMENTATION=1 to collect --metrics")
+    if args.profile and args.workers > 1:
+        print("Profiling the main process only; classification runs in worker processes (see --workers 1)")
+    start_time = time.perf_counter()
+    with instrumentation.profile(args.profile) if args.profile else contextlib.nullcontext():
+        totals = run(args, cancel_event)
+    elapsed = time.perf_counter() - start_time
+    if args.metrics and instrumentation.ENABLED:
+        instrumentation.export(args.metrics)
+        print(f"Metrics written to {args.metrics}")
+
+    num_updated = totals['num_updated']
+    print(f"Throughput report: {num_updated} documents in {totals['passes']} passes, {elapsed:.1f}s wall time, "
+          f"{num_updated / elapsed if elapsed else 0:.1f} docs/s")
+    if num_updated:
+        print(f"Average confidence: {totals['confidence_sum'] / num_updated:.2%}")
+        for label, count in sorted(totals['label_counts'].items()):
+            print(f"  target {label}: {count}")
+    if args.dry_run:
+        print("Dry run: no targets were written")
+
+if __name__ == '__main__':
+    # Required for worker processes to start from a PyInstaller bundle
+    multiprocessing.freeze_support()
+    main()
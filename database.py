@@ -1,8 +1,18 @@
 import os
-from pymongo import MongoClient
+import re
+from pymongo import MongoClient, UpdateOne, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from bson import ObjectId
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import sys
+import time
+import threading
+import socket
+import uuid
+from collections import namedtuple, OrderedDict
+
+import instrumentation
 
 # Load environment variables
 # Cargar variables de entorno
@@ -17,43 +27,596 @@ else:
 dotenv_path = os.path.join(app_dir, '.env.development')
 load_dotenv(dotenv_path)
 
-# Establish MongoDB connection
-# Establecer conexión MongoDB
+# MongoDB connection settings; the client is created on first use
+# Parámetros de conexión MongoDB; el cliente se crea en el primer uso
 uri = os.getenv('MONGODB_URI')
-client = MongoClient(uri)
-db = client['cmvalparaisoDas']
-collection = db['opinionSaludValparaiso']
-log_collection = db['log']
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """ Return the shared MongoClient, connecting on first use. """
+    """ Devolver el MongoClient compartido, conectando en el primer uso. """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = MongoClient(uri)
+    return _client
+
+def get_collection():
+    """ Return the survey collection. """
+    """ Devolver la colección de encuestas. """
+    return get_client()['cmvalparaisoDas']['opinionSaludValparaiso']
+
+def get_log_collection():
+    """ Return the log collection. """
+    """ Devolver la colección de registros. """
+    return get_client()['cmvalparaisoDas']['log']
+
+def get_watermark_collection():
+    """ Return the collection holding the incremental classification watermarks. """
+    """ Devolver la colección con las marcas de agua de la clasificación incremental. """
+    return get_client()['cmvalparaisoDas']['watermarks']
+
+# Categorical fields are searched through their distinct values so the query can use an index
+# Los campos categóricos se buscan mediante sus valores distintos para que la consulta use un índice
+CATEGORICAL_FIELDS = ["genero", "cesfam", "frecuencia"]
+
+# Explorer queries are stopped by the server after this many milliseconds, so a runaway regex cannot hang it
+# Las consultas del explorador se detienen en el servidor tras estos milisegundos, para que un regex no lo bloquee
+SEARCH_MAX_TIME_MS = int(os.getenv('SEARCH_MAX_TIME_MS', '15000'))
+
+class QueryCancelled(Exception):
+    """ Raised in the thread running a search whose QueryHandle was cancelled. """
+
+class QueryHandle:
+    """ Tracks the cursors opened for one explorer search, so another thread can kill them. """
+    """ Registra los cursores abiertos por una búsqueda del explorador, para que otro hilo pueda cerrarlos. """
+
+    def __init__(self):
+        self.cancelled = False
+        self._cursors = []
+        self._lock = threading.Lock()
+
+    def track(self, cursor):
+        """ Register a cursor, closing it right away if the search was already cancelled. """
+        with self._lock:
+            if self.cancelled:
+                cursor.close()
+                raise QueryCancelled()
+            self._cursors.append(cursor)
+        return cursor
+
+    def check(self):
+        """ Raise QueryCancelled if the search was cancelled, e.g. after a cursor was closed mid-iteration. """
+        if self.cancelled:
+            raise QueryCancelled()
+
+    def cancel(self):
+        """ Kill the open cursors on the server; the searching thread stops at its next check. """
+        """ Cerrar los cursores abiertos en el servidor; el hilo de búsqueda se detiene en su siguiente revisión. """
+        with self._lock:
+            self.cancelled = True
+            cursors, self._cursors = self._cursors, []
+        for cursor in cursors:
+            cursor.close()
+
+def _read_rows(cursor, handle):
+    """ Decode a cursor into SurveyRows, aborting if the search was cancelled meanwhile. """
+    if handle is not None:
+        handle.track(cursor)
+    rows = [to_row(doc) for doc in cursor]
+    if handle is not None:
+        # A killed cursor just stops early, so partial results must not be returned (or cached)
+        handle.check()
+    return rows
+
+def ensure_indexes():
+    """ Create the indexes used by classification, statistics and searches. Safe to run repeatedly. """
+    """ Crear los índices usados por la clasificación, las estadísticas y las búsquedas. Se puede repetir. """
+    collection = get_collection()
+    created = [
+        # Uncategorized counts and the classification scan in _id order
+        collection.create_index([('target', ASCENDING), ('_id', ASCENDING)]),
+        collection.create_index([('date', ASCENDING)]),
+        collection.create_index([('edad', ASCENDING)]),
+        collection.create_index([('satisfaccion', ASCENDING)]),
+        collection.create_index([('recomendacion', ASCENDING)]),
+    ]
+    created += [collection.create_index([(field, ASCENDING)]) for field in CATEGORICAL_FIELDS]
+    created.append(get_log_collection().create_index([('status', ASCENDING), ('date', DESCENDING)]))
+    return created
+
+# Fields shown in the data explorer, in table column order; queries for the explorer only fetch these
+# Campos mostrados en el explorador, en el orden de la tabla; las consultas del explorador solo traen estos
+DISPLAY_FIELDS = ('_id', 'edad', 'genero', 'cesfam', 'frecuencia', 'satisfaccion', 'recomendacion', 'razon', 'date', 'target')
+DISPLAY_PROJECTION = {field: 1 for field in DISPLAY_FIELDS}
+
+TARGET_TEXTS = {
+    0: 'Irrelevante',
+    1: 'Negativo',
+    2: 'Positivo',
+    3: 'Sin clasificar',
+    4: 'Error al clasificar'
+}
+
+# Compact, ready-to-insert explorer row; namedtuples have no per-instance __dict__
+# Fila compacta del explorador, lista para insertar; las namedtuple no tienen __dict__ por instancia
+SurveyRow = namedtuple('SurveyRow', ['id', 'edad', 'genero', 'cesfam', 'frecuencia', 'satisfaccion',
+                                     'recomendacion', 'razon', 'date', 'etiqueta'])
+
+def to_row(document):
+    """ Decode a projected document into a SurveyRow with the label already converted to text. """
+    """ Convertir un documento proyectado en una SurveyRow con la etiqueta ya convertida a texto. """
+    get = document.get
+    return SurveyRow(document['_id'], get('edad', ''), get('genero', ''), get('cesfam', ''), get('frecuencia', ''),
+                     get('satisfaccion', ''), get('recomendacion', ''), get('razon', ''), get('date', ''),
+                     TARGET_TEXTS.get(get('target'), 'Desconocido'))
+
+class QueryCache:
+    """ In-process LRU cache of query results with a TTL, an approximate memory bound and hit/miss counters. """
+    """ Caché LRU en proceso de resultados de consultas con TTL, límite aproximado de memoria y contadores. """
+
+    def __init__(self, ttl_seconds=60, max_bytes=64 * 2**20):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._size = 0
+        self._generation = 0  # Bumped by clear(), so results computed across a write are not stored
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        """ Return the cached value for key, or compute, store and return it. """
+        """ Devolver el valor en caché para la clave, o calcularlo, guardarlo y devolverlo. """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            generation = self._generation
+        value = compute()
+        # Keys hold the repr of the filter, which can be large, so they count towards the bound too
+        size = _estimate_size(key) + _estimate_size(value)
+        with self._lock:
+            # A write cleared the cache while computing: the value may predate it, so it is returned but not kept
+            # Una escritura vació la caché durante el cálculo: el valor puede ser anterior, se devuelve sin guardarlo
+            if size <= self.max_bytes and generation == self._generation:
+                self._discard(key)
+                self._entries[key] = (now + self.ttl_seconds, size, value)
+                self._size += size
+                while self._size > self.max_bytes:
+                    self._discard(next(iter(self._entries)))
+        return value
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+    def clear(self):
+        """ Drop every cached result; called whenever targets are written. """
+        """ Descartar todos los resultados; se llama cada vez que se escriben objetivos. """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self._generation += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0,
+                    'entries': len(self._entries), 'bytes': self._size}
+
+def _estimate_size(value):
+    """ Roughly estimate the memory held by a cached result. """
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_estimate_size(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_estimate_size(item) for item in value.values())
+    return sys.getsizeof(value)
+
+query_cache = QueryCache(ttl_seconds=float(os.getenv('QUERY_CACHE_TTL', '60')),
+                         max_bytes=int(os.getenv('QUERY_CACHE_MAX_BYTES', str(64 * 2**20))))
 
 def reset_all_targets_to_3():
     """ Reset all document targets to 3 in the collection. """
     """ Restablecer todos los objetivos de los documentos a 3 en la colección. """
-    collection.update_many({}, {'$set': {'target': 3}})
+    # Skip documents that are already uncategorized so they are not rewritten
+    # Omitir documentos que ya están sin categorizar para no reescribirlos
+    # The stored probabilities are dropped too, so a later rethreshold cannot label the reset documents again
+    # También se descartan las probabilidades, para que un nuevo umbral no vuelva a etiquetar lo restablecido
+    result = get_collection().update_many({'target': {'$ne': 3}}, {
+        '$set': {'target': 3},
+        '$unset': {'probabilities': '', 'model_fingerprint': ''}
+    })
+    query_cache.clear()
+    # Every document is pending again, so incremental runs must start over from the first one,
+    # and an interrupted run must not be resumed past the documents that were just reset
+    # Todos los documentos vuelven a estar pendientes: las ejecuciones incrementales parten de cero
+    # y una ejecución interrumpida no debe reanudarse más allá de los documentos restablecidos
+    clear_watermarks()
+    close_open_runs()
+    return result.modified_count
+
+def iter_document_chunks(chunk_size=500, after_id=None, limit=None):
+    """ Yield uncategorized documents ({_id, razon}) in _id order and in chunks, streamed through a server-side cursor. """
+    """ Generar documentos sin categorizar ({_id, razon}) en orden de _id y en bloques, leídos con un cursor del servidor. """
+    query = {'target': 3}
+    if after_id is not None:
+        # Resume after the last document of an interrupted run
+        # Continuar después del último documento de una ejecución interrumpida
+        query['_id'] = {'$gt': after_id}
+    cursor = get_collection().find(query, {'_id': 1, 'razon': 1}, sort=[('_id', 1)], batch_size=chunk_size,
+                                   limit=limit or 0)
+    return _iter_chunks(cursor, chunk_size)
 
-def get_documents():
-    """ Retrieve documents with target 3 from the collection. """
-    """ Recuperar documentos con objetivo 3 de la colección. """
-    return list(collection.find({'target': 3}))
+def has_uncategorized_after(after_id=None):
+    """ Check whether any uncategorized document comes after the given _id, using the {target, _id} index. """
+    """ Comprobar si algún documento sin categorizar viene después del _id dado, usando el índice {target, _id}. """
+    query = {'target': 3}
+    if after_id is not None:
+        query['_id'] = {'$gt': after_id}
+    return get_collection().find_one(query, {'_id': 1}) is not None
+
+def open_insert_stream():
+    """ Open a change stream of inserted survey ids, or return None when the server does not support change streams. """
+    """ Abrir un change stream de ids insertados, o devolver None si el servidor no admite change streams. """
+    try:
+        # Only the document key is needed; the pass that follows reads the documents itself
+        return get_collection().watch([
+            {'$match': {'operationType': 'insert'}},
+            {'$project': {'documentKey': 1}}
+        ], max_await_time_ms=1000)
+    except OperationFailure:
+        # A standalone mongod has no oplog, hence no change streams; the caller polls instead
+        return None
+
+def iter_comment_chunks(chunk_size=2000, after_id=None):
+    """ Yield every document's {_id, razon} in _id order and in chunks, optionally after a given _id. """
+    """ Generar {_id, razon} de cada documento en orden de _id y en bloques, opcionalmente tras un _id. """
+    query = {'_id': {'$gt': after_id}} if after_id is not None else {}
+    cursor = get_collection().find(query, {'_id': 1, 'razon': 1}, sort=[('_id', 1)], batch_size=chunk_size)
+    return _iter_chunks(cursor, chunk_size)
+
+def iter_row_chunks(chunk_size=5000, after_id=None):
+    """ Yield the displayed fields of every document in _id order and in chunks, optionally after a given _id. """
+    """ Generar los campos mostrados de cada documento en orden de _id y en bloques, opcionalmente tras un _id. """
+    query = {'_id': {'$gt': after_id}} if after_id is not None else {}
+    cursor = get_collection().find(query, DISPLAY_PROJECTION, sort=[('_id', 1)], batch_size=chunk_size)
+    return _iter_chunks(cursor, chunk_size)
+
+def iter_target_chunks(chunk_size=20000):
+    """ Yield every document's {_id, target} in chunks, in no particular order. """
+    """ Generar {_id, target} de cada documento en bloques, sin un orden particular. """
+    cursor = get_collection().find({}, {'_id': 1, 'target': 1}, batch_size=chunk_size)
+    return _iter_chunks(cursor, chunk_size)
+
+def _iter_chunks(cursor, chunk_size):
+    """ Group a cursor into lists of chunk_size documents, closing it when done. """
+    try:
+        chunk = []
+        for doc in cursor:
+            chunk.append(doc)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    finally:
+        cursor.close()
 
 def update_target(document_id, new_target):
     """ Update the target of a specific document. """
     """ Actualizar el objetivo de un documento específico. """
-    collection.update_one({'_id': document_id}, {'$set': {'target': new_target}})
+    get_collection().update_one({'_id': document_id}, {'$set': {'target': new_target}})
+    query_cache.clear()
+
+# Decimals kept of each stored class probability
+# Decimales guardados de cada probabilidad de clase
+PROBABILITY_DIGITS = 4
+
+class BulkTargetUpdater:
+    """ Buffer target updates and flush them with unordered bulk_write calls. """
+    """ Acumular actualizaciones de objetivo y enviarlas con bulk_write no ordenado. """
+
+    def __init__(self, batch_size=500, release_claims=None):
+        self.batch_size = batch_size
+        self.release_claims = release_claims  # Worker id whose WorkClaimer lease is dropped by each write
+        self.operations = []
+        self.matched_count = 0
+        self.modified_count = 0
+
+    def add(self, document_id, new_target, probabilities=None, fingerprint=None):
+        """ Queue a target update, and optionally the probabilities behind it, flushing once the buffer is full. """
+        """ Encolar una actualización, y opcionalmente sus probabilidades, enviando el búfer al llenarse. """
+        update = {'$set': {'target': new_target}}
+        if probabilities is not None:
+            # Kept so the confidence threshold can be re-applied without running the model again
+            update['$set']['probabilities'] = [round(value, PROBABILITY_DIGITS) for value in probabilities]
+            update['$set']['model_fingerprint'] = fingerprint
+        if self.release_claims is not None:
+            # Only this worker's lease is dropped: if a slower node lost the document to another, that lease stays
+            # Solo se elimina el arriendo de este nodo: si otro ya reclamó el documento, su arriendo se mantiene
+            held = {'$eq': ['$claimed_by', self.release_claims]}
+            update = [{'$set': {
+                **{field: {'$literal': value} for field, value in update['$set'].items()},
+                'claimed_by': {'$cond': [held, '$$REMOVE', '$claimed_by']},
+                'lease_expires': {'$cond': [held, '$$REMOVE', '$lease_expires']}
+            }}]
+        self.operations.append(UpdateOne({'_id': document_id}, update))
+        if len(self.operations) >= self.batch_size:
+            self.flush()
+
+    @instrumentation.timed('database.BulkTargetUpdater.flush')
+    def flush(self):
+        """ Send all queued updates in a single round trip. """
+        """ Enviar todas las actualizaciones encoladas en un solo viaje. """
+        if not self.operations:
+            return
+        result = get_collection().bulk_write(self.operations, ordered=False)
+        query_cache.clear()
+        self.matched_count += result.matched_count
+        self.modified_count += result.modified_count
+        self.operations = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Write whatever was already classified, even if the run was interrupted
+        # Escribir lo ya clasificado, incluso si la ejecución se interrumpió
+        self.flush()
+
+class WorkClaimer:
+    """ Claim chunks of uncategorized documents under a renewable lease, so several nodes can share the backlog. """
+    """ Reclamar bloques de documentos sin categorizar con un arriendo renovable, para repartir el trabajo entre nodos. """
+
+    def __init__(self, worker_id=None, lease_seconds=300, heartbeat_seconds=None):
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds or lease_seconds / 3
+        self.held_ids = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+        # Failed renewals are counted instead of printed; the caller reports them
+        self.heartbeat_failures = 0
+
+    @staticmethod
+    def _claimable():
+        # Uncategorized documents nobody holds, or whose holder let the lease expire (e.g. it crashed).
+        # Leases are set and compared with the server clock ($$NOW), so node clocks and time zones do not matter
+        # Los arriendos se fijan y comparan con el reloj del servidor, así que los relojes de los nodos no importan
+        return {'target': 3, '$or': [{'lease_expires': {'$exists': False}},
+                                     {'$expr': {'$lt': ['$lease_expires', '$$NOW']}}]}
+
+    def _lease_update(self):
+        return [{'$set': {'lease_expires': {'$add': ['$$NOW', int(self.lease_seconds * 1000)]}}}]
+
+    @instrumentation.timed('database.WorkClaimer.claim')
+    def claim(self, chunk_size):
+        """ Atomically claim up to chunk_size documents and return them ({_id, razon}) in _id order, [] when none are left. """
+        """ Reclamar atómicamente hasta chunk_size documentos y devolverlos ({_id, razon}) en orden de _id, [] si no quedan. """
+        collection = get_collection()
+        while True:
+            candidates = [doc['_id'] for doc in collection.find(self._claimable(), {'_id': 1},
+                                                                 sort=[('_id', 1)], limit=chunk_size)]
+            if not candidates:
+                return []
+            # The filter is re-checked per document by the server, so a document goes to exactly one worker
+            # El servidor vuelve a evaluar el filtro por documento, así que cada documento va a un solo nodo
+            update = self._lease_update()
+            update[0]['$set']['claimed_by'] = self.worker_id
+            result = collection.update_many({'_id': {'$in': candidates}, **self._claimable()}, update)
+            if not result.modified_count:
+                continue  # Another worker won every candidate, try the next ones
+            with self._lock:
+                # Documents still held from an earlier chunk are already being classified
+                fresh = [document_id for document_id in candidates if document_id not in self.held_ids]
+                documents = list(collection.find({'_id': {'$in': fresh}, 'claimed_by': self.worker_id},
+                                                 {'_id': 1, 'razon': 1}, sort=[('_id', 1)]))
+                self.held_ids.update(doc['_id'] for doc in documents)
+            if documents:
+                return documents
+
+    def iter_chunks(self, chunk_size=500, limit=None):
+        """ Yield claimed chunks until the backlog is empty or limit documents were claimed. """
+        """ Generar bloques reclamados hasta vaciar el trabajo pendiente o reclamar limit documentos. """
+        claimed = 0
+        while not limit or claimed < limit:
+            chunk = self.claim(min(chunk_size, limit - claimed) if limit else chunk_size)
+            if not chunk:
+                return
+            claimed += len(chunk)
+            yield chunk
+
+    def renew(self):
+        """ Extend the lease of every held document (heartbeat). """
+        """ Extender el arriendo de cada documento retenido (latido). """
+        with self._lock:
+            ids = list(self.held_ids)
+        if ids:
+            get_collection().update_many({'_id': {'$in': ids}, 'claimed_by': self.worker_id}, self._lease_update())
+
+    def complete(self, ids):
+        """ Stop renewing documents whose targets were written (the write drops their lease). """
+        """ Dejar de renovar documentos cuyos objetivos ya se escribieron (la escritura elimina su arriendo). """
+        with self._lock:
+            self.held_ids.difference_update(ids)
+
+    def release(self):
+        """ Give back every held document so other workers can claim it right away. """
+        """ Devolver todos los documentos retenidos para que otros nodos puedan reclamarlos de inmediato. """
+        with self._lock:
+            ids, self.held_ids = list(self.held_ids), set()
+        if ids:
+            get_collection().update_many({'_id': {'$in': ids}, 'claimed_by': self.worker_id},
+                                         {'$unset': {'claimed_by': '', 'lease_expires': ''}})
+
+    def _run_heartbeat(self):
+        while not self._stop.wait(self.heartbeat_seconds):
+            try:
+                self.renew()
+            except Exception:
+                self.heartbeat_failures += 1
+
+    def start(self):
+        """ Start renewing the held leases in the background. """
+        """ Comenzar a renovar los arriendos retenidos en segundo plano. """
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._run_heartbeat, daemon=True)
+        self._heartbeat.start()
+
+    def stop(self):
+        """ Stop the heartbeat and release the documents that were not written. """
+        """ Detener el latido y liberar los documentos que no se escribieron. """
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        self.release()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+def _threshold_target(threshold):
+    """ Aggregation expression of the target for a threshold: the most probable class, or 4 below the threshold. """
+    confidence = {'$max': '$probabilities'}
+    return {'$cond': [{'$lt': [confidence, threshold]}, 4, {'$indexOfArray': ['$probabilities', confidence]}]}
+
+def _probability_filter(fingerprint=None):
+    # Probabilities of the current model by default, so vectors of different models are never mixed;
+    # uncategorized documents are pending classification and keep target 3
+    if fingerprint is None:
+        import classifier  # Deferred: only the threshold tools need the model fingerprint
+        fingerprint = classifier.model_fingerprint()
+    return {'probabilities': {'$type': 'array'}, 'model_fingerprint': fingerprint, 'target': {'$ne': 3}}
+
+def rethreshold(threshold, fingerprint=None):
+    """
+    Recompute the target of every classified document with stored probabilities of the given model (the current
+    one by default) for a new confidence threshold, server-side with an update pipeline.
+    Returns the number of documents whose target changed.
+    Recalcular el objetivo de cada documento con probabilidades guardadas para un nuevo umbral de confianza.
+    """
+    result = get_collection().update_many(_probability_filter(fingerprint),
+                                          [{'$set': {'target': _threshold_target(threshold)}}])
+    query_cache.clear()
+    return result.modified_count
+
+def threshold_histogram(thresholds, fingerprint=None):
+    """
+    For each threshold, count the classified documents with stored probabilities of the given model (the current
+    one by default) that would be labeled 4 (Error al clasificar) and how many more or fewer that is than today.
+    Para cada umbral, contar los documentos que quedarían con etiqueta 4 y la diferencia con la situación actual.
+    """
+    thresholds = sorted(set(thresholds))
+    boundaries = sorted(set([0] + thresholds + [2]))  # Confidences are at most 1
+    pipeline = [
+        {'$match': _probability_filter(fingerprint)},
+        {'$facet': {
+            # Buckets between consecutive thresholds; the count below a threshold is the sum of the buckets under it
+            'buckets': [
+                {'$bucket': {'groupBy': {'$max': '$probabilities'}, 'boundaries': boundaries,
+                             'default': 'other', 'output': {'count': {'$sum': 1}}}}
+            ],
+            'current': [{'$match': {'target': 4}}, {'$count': 'count'}],
+            'total': [{'$count': 'count'}]
+        }}
+    ]
+    result = next(get_collection().aggregate(pipeline), {})
+    buckets = {entry['_id']: entry['count'] for entry in result.get('buckets', [])}
+    current = result['current'][0]['count'] if result.get('current') else 0
+    histogram = []
+    for threshold in thresholds:
+        below = sum(count for lower, count in buckets.items() if lower != 'other' and lower < threshold)
+        histogram.append({'threshold': threshold, 'error_count': below, 'change': below - current})
+    return {
+        'total': result['total'][0]['count'] if result.get('total') else 0,
+        'current_error_count': current,
+        'thresholds': histogram
+    }
 
 def get_total_documents():
-    """ Get the total count of documents in the collection. """
-    """ Obtener el conteo total de documentos en la colección. """
-    return collection.count_documents({})
+    """ Get the total count of documents in the collection, read from the collection metadata. """
+    """ Obtener el conteo total de documentos en la colección, leído de los metadatos de la colección. """
+    return get_collection().estimated_document_count()
 
 def get_uncategorized_documents():
     """ Get the count of uncategorized documents in the collection. """
     """ Obtener el conteo de documentos sin categorizar en la colección. """
-    return collection.count_documents({'target': 3})
+    return get_collection().count_documents({'target': 3})
+
+def get_label_counts():
+    """ Get the number of documents per target value, in one aggregation. """
+    """ Obtener el número de documentos por valor de objetivo, en una sola agregación. """
+    return {entry['_id']: entry['count']
+            for entry in get_collection().aggregate([{'$group': {'_id': '$target', 'count': {'$sum': 1}}}])}
+
+def get_dashboard_stats():
+    """
+    Get the main window statistics in one round trip: per-label and per-cesfam counts plus the last finished run.
+    Obtener las estadísticas de la ventana principal en una sola consulta: conteos por etiqueta y por cesfam y la última ejecución.
+    """
+    # A single $group by (cesfam, target) yields every count; the last run is joined from the log collection
+    # Un solo $group por (cesfam, target) entrega todos los conteos; la última ejecución se une desde la colección log
+    pipeline = [
+        {'$facet': {
+            'breakdown': [
+                {'$group': {'_id': {'cesfam': '$cesfam', 'target': '$target'}, 'count': {'$sum': 1}}}
+            ],
+            'last_run': [
+                {'$limit': 1},
+                {'$lookup': {
+                    'from': get_log_collection().name,
+                    'pipeline': [
+                        {'$match': {'status': {'$nin': ['running', 'abandoned']}}},
+                        {'$sort': {'date': -1}},
+                        {'$limit': 1}
+                    ],
+                    'as': 'run'
+                }},
+                {'$project': {'_id': 0, 'run': 1}}
+            ]
+        }}
+    ]
+    result = next(get_collection().aggregate(pipeline), {})
+
+    labels = {target: 0 for target in TARGET_TEXTS}
+    cesfam = {}
+    for entry in result.get('breakdown', []):
+        target, count = entry['_id'].get('target'), entry['count']
+        labels[target] = labels.get(target, 0) + count
+        counts = cesfam.setdefault(entry['_id'].get('cesfam') or 'Sin centro', {})
+        counts[target] = counts.get(target, 0) + count
 
-def search_documents(query, column='Todo'):
+    last_run = result.get('last_run')
+    if last_run:
+        last_run = last_run[0]['run'][0] if last_run[0]['run'] else None
+    else:
+        # The lookup needs at least one survey document to run from
+        last_run = get_last_log()
+
+    return {
+        'total': sum(labels.values()),
+        'labels': labels,
+        'cesfam': cesfam,
+        'last_run': last_run
+    }
+
+def build_search_filter(query, column='Todo', comment_ids=None):
     """
-    Search for documents in the collection based on a query and a specific column.
-    Busca documentos en la colección basándose en una consulta y una columna específica.
+    Build the MongoDB filter for a query on a specific column, or None if nothing can match.
+    Construye el filtro MongoDB para una consulta en una columna específica, o None si nada puede coincidir.
+    comment_ids, when given, are the _ids whose comments match according to the local search index.
     """
     # Mapping of front-end column names to database field names
     # Mapeo de nombres de columnas de front-end a nombres de campos de la base de datos
@@ -80,13 +643,15 @@ def search_documents(query, column='Todo'):
     # If searching across all columns
     # Si se busca en todas las columnas
     if column == 'Todo':
-        regex_query = {"$regex": f"{query}", "$options": 'i'}
         int_query = try_int(query)
 
-        # Fields to check with regex
-        # Campos para verificar con regex
-        regex_fields = ["genero", "cesfam", "frecuencia", "razon"]
-        regex_or_query = [{field: regex_query} for field in regex_fields]
+        # Text fields: categorical values through their index, comments through the local index when available
+        # Campos de texto: valores categóricos mediante su índice, comentarios mediante el índice local si existe
+        regex_or_query = [categorical_filter(field, query) for field in CATEGORICAL_FIELDS]
+        if comment_ids is not None:
+            regex_or_query.append(ids_filter(comment_ids))
+        else:
+            regex_or_query.append(comment_filter(query))
 
         # Fields to check as integers or ObjectId
         # Campos para verificar como enteros u ObjectId
@@ -97,34 +662,165 @@ def search_documents(query, column='Todo'):
         # Combinando todas las consultas
         or_query = regex_or_query + int_or_query
 
-        results = collection.find({"$or": or_query})
+        return {"$or": or_query}
 
     # Special handling for 'ID' column
     # Manejo especial para la columna 'ID'
     elif column == 'ID':
+        # A full ObjectId is looked up directly on the _id index
+        if ObjectId.is_valid(str(query)):
+            return {db_column: ObjectId(str(query))}
         regex_query = {"$regex": f"{query}", "$options": 'i'}
-        results = collection.find({db_column: regex_query})
+        return {db_column: regex_query}
         
     # Special handling for 'Fecha' column
     # Manejo especial para la columna 'Fecha'
     elif column == 'Fecha':
         if query:
-            results = collection.find({db_column: query})
+            return {db_column: query}
         else:
-            # If preprocessing failed, return an empty list
-            # Si el preprocesamiento falla, devuelve una lista vacía
-            return []
+            # If preprocessing failed, nothing can match
+            # Si el preprocesamiento falla, nada puede coincidir
+            return None
         
     else:
         # Searching in other columns
         # Buscando en otras columnas
         if isinstance(query, int):
-            results = collection.find({db_column: query})
+            return {db_column: query}
+        elif db_column in CATEGORICAL_FIELDS:
+            return categorical_filter(db_column, query)
+        elif db_column == 'razon':
+            return comment_filter(query)
         else:
             regex_query = {"$regex": f"{query}", "$options": 'i'}
-            results = collection.find({db_column: regex_query})
+            return {db_column: regex_query}
+
+def categorical_filter(field, query):
+    """
+    Match a categorical field the way a case-insensitive regex would, but through the field's index:
+    the few distinct values are filtered locally and the query becomes an $in.
+    Compara un campo categórico como un regex sin mayúsculas, pero mediante su índice.
+    """
+    try:
+        pattern = re.compile(str(query), re.IGNORECASE)
+    except re.error:
+        pattern = re.compile(re.escape(str(query)), re.IGNORECASE)
+    distinct_values = query_cache.get_or_compute(('distinct', field), lambda: get_collection().distinct(field))
+    values = [value for value in distinct_values if isinstance(value, str) and pattern.search(value)]
+    return {field: {'$in': values}}
 
-    return list(results)
+def comment_filter(query):
+    """
+    Match comments containing the query anywhere, case-insensitively, like the original search.
+    Buscar comentarios que contengan la consulta en cualquier parte, sin distinguir mayúsculas.
+    A text index only matches whole words ("aten" would not find "atención"), so it is not used here;
+    the local search index answers comment searches quickly when it is available.
+    """
+    query = str(query).strip()
+    return {'razon': {"$regex": f"{query}", "$options": 'i'}}
+
+def _plan_stages(plan):
+    """ Collect the stage names of an explain plan, depth first. """
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages += _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages += _plan_stages(value)
+    return stages
+
+def explain_search_plans(samples=None):
+    """
+    Explain one sample query per search mode and report whether its winning plan uses an index.
+    Explicar una consulta de ejemplo por modo de búsqueda e informar si su plan usa un índice.
+    """
+    samples = samples or [
+        ('Todo', 'buena'),
+        ('Edad', 30),
+        ('Género', 'fem'),
+        ('Centro de Salud', 'placilla'),
+        ('Frecuencia', 'mes'),
+        ('Satisfacción', 5),
+        ('Recomendación', 7),
+        ('Comentario Abierto', 'buena atencion'),
+        ('Fecha', {'$gte': datetime(datetime.now().year, 1, 1), '$lt': datetime(datetime.now().year + 1, 1, 1)}),
+        ('Etiqueta', 1),
+        ('Sin clasificar', None)
+    ]
+    report = []
+    for column, query in samples:
+        if column == 'Sin clasificar':
+            search_filter = {'target': 3}
+        else:
+            search_filter = build_search_filter(query, column)
+        plan = get_collection().find(search_filter).explain()['queryPlanner']['winningPlan']
+        stages = _plan_stages(plan)
+        report.append({'column': column, 'stages': stages, 'uses_index': 'COLLSCAN' not in stages})
+    return report
+
+def count_matching_documents(search_filter, handle=None):
+    """ Count the documents matching a filter, using the collection metadata when there is no filter. """
+    """ Contar los documentos que cumplen un filtro, usando los metadatos de la colección si no hay filtro. """
+    if not search_filter:
+        return get_collection().estimated_document_count()
+    # A count cannot be killed from here, so it is bounded by maxTimeMS only
+    count = query_cache.get_or_compute(('count', repr(search_filter)), lambda: get_collection().count_documents(
+        search_filter, maxTimeMS=SEARCH_MAX_TIME_MS))
+    if handle is not None:
+        handle.check()
+    return count
+
+def find_rows(search_filter):
+    """ Stream every row matching a filter, in _id order. """
+    """ Recorrer todas las filas que cumplen un filtro, en orden de _id. """
+    return (to_row(doc) for doc in get_collection().find(search_filter, DISPLAY_PROJECTION, sort=[('_id', 1)]))
+
+def ids_filter(ids):
+    """ Build a filter matching the given _ids (as strings). """
+    """ Construir un filtro que coincide con los _id dados (como texto). """
+    return {'_id': {'$in': [ObjectId(document_id) for document_id in ids]}}
+
+def get_rows_by_ids(ids, handle=None):
+    """ Fetch rows by _id, returned in the order of the given ids. """
+    """ Obtener filas por _id, devueltas en el orden de los ids dados. """
+    def fetch():
+        object_ids = [ObjectId(document_id) for document_id in ids]
+        cursor = get_collection().find({'_id': {'$in': object_ids}}, DISPLAY_PROJECTION,
+                                       max_time_ms=SEARCH_MAX_TIME_MS)
+        rows = {row.id: row for row in _read_rows(cursor, handle)}
+        return [rows[object_id] for object_id in object_ids if object_id in rows]
+    return query_cache.get_or_compute(('rows_by_ids', tuple(ids)), fetch)
+
+def get_page(search_filter, page_size, after_id=None, before_id=None, from_end=False, handle=None):
+    """
+    Get one page of matching rows in _id order, using keyset pagination instead of skip.
+    Obtener una página de filas en orden de _id, usando paginación por clave en lugar de skip.
+    after_id reads forward from a row, before_id reads backward from a row, from_end reads the last page.
+    handle, a QueryHandle, lets another thread kill the query.
+    """
+    conditions = [search_filter] if search_filter else []
+    if after_id is not None:
+        conditions.append({'_id': {'$gt': after_id}})
+    if before_id is not None:
+        conditions.append({'_id': {'$lt': before_id}})
+    page_filter = {'$and': conditions} if conditions else {}
+
+    # Pages read backward are fetched in descending order and flipped
+    # Las páginas leídas hacia atrás se obtienen en orden descendente y se invierten
+    backward = before_id is not None or from_end
+
+    def fetch():
+        cursor = get_collection().find(page_filter, DISPLAY_PROJECTION, sort=[('_id', -1 if backward else 1)],
+                                       limit=page_size, max_time_ms=SEARCH_MAX_TIME_MS)
+        rows = _read_rows(cursor, handle)
+        if backward:
+            rows.reverse()
+        return rows
+    return query_cache.get_or_compute(('page', repr(page_filter), backward, page_size), fetch)
 
 def try_int(val):
     """ Try converting a value to integer, or return original value if conversion fails. """
@@ -134,55 +830,108 @@ def try_int(val):
     except ValueError:
         return val
 
-def search_all_columns(query):
-    """ Search all columns for a given query. """
-    regex_query = {"$regex": f"{query}", "$options": 'i'}
-    int_query = try_int(query)
-
-    # Constructing query for various fields
-    regex_fields = ["genero", "cesfam", "frecuencia", "razon"]
-    int_fields = ["edad", "satisfaccion", "recomendacion", "target"]
-
-    regex_or_query = [{field: regex_query} for field in regex_fields]
-    int_or_query = [{field: int_query} for field in int_fields if isinstance(int_query, int)]
-
-    or_query = regex_or_query + int_or_query
-    return list(collection.find({"$or": or_query}))
-
-def search_specific_column(query, db_column):
-    """ Search a specific column with a query. """
-    regex_query = {"$regex": f"{query}", "$options": 'i'}
-    return list(collection.find({db_column: regex_query}))
-
-def search_date_column(query, db_column):
-    """ Search the date column for a specific query. """
-    if query:
-        return list(collection.find({db_column: query}))
-    return []
-
-def search_other_columns(query, db_column):
-    """ Search other columns based on the type of the query. """
-    if isinstance(query, int):
-        return list(collection.find({db_column: query}))
-    regex_query = {"$regex": f"{query}", "$options": 'i'}
-    return list(collection.find({db_column: regex_query}))
-
-def get_all_documents():
-    """ Retrieve all documents from the collection. """
-    """ Recuperar todos los documentos de la colección. """
-    return list(collection.find({}))
-
-def log_update(num_updated, average_confidence):
-    """ Log an update action with the number of updated documents and their average confidence. """
-    """ Registrar una acción de actualización con el número de documentos actualizados y su confianza promedio. """
+def get_last_log():
+    """ Get the most recent log entry of a finished run (not one abandoned by a reset). """
+    """ Obtener la entrada de registro más reciente de una ejecución terminada. """
+    return get_log_collection().find_one({'status': {'$nin': ['running', 'abandoned']}}, sort=[('date', -1)])
+
+# A running entry without a checkpoint for this long belongs to a process that died; younger ones may still be live
+# Una ejecución sin punto de control durante este tiempo pertenece a un proceso que murió; las más recientes pueden seguir vivas
+STALE_RUN_SECONDS = int(os.getenv('CLASSIFIER_STALE_RUN_SECONDS', '600'))
+
+def _utc_now():
+    # Heartbeats are compared across machines, so they are stored in UTC rather than local time
+    return datetime.now(timezone.utc)
+
+def start_run(settings):
+    """ Create the ledger entry of a new classification run and return its id. """
+    """ Crear la entrada del registro de una nueva ejecución de clasificación y devolver su id. """
+    now = datetime.now()
     entry = {
-        'date': datetime.now(), 
-        'num_updated': num_updated,
-        'average_confidence': average_confidence  # Include the average confidence in the log
+        'status': 'running',
+        'started_at': now,
+        'date': now,
+        'heartbeat_at': _utc_now(),
+        'settings': settings,
+        'last_id': None,
+        'num_updated': 0,
+        'confidence_sum': 0,
+        'label_counts': {},
+        'elapsed_seconds': 0
     }
-    log_collection.insert_one(entry)
+    return get_log_collection().insert_one(entry).inserted_id
 
-def get_last_log():
-    """ Get the most recent log entry. """
-    """ Obtener la entrada de registro más reciente. """
-    return log_collection.find_one(sort=[('date', -1)])
\ No newline at end of file
+def get_watermark(fingerprint):
+    """ Get the last _id classified for a model fingerprint, or None if that model has no watermark yet. """
+    """ Obtener el último _id clasificado para una huella de modelo, o None si ese modelo aún no tiene marca. """
+    entry = get_watermark_collection().find_one({'_id': fingerprint})
+    return entry['last_id'] if entry else None
+
+def set_watermark(fingerprint, last_id):
+    """ Record the last _id classified for a model fingerprint. """
+    """ Registrar el último _id clasificado para una huella de modelo. """
+    get_watermark_collection().update_one({'_id': fingerprint},
+                                          {'$set': {'last_id': last_id, 'date': datetime.now()}}, upsert=True)
+
+def clear_watermarks():
+    """ Forget every watermark, so the next incremental run scans from the first document. """
+    """ Olvidar todas las marcas de agua, para que la siguiente ejecución incremental parta del primer documento. """
+    get_watermark_collection().delete_many({})
+
+def get_interrupted_run():
+    """ Get the most recent run that never finished and has not checkpointed for STALE_RUN_SECONDS, if any. """
+    """ Obtener la ejecución más reciente que nunca terminó y no registra progreso hace STALE_RUN_SECONDS, si existe. """
+    # Distributed runs are not resumed: their claims expire and are picked up by the other workers.
+    # A run that checkpointed recently may still be live in another process, so it is left alone
+    cutoff = _utc_now() - timedelta(seconds=STALE_RUN_SECONDS)
+    return get_log_collection().find_one({
+        'status': 'running',
+        'settings.worker_id': {'$exists': False},
+        '$or': [{'heartbeat_at': {'$lt': cutoff}}, {'heartbeat_at': {'$exists': False}}]
+    }, sort=[('date', -1)])
+
+def close_open_runs(status='abandoned'):
+    """ Close every run still marked as running, so none of them is resumed. """
+    """ Cerrar todas las ejecuciones marcadas en curso, para que ninguna se reanude. """
+    get_log_collection().update_many({'status': 'running'}, {'$set': {'status': status, 'date': datetime.now()}})
+
+def checkpoint_run(run_id, progress):
+    """ Record the progress of a running classification (last _id, counts, confidence sum). """
+    """ Registrar el progreso de una clasificación en curso (último _id, conteos, suma de confianza). """
+    get_log_collection().update_one({'_id': run_id},
+                                    {'$set': {**progress, 'date': datetime.now(), 'heartbeat_at': _utc_now()}})
+
+def finish_run(run_id, progress, status='completed', metrics=None, stats=None):
+    """
+    Close a run with its final counts, average confidence, throughput and, if given, its instrumentation summary
+    and the stats of its write-back and caches (stored as is).
+    Cerrar una ejecución con sus conteos finales, confianza promedio, rendimiento y, si se entregan, sus métricas
+    y las estadísticas de su escritura y sus cachés.
+    Returns False if the run had already been closed meanwhile (the labels were reset while it ran).
+    """
+    num_updated = progress['num_updated']
+    elapsed_seconds = progress['elapsed_seconds']
+    summary = {
+        **progress,
+        'status': status,
+        'date': datetime.now(),
+        'average_confidence': progress['confidence_sum'] / num_updated if num_updated else 0,
+        'docs_per_second': num_updated / elapsed_seconds if elapsed_seconds else 0
+    }
+    if metrics is not None:
+        summary['metrics'] = metrics
+    if stats is not None:
+        summary.update(stats)
+    previous = get_log_collection().find_one_and_update({'_id': run_id}, {'$set': summary}, {'status': 1})
+    return previous is not None and previous['status'] == 'running'
+
+# Time every query and write when instrumentation is enabled; generators are timed by their callers instead
+# Medir cada consulta y escritura si la instrumentación está activa; los generadores los miden quienes los usan
+instrumentation.instrument(globals(), 'database', [
+    'ensure_indexes', 'reset_all_targets_to_3', 'has_uncategorized_after', 'update_target',
+    'rethreshold', 'threshold_histogram', 'get_total_documents', 'get_uncategorized_documents', 'get_label_counts',
+    'get_dashboard_stats', 'build_search_filter', 'explain_search_plans', 'count_matching_documents',
+    'get_rows_by_ids', 'get_page', 'get_last_log',
+    'start_run', 'get_watermark', 'set_watermark', 'clear_watermarks', 'get_interrupted_run', 'close_open_runs',
+    'checkpoint_run', 'finish_run'
+])
\ No newline at end of file
@@ -0,0 +1,117 @@
+import csv
+import os
+from datetime import datetime
+
+# ENG: Streaming export of explorer rows to Excel, CSV or Parquet with constant memory use
+# ESP: Exportación en streaming de filas del explorador a Excel, CSV o Parquet con memoria constante
+
+COLUMNS = ('ID', 'Edad', 'Género', 'Centro de Salud', 'Frecuencia', 'Satisfacción', 'Recomendación',
+           'Comentario Abierto', 'Fecha', 'Etiqueta')
+FORMATS = ('xlsx', 'csv', 'parquet')
+
+def _cell(value):
+    """ Convert a row value into something every writer accepts (ObjectId becomes text). """
+    if value is None or isinstance(value, (str, int, float, datetime)):
+        return value
+    return str(value)
+
+def _text(value):
+    """ Convert a row value into text for a Parquet string column, keeping missing values as nulls. """
+    return None if value is None else str(value)
+
+def _write_xlsx(rows, path, report):
+    from openpyxl import Workbook
+
+    # Write-only mode streams rows to disk instead of keeping the whole sheet in memory
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Datos')
+    sheet.append(COLUMNS)
+    for row in rows:
+        sheet.append([_cell(value) for value in row])
+        report()
+    workbook.save(path)
+
+def _write_csv(rows, path, report):
+    # utf-8-sig so that Excel opens accents correctly
+    with open(path, 'w', newline='', encoding='utf-8-sig') as output:
+        writer = csv.writer(output)
+        writer.writerow(COLUMNS)
+        for row in rows:
+            writer.writerow([_cell(value) for value in row])
+            report()
+
+def _write_parquet(rows, path, report, chunk_size):
+    # pyarrow is optional (requirements-optional.txt)
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("La exportación a Parquet requiere pyarrow (pip install -r requirements-optional.txt)")
+
+    text, integer = pa.string(), pa.int64()
+    schema = pa.schema([(name, kind) for name, kind in zip(COLUMNS, (
+        text, integer, text, text, text, integer, integer, text, pa.timestamp('ms'), text
+    ))])
+    converters = [
+        _text,
+        lambda value: value if isinstance(value, int) else None,
+        _text, _text, _text,
+        lambda value: value if isinstance(value, int) else None,
+        lambda value: value if isinstance(value, int) else None,
+        _text,
+        lambda value: value if isinstance(value, datetime) else None,
+        _text
+    ]
+
+    def flush(columns):
+        writer.write_table(pa.table(columns, schema=schema))
+
+    with pq.ParquetWriter(path, schema) as writer:
+        columns = [[] for _ in COLUMNS]
+        for row in rows:
+            for column, convert, value in zip(columns, converters, row):
+                column.append(convert(value))
+            report()
+            # Each chunk becomes a row group, so only one chunk is held in memory
+            if len(columns[0]) >= chunk_size:
+                flush(columns)
+                columns = [[] for _ in COLUMNS]
+        if columns[0]:
+            flush(columns)
+
+def export_rows(rows, path, progress_callback=None, cancel_event=None, chunk_size=5000):
+    """
+    Stream rows (SurveyRow tuples, e.g. from database.find_rows) into path; the format follows the extension.
+    Escribir filas en streaming en path; el formato depende de la extensión.
+    progress_callback receives the number of rows written every chunk_size rows. Returns the row count.
+    """
+    file_format = os.path.splitext(path)[1].lstrip('.').lower()
+    if file_format not in FORMATS:
+        raise ValueError(f"Formato de exportación no soportado: '{file_format}'")
+
+    written = 0
+
+    def report():
+        nonlocal written
+        written += 1
+        if written % chunk_size == 0:
+            if cancel_event is not None and cancel_event.is_set():
+                raise InterruptedError("Exportación cancelada")
+            if progress_callback:
+                progress_callback(written)
+
+    try:
+        if file_format == 'xlsx':
+            _write_xlsx(rows, path, report)
+        elif file_format == 'csv':
+            _write_csv(rows, path, report)
+        else:
+            _write_parquet(rows, path, report, chunk_size)
+    except BaseException:
+        # Do not leave a truncated file behind
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    if progress_callback:
+        progress_callback(written)
+    return written
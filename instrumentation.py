@@ -0,0 +1,161 @@
+import atexit
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import re
+import threading
+import time
+
+# ENG: Timing spans and counters for the hot paths, exported as JSON or in the Prometheus text format
+# ESP: Intervalos de tiempo y contadores de las rutas críticas, exportados en JSON o en formato de texto Prometheus
+
+# Read once at import: when disabled, timed() returns functions unchanged and span() a shared no-op context
+# Se lee una vez al importar: desactivado, timed() devuelve las funciones sin cambios y span() un contexto vacío
+ENABLED = os.getenv('INSTRUMENTATION', '0') == '1'
+# Written when the process exits, as JSON or, with a .prom extension, in the Prometheus text format
+EXPORT_PATH = os.getenv('INSTRUMENTATION_FILE')
+
+_lock = threading.Lock()
+_spans = {}  # name -> {'count', 'seconds', 'max_seconds'}
+_counters = {}  # name -> value
+_NO_SPAN = contextlib.nullcontext()
+
+def _record(name, elapsed):
+    with _lock:
+        stats = _spans.get(name)
+        if stats is None:
+            stats = _spans[name] = {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+        stats['count'] += 1
+        stats['seconds'] += elapsed
+        if elapsed > stats['max_seconds']:
+            stats['max_seconds'] = elapsed
+
+@contextlib.contextmanager
+def _span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, time.perf_counter() - start)
+
+def span(name):
+    """ Context manager timing a block under name. """
+    """ Gestor de contexto que mide un bloque bajo name. """
+    return _span(name) if ENABLED else _NO_SPAN
+
+def timed(name):
+    """ Decorator timing every call of a function under name. """
+    """ Decorador que mide cada llamada de una función bajo name. """
+    def decorate(function):
+        if not ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _record(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+def instrument(namespace, prefix, names):
+    """ Replace the named functions of a module namespace (e.g. globals()) with timed versions. """
+    """ Reemplazar las funciones indicadas de un módulo (p. ej. globals()) por versiones medidas. """
+    if not ENABLED:
+        return
+    for name in names:
+        namespace[name] = timed(f"{prefix}.{name}")(namespace[name])
+
+def count(name, value=1):
+    """ Add value to a counter. """
+    """ Sumar value a un contador. """
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def snapshot():
+    """ Return a copy of every span and counter. """
+    """ Devolver una copia de todos los intervalos y contadores. """
+    with _lock:
+        return {'spans': {name: dict(stats) for name, stats in _spans.items()}, 'counters': dict(_counters)}
+
+def since(previous):
+    """ Return the spans and counters accumulated after a previous snapshot (max_seconds is not differentiable). """
+    """ Devolver los intervalos y contadores acumulados desde una instantánea anterior. """
+    current = snapshot()
+    spans = {}
+    for name, stats in current['spans'].items():
+        before = previous['spans'].get(name, {'count': 0, 'seconds': 0.0})
+        if stats['count'] > before['count']:
+            spans[name] = {'count': stats['count'] - before['count'], 'seconds': stats['seconds'] - before['seconds']}
+    counters = {name: value - previous['counters'].get(name, 0) for name, value in current['counters'].items()
+                if value != previous['counters'].get(name, 0)}
+    return {'spans': spans, 'counters': counters}
+
+def summary(previous):
+    """ Like since(), as lists of records that can be stored in Mongo (span names contain dots). """
+    """ Como since(), en listas de registros que se pueden guardar en Mongo (los nombres contienen puntos). """
+    delta = since(previous)
+    return {
+        'spans': [{'name': name, **stats} for name, stats in sorted(delta['spans'].items())],
+        'counters': [{'name': name, 'value': value} for name, value in sorted(delta['counters'].items())]
+    }
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+def _metric_label(name):
+    return re.sub(r'["\\\n]', '_', name)
+
+def to_prometheus(data=None):
+    """ Render spans and counters in the Prometheus text exposition format. """
+    """ Convertir intervalos y contadores al formato de texto de Prometheus. """
+    data = data or snapshot()
+    lines = ['# HELP app_span_seconds Time spent in instrumented code.', '# TYPE app_span_seconds summary']
+    for name, stats in sorted(data['spans'].items()):
+        label = _metric_label(name)
+        lines.append(f'app_span_seconds_count{{span="{label}"}} {stats["count"]}')
+        lines.append(f'app_span_seconds_sum{{span="{label}"}} {stats["seconds"]:.6f}')
+    lines += ['# HELP app_span_max_seconds Longest single call.', '# TYPE app_span_max_seconds gauge']
+    for name, stats in sorted(data['spans'].items()):
+        lines.append(f'app_span_max_seconds{{span="{_metric_label(name)}"}} {stats.get("max_seconds", 0):.6f}')
+    lines += ['# HELP app_events_total Instrumented event counters.', '# TYPE app_events_total counter']
+    for name, value in sorted(data['counters'].items()):
+        lines.append(f'app_events_total{{event="{_metric_label(name)}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+def export(path):
+    """ Write the current metrics to path: Prometheus text for .prom files, JSON otherwise. """
+    """ Escribir las métricas actuales en path: texto Prometheus para archivos .prom, JSON en otro caso. """
+    data = snapshot()
+    with open(path, 'w', encoding='utf-8') as output:
+        if path.endswith('.prom'):
+            output.write(to_prometheus(data))
+        else:
+            json.dump(data, output, indent=2)
+
+@contextlib.contextmanager
+def profile(path):
+    """
+    Run a block under cProfile and save the stats to path (open with pstats or snakeviz).
+    Ejecutar un bloque bajo cProfile y guardar las estadísticas en path.
+    For sampling without overhead, run the same command under py-spy: py-spy record -o run.svg -- python cli.py
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print(f"Profile written to {path}")
+
+if ENABLED and EXPORT_PATH:
+    atexit.register(export, EXPORT_PATH)
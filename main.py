@@ -1,13 +1,22 @@
+import time
+# Reference point for measuring cold start
+# Punto de referencia para medir el arranque en frío
+start_time = time.perf_counter()
+
 import tkinter as tk
 from tkinter import ttk
 from datetime import datetime, timedelta
 import re
-import pandas as pd
 from tkinter.filedialog import asksaveasfilename
 import database as database
-import classifier
+import search_index
+import instrumentation
 import os
 import sys
+import threading
+import queue
+import multiprocessing
+from pymongo.errors import ExecutionTimeout
 
 # Set the icon path based on whether the app is running as a PyInstaller bundle or not
 if getattr(sys, 'frozen', False):
@@ -17,6 +26,30 @@ else:
     # If the application is running in a development environment
     base_path = os.path.abspath(".")
 
+# Milliseconds between checks of the classification progress queue
+# Milisegundos entre revisiones de la cola de progreso de la clasificación
+PROGRESS_POLL_MS = 200
+
+# Rows fetched per page in the data explorer, and the most rows kept in its table at once
+# Filas obtenidas por página en el explorador, y el máximo de filas mantenidas en la tabla
+PAGE_SIZE = 200
+MAX_TREE_ROWS = 600
+
+# Milliseconds between checks for search results, pause after typing before a search-as-you-type search,
+# and rows inserted into the table per batch while the first page streams in
+# Milisegundos entre revisiones de resultados, pausa tras escribir antes de buscar, y filas insertadas por lote
+SEARCH_POLL_MS = 50
+SEARCH_DEBOUNCE_MS = 400
+STREAM_BATCH_ROWS = 50
+
+# Answer explorer filters from a local columnar snapshot of the collection (imported only when enabled)
+# Responder los filtros del explorador desde una instantánea local de la colección (se importa solo si se activa)
+USE_LOCAL_SNAPSHOT = os.getenv('LOCAL_SNAPSHOT', '0') == '1'
+
+# Labels shown in the main window distribution, in display order
+# Etiquetas mostradas en la distribución de la ventana principal, en orden de visualización
+DISTRIBUTION_TARGETS = (2, 1, 0, 3, 4)
+
 # ENG: Main window for exploring data
 # ESP: Ventana principal para explorar datos
 def open_data_window():
@@ -51,6 +84,12 @@ def open_data_window():
     search_button = ttk.Button(data_window, text="Buscar", command=lambda: search_data())
     search_button.grid(row=0, column=3, padx=5, pady=5)
 
+    # ENG: Option to search while typing, once the user pauses
+    # ESP: Opción para buscar al escribir, cuando el usuario hace una pausa
+    search_as_you_type = tk.BooleanVar(master=data_window, value=False)
+    ttk.Checkbutton(data_window, text="Buscar al escribir", variable=search_as_you_type).grid(
+        row=4, column=0, columnspan=2, padx=5, pady=5, sticky='w')
+
     # ENG: Result treeview for displaying search results
     # ESP: Vista de árbol de resultados para mostrar resultados de búsqueda
     result_tree = ttk.Treeview(data_window, columns=table_columns, show='headings', height=15)
@@ -65,8 +104,8 @@ def open_data_window():
     tree_scrollbar = ttk.Scrollbar(data_window, orient="vertical", command=result_tree.yview)
     tree_scrollbar.grid(row=1, column=5, sticky='ns')
 
-    # Configure the treeview to use the scrollbar
-    result_tree.configure(yscrollcommand=tree_scrollbar.set)
+    # Configure the treeview to use the scrollbar; scrolling near either end fetches more rows
+    result_tree.configure(yscrollcommand=lambda first, last: on_tree_scroll(first, last))
 
     result_tree.grid(row=1, column=0, columnspan=4, padx=5, pady=5, sticky='nsew')
     
@@ -248,58 +287,332 @@ def open_data_window():
     def search_data(event=None):
         query = search_entry.get()
         column = selected_column.get()
-        processed_query = preprocess_query(query, column)
-        for row in result_tree.get_children():
-            result_tree.delete(row)
-        
-        #print(f"Searching for query: '{query}' in column: '{column}' (Processed: '{processed_query}')")  # Debug print
-        
-        # Check if the search box is empty
-        if not query.strip():
-            results = database.get_all_documents()  # Retrieve all documents if search box is empty
-        else:
-            results = database.search_documents(processed_query, column)  # Passing processed_query here
-        
-        #print(f"Results: {results}")  # Debug print
-        
-        if results:  # Check if results are not None or empty
-            for result in results:
-                target_text = target_number_to_text(result['target'])
-                result_tree.insert('', tk.END, values=(result['_id'], result['edad'], result['genero'], result['cesfam'],
-                                                    result['frecuencia'], result['satisfaccion'], result['recomendacion'],
-                                                    result['razon'], result['date'], target_text))
+        if search_state['debounce'] is not None:
+            data_window.after_cancel(search_state['debounce'])
+            search_state['debounce'] = None
+
+        # A new search supersedes the running one: its results are discarded and its cursor is killed
+        # Una nueva búsqueda reemplaza a la anterior: sus resultados se descartan y su cursor se cierra
+        search_state['generation'] += 1
+        if search_state['handle'] is not None:
+            search_state['handle'].cancel()
+        handle = database.QueryHandle()
+        search_state['handle'] = handle
+        page_label.configure(text="Buscando...")
+        search_state['searching'] = True
+        threading.Thread(target=run_search, args=(search_state['generation'], handle, query, column),
+                         daemon=True).start()
+        if not search_state['polling']:
+            search_state['polling'] = True
+            data_window.after(SEARCH_POLL_MS, poll_search_results)
     search_entry.bind('<Return>', search_data)
 
-    # ENG: Function to convert target number to corresponding text
-    # ESP: Función para convertir el número objetivo al texto correspondiente
-    def target_number_to_text(target_number):
-        target_texts = {
-            0: 'Irrelevante',
-            1: 'Negativo',
-            2: 'Positivo',
-            3: 'Sin clasificar',
-            4: 'Error al clasificar'
-        }
-        return target_texts.get(target_number, 'Desconocido')
-    
+    # ENG: Function run on a worker thread: builds the filter, counts the matches and fetches the first page
+    # ESP: Función ejecutada en un hilo: construye el filtro, cuenta las coincidencias y obtiene la primera página
+    @instrumentation.timed('explorer.search')
+    def run_search(generation, handle, query, column):
+        try:
+            processed_query = preprocess_query(query, column)
+
+            # Check if the search box is empty
+            ranked_ids = None
+            if not query.strip():
+                search_filter = {}  # Match all documents if search box is empty
+            else:
+                # Comments are looked up in the local search index when it is available
+                # Los comentarios se buscan en el índice local cuando está disponible
+                comment_ids = search_comments(query) if column in ('Comentario Abierto', 'Todo') else None
+                if comment_ids is not None and column == 'Comentario Abierto':
+                    ranked_ids = comment_ids  # Shown in relevance order
+                    search_filter = database.ids_filter(comment_ids)
+                else:
+                    # Too many ids to send with every page and count: the comments are matched by the regex instead
+                    # Demasiados _id para enviarlos en cada página y conteo: los comentarios se buscan con el regex
+                    if comment_ids is not None and len(comment_ids) > search_index.MAX_FILTER_IDS:
+                        comment_ids = None
+                    search_filter = database.build_search_filter(processed_query, column, comment_ids=comment_ids)  # Passing processed_query here
+
+            # Only the first page is fetched now; the rest is fetched as the user scrolls
+            # Solo se obtiene la primera página; el resto se obtiene al desplazarse
+            rows, total = [], 0
+            if ranked_ids is not None:
+                total = len(ranked_ids)
+                rows = data_source({}).get_rows_by_ids(ranked_ids[:PAGE_SIZE], handle=handle)
+            elif search_filter is not None:
+                source = data_source(search_filter)
+                total = source.count_matching_documents(search_filter, handle=handle)
+                rows = source.get_page(search_filter, PAGE_SIZE, handle=handle)
+            search_queue.put((generation, 'done', (search_filter, ranked_ids, total, rows)))
+        except database.QueryCancelled:
+            pass  # A newer search took over
+        except ExecutionTimeout:
+            search_queue.put((generation, 'error', "La búsqueda tardó demasiado, intente una consulta más específica"))
+        except Exception as error:
+            search_queue.put((generation, 'error', f"Error al buscar: {error}"))
+
+    # ENG: Function to collect search results on the Tk thread, ignoring those of superseded searches
+    # ESP: Función para recibir los resultados en el hilo de Tk, ignorando los de búsquedas reemplazadas
+    def poll_search_results():
+        try:
+            while True:
+                generation, kind, payload = search_queue.get_nowait()
+                if kind in ('page', 'page_error'):
+                    search_state['pages_pending'] -= 1
+                if generation != search_state['generation']:
+                    continue
+                if kind == 'page':
+                    show_fetched_page(*payload)
+                    page_state['loading'] = False
+                    continue
+                if kind == 'page_error':
+                    page_label.configure(text=payload)
+                    page_state['loading'] = False
+                    continue
+                search_state['searching'] = False
+                if kind == 'error':
+                    page_label.configure(text=payload)
+                    page_state['loading'] = False  # The rows of the previous search stay and can still be scrolled
+                    continue
+                search_filter, ranked_ids, total, rows = payload
+                page_state['filter'] = search_filter
+                page_state['ranked_ids'] = ranked_ids
+                page_state['total'] = total
+                page_state['has_after'] = False
+                page_state['loading'] = True  # No page loads from scrolling while rows stream in
+                show_page([], 0)
+                stream_rows(generation, rows, 0)
+        except queue.Empty:
+            pass
+        if search_state['searching'] or search_state['pages_pending']:
+            data_window.after(SEARCH_POLL_MS, poll_search_results)
+        else:
+            search_state['polling'] = False
+
+    # ENG: Function to insert the first page in small batches, so the window keeps responding
+    # ESP: Función para insertar la primera página en lotes pequeños, para que la ventana siga respondiendo
+    def stream_rows(generation, rows, start):
+        if generation != search_state['generation']:
+            return
+        with instrumentation.span('explorer.render_rows'):
+            append_rows(rows[start:start + STREAM_BATCH_ROWS])
+        update_page_label()
+        if start + STREAM_BATCH_ROWS < len(rows):
+            data_window.after(1, stream_rows, generation, rows, start + STREAM_BATCH_ROWS)
+        else:
+            page_state['has_after'] = len(rows) == PAGE_SIZE
+            page_state['loading'] = False
+
+    # ENG: Function to search again shortly after the user stops typing, when search-as-you-type is enabled
+    # ESP: Función para buscar poco después de que se deja de escribir, si la búsqueda al escribir está activa
+    def on_search_typed(event):
+        if not search_as_you_type.get() or event.keysym == 'Return':
+            return
+        if search_state['debounce'] is not None:
+            data_window.after_cancel(search_state['debounce'])
+        search_state['debounce'] = data_window.after(SEARCH_DEBOUNCE_MS, search_data)
+    search_entry.bind('<KeyRelease>', on_search_typed)
+
+    # ENG: State of the running search: its generation number, its cancellation handle and the pending debounce
+    # ESP: Estado de la búsqueda en curso: su número de generación, su control de cancelación y la espera pendiente
+    search_state = {'generation': 0, 'handle': None, 'debounce': None, 'polling': False, 'searching': False,
+                    'pages_pending': 0}
+    search_queue = queue.Queue()
+
+    # ENG: State of the paginated result table: the active filter, its total and the loaded window of rows
+    # ESP: Estado de la tabla paginada: el filtro activo, su total y la ventana de filas cargada
+    page_state = {'filter': None, 'ranked_ids': None, 'total': 0, 'offset': 0, 'row_ids': [], 'has_after': False,
+                  'loading': False}
+
+    # ENG: Function choosing where a filter is answered: the local snapshot when it can, else MongoDB
+    # ESP: Función que elige dónde se responde un filtro: la instantánea local si puede, si no MongoDB
+    def data_source(search_filter):
+        if USE_LOCAL_SNAPSHOT:
+            import snapshot
+            local = snapshot.get_snapshot()
+            local.sync_in_background()  # Only the delta since the last sync is read from MongoDB
+            if local.is_ready() and local.supports(search_filter):
+                return local
+        return database
+
+    # ENG: Function to search comments in the local index; returns None to fall back to MongoDB
+    # ESP: Función para buscar comentarios en el índice local; devuelve None para usar MongoDB
+    def search_comments(query):
+        index = search_index.get_index()
+        if not index.is_ready():
+            return None
+        index.update(blocking=False)  # Pick up comments added since the last search
+        return index.search(query)
+
+    # ENG: Function to fetch a page of results, by _id keyset or by position in the ranked index results
+    # ESP: Función para obtener una página, por clave _id o por posición en los resultados del índice
+    def fetch_page(state, after_id=None, before_id=None, from_end=False, handle=None):
+        ranked_ids = state['ranked_ids']
+        if ranked_ids is None:
+            return data_source(state['filter']).get_page(state['filter'], PAGE_SIZE, after_id=after_id,
+                                                         before_id=before_id, from_end=from_end, handle=handle)
+        end = None
+        if after_id is not None:
+            start = state['offset'] + state['loaded']
+        elif before_id is not None:
+            start, end = max(state['offset'] - PAGE_SIZE, 0), state['offset']
+        elif from_end:
+            start = max(len(ranked_ids) - PAGE_SIZE, 0)
+        else:
+            start = 0
+        return data_source({}).get_rows_by_ids(ranked_ids[start:end if end is not None else start + PAGE_SIZE],
+                                               handle=handle)
+
+    # ENG: Function to fetch a page on a worker thread; the rows are applied by poll_search_results on the Tk thread
+    # ESP: Función para obtener una página en un hilo; poll_search_results aplica las filas en el hilo de Tk
+    def request_page(direction):
+        if page_state['loading'] or search_state['searching']:
+            return  # One fetch at a time, and none for the rows of a search that is being replaced
+        page_state['loading'] = True
+        # The worker reads a copy of the state, which the Tk thread keeps changing
+        # El hilo lee una copia del estado, que el hilo de Tk sigue modificando
+        state = {'filter': page_state['filter'], 'ranked_ids': page_state['ranked_ids'],
+                 'offset': page_state['offset'], 'loaded': len(page_state['row_ids'])}
+        kwargs = {}
+        if direction == 'next':
+            kwargs['after_id'] = page_state['row_ids'][-1]
+        elif direction == 'previous':
+            kwargs['before_id'] = page_state['row_ids'][0]
+        elif direction == 'last':
+            kwargs['from_end'] = True
+        search_state['pages_pending'] += 1
+        threading.Thread(target=run_page_fetch, args=(search_state['generation'], search_state['handle'], direction,
+                                                      state, kwargs), daemon=True).start()
+        if not search_state['polling']:
+            search_state['polling'] = True
+            data_window.after(SEARCH_POLL_MS, poll_search_results)
+
+    @instrumentation.timed('explorer.fetch_page')
+    def run_page_fetch(generation, handle, direction, state, kwargs):
+        try:
+            rows = fetch_page(state, handle=handle, **kwargs)
+            search_queue.put((generation, 'page', (direction, rows)))
+        except database.QueryCancelled:
+            search_queue.put((generation, 'page_error', None))  # A newer search took over; dropped by its generation
+        except ExecutionTimeout:
+            search_queue.put((generation, 'page_error', "La consulta tardó demasiado, intente una búsqueda más específica"))
+        except Exception as error:
+            search_queue.put((generation, 'page_error', f"Error al cargar filas: {error}"))
+
+    # ENG: Function to update the label showing which rows are loaded
+    # ESP: Función para actualizar la etiqueta que muestra las filas cargadas
+    def update_page_label():
+        loaded = len(page_state['row_ids'])
+        if loaded:
+            page_label.configure(text=f"Filas {page_state['offset'] + 1}-{page_state['offset'] + loaded} de {page_state['total']}")
+        else:
+            page_label.configure(text="Sin resultados")
+
+    # ENG: Functions to fill the table with SurveyRow tuples, which arrive ready to insert
+    # ESP: Funciones para llenar la tabla con tuplas SurveyRow, que llegan listas para insertar
+    def show_page(rows, offset):
+        result_tree.delete(*result_tree.get_children())
+        page_state['row_ids'] = []
+        page_state['offset'] = offset
+        append_rows(rows)
+        update_page_label()
+
+    def append_rows(rows):
+        for row in rows:
+            result_tree.insert('', tk.END, iid=str(row.id), values=row)
+            page_state['row_ids'].append(row.id)
+
+    def prepend_rows(rows):
+        for row in reversed(rows):
+            result_tree.insert('', 0, iid=str(row.id), values=row)
+            page_state['row_ids'].insert(0, row.id)
+        page_state['offset'] -= len(rows)
+
+    # ENG: Functions to keep at most MAX_TREE_ROWS rows in the table
+    # ESP: Funciones para mantener como máximo MAX_TREE_ROWS filas en la tabla
+    def trim_top():
+        excess = len(page_state['row_ids']) - MAX_TREE_ROWS
+        if excess > 0:
+            result_tree.delete(*[str(row_id) for row_id in page_state['row_ids'][:excess]])
+            del page_state['row_ids'][:excess]
+            page_state['offset'] += excess
+
+    def trim_bottom():
+        excess = len(page_state['row_ids']) - MAX_TREE_ROWS
+        if excess > 0:
+            result_tree.delete(*[str(row_id) for row_id in page_state['row_ids'][-excess:]])
+            del page_state['row_ids'][-excess:]
+            page_state['has_after'] = True
+
+    # ENG: Page navigation functions
+    # ESP: Funciones de navegación de páginas
+    def load_first_page():
+        if page_state['filter'] is None:
+            show_page([], 0)
+            page_state['has_after'] = False
+            return
+        request_page('first')
+
+    def load_last_page():
+        if page_state['filter'] is None:
+            return
+        request_page('last')
+
+    def load_next_page():
+        if page_state['filter'] is None or not page_state['has_after'] or not page_state['row_ids']:
+            return
+        request_page('next')
+
+    def load_previous_page():
+        if page_state['filter'] is None or page_state['offset'] <= 0 or not page_state['row_ids']:
+            return
+        request_page('previous')
+
+    # ENG: Function to put a page fetched by run_page_fetch in the table
+    # ESP: Función para poner en la tabla una página obtenida por run_page_fetch
+    def show_fetched_page(direction, rows):
+        if direction == 'first':
+            page_state['has_after'] = len(rows) == PAGE_SIZE
+            show_page(rows, 0)
+        elif direction == 'last':
+            page_state['has_after'] = False
+            show_page(rows, max(page_state['total'] - len(rows), 0))
+            if rows:
+                result_tree.see(str(rows[-1].id))
+        elif direction == 'next':
+            page_state['has_after'] = len(rows) == PAGE_SIZE
+            if rows:
+                append_rows(rows)
+                trim_top()
+                result_tree.see(str(rows[0].id))
+            update_page_label()
+        else:
+            if rows:
+                prepend_rows(rows)
+                trim_bottom()
+                result_tree.see(str(rows[-1].id))
+            else:
+                page_state['offset'] = 0
+            update_page_label()
+
+    # ENG: Function called whenever the table scrolls; fetches rows on demand near either end
+    # ESP: Función llamada al desplazar la tabla; obtiene filas bajo demanda cerca de cada extremo
+    def on_tree_scroll(first, last):
+        tree_scrollbar.set(first, last)
+        if page_state['loading']:
+            return
+        if float(last) >= 1.0 and page_state['has_after']:
+            load_next_page()
+        elif float(first) <= 0.0 and page_state['offset'] > 0:
+            load_previous_page()
+
     # ENG: Function to save data to Excel file
     # ESP: Función para guardar datos en un archivo Excel
     def save_to_excel():
-        # Retrieve data from the table
-        rows = result_tree.get_children()
-        data = []
-        for row in rows:
-            row_data = result_tree.item(row, 'values')
-            data.append(row_data)
-
-        # Check if data is empty
-        if not data:
+        # Export every row of the active search, not only the rows loaded in the table
+        if page_state['filter'] is None or not page_state['total']:
             tk.messagebox.showerror("Error", "No hay datos disponibles para exportar")
             return
 
-        # Convert the data to a pandas DataFrame
-        df = pd.DataFrame(data, columns=table_columns)
-
         # Get the current date and format it as a string, e.g., '2023-04-07'
         current_date = datetime.now().strftime('%Y-%m-%d')
         
@@ -311,74 +624,74 @@ def open_data_window():
             title="Guardar como",
             initialfile=suggested_filename,
             defaultextension=".xlsx",
-            filetypes=[("Formato Excel", "*.xlsx")]
+            filetypes=[("Formato Excel", "*.xlsx"), ("CSV", "*.csv"), ("Parquet", "*.parquet")]
         )
+        if not file_name:
+            return
 
-        if file_name:
-            # Save the DataFrame to Excel format
-            df.to_excel(file_name, index=False, engine='openpyxl')
-            tk.messagebox.showinfo("Información", f"Datos almacenados en {file_name}")
+        # The rows are streamed from the cursor to the file on a worker thread, so memory stays flat
+        # and the window keeps responding; progress comes back through a queue polled with after()
+        total = page_state['total']
+        export_queue = queue.Queue()
 
-    save_button = ttk.Button(data_window, text="Exportar Excel", command=save_to_excel)
+        @instrumentation.timed('explorer.export')
+        def run_export():
+            try:
+                import export  # Deferred so openpyxl/pyarrow are not loaded at startup
+                rows = data_source(page_state['filter']).find_rows(page_state['filter'])
+                written = export.export_rows(rows, file_name,
+                                             progress_callback=lambda done: export_queue.put(('progress', done)))
+                instrumentation.count('explorer.exported_rows', written)
+                export_queue.put(('done', written))
+            except Exception as error:
+                export_queue.put(('error', error))
+
+        def poll_export():
+            try:
+                while True:
+                    kind, payload = export_queue.get_nowait()
+                    if kind == 'progress':
+                        export_label.configure(text=f"Exportando {payload}/{total}...")
+                    elif kind == 'done':
+                        export_label.configure(text="")
+                        save_button.configure(state='normal')
+                        tk.messagebox.showinfo("Información", f"{payload} datos almacenados en {file_name}")
+                        return
+                    elif kind == 'error':
+                        export_label.configure(text="")
+                        save_button.configure(state='normal')
+                        tk.messagebox.showerror("Error", f"Error al exportar: {payload}")
+                        return
+            except queue.Empty:
+                pass
+            data_window.after(PROGRESS_POLL_MS, poll_export)
+
+        save_button.configure(state='disabled')
+        export_label.configure(text=f"Exportando 0/{total}...")
+        threading.Thread(target=run_export, daemon=True).start()
+        data_window.after(PROGRESS_POLL_MS, poll_export)
+
+    # ENG: Page navigation controls
+    # ESP: Controles de navegación de páginas
+    navigation_frame = ttk.Frame(data_window)
+    navigation_frame.grid(row=3, column=0, columnspan=3, padx=5, pady=5, sticky='w')
+    ttk.Button(navigation_frame, text="<< Inicio", command=load_first_page).grid(row=0, column=0, padx=2)
+    ttk.Button(navigation_frame, text="< Anterior", command=load_previous_page).grid(row=0, column=1, padx=2)
+    ttk.Button(navigation_frame, text="Siguiente >", command=load_next_page).grid(row=0, column=2, padx=2)
+    ttk.Button(navigation_frame, text="Final >>", command=load_last_page).grid(row=0, column=3, padx=2)
+    page_label = ttk.Label(navigation_frame)
+    page_label.grid(row=0, column=4, padx=10)
+
+    save_button = ttk.Button(data_window, text="Exportar", command=save_to_excel)
     save_button.grid(row=3, column=3, padx=5, pady=5)
+    export_label = ttk.Label(data_window)
+    export_label.grid(row=4, column=3, padx=5)
 
     data_window.grid_columnconfigure(2, weight=1)
     data_window.grid_rowconfigure(2, weight=1)
     data_window.mainloop()
 
 
-# ENG: Main application window setup
-# ESP: Configuración de la ventana principal de la aplicación
-app = tk.Tk()  
-app.geometry("420x300")
-app.title("Clasificador de Datos")
-app.minsize(420, 300)
-# ENG: Apply the Azure theme with dark mode
-# ESP: Aplicar el tema Azure con modo oscuro
-app.iconbitmap(os.path.join(base_path, 'logo.ico'))
-app.tk.call("source", os.path.join(base_path, "azure.tcl"))
-app.tk.call("set_theme", "dark")
-
-# ENG: Label for total documents in the database
-# ESP: Etiqueta para el total de documentos en la base de datos
-total_docs_label = ttk.Label(app)
-total_docs_label.grid(row=0, column=0, padx=20, pady=20, sticky='w')
-
-# ENG: Label for uncategorized documents in the database
-# ESP: Etiqueta para documentos sin clasificar en la base de datos
-uncategorized_docs_label = ttk.Label(app)
-uncategorized_docs_label.grid(row=1, column=0, padx=20, pady=20, sticky='w')
-
-# ENG: Button to classify data
-# ESP: Botón para clasificar datos
-classify_button = ttk.Button(app, text="Clasificar datos", command=lambda: classify_and_update())
-classify_button.grid(row=0, column=1, padx=20, pady=20, sticky='ew')
-
-# ENG: Button to explore data
-# ESP: Botón para explorar datos
-view_data_button = ttk.Button(app, text="Explorar datos", command=open_data_window)
-view_data_button.grid(row=1, column=1, padx=20, pady=20, sticky='ew')
-
-# ENG: Button to reset targets in the database
-# ESP: Botón para restablecer objetivos en la base de datos
-reset_targets_button = ttk.Button(app, text="Restaurar etiqueta de los datos", command=lambda: reset_all_targets_to_3())
-reset_targets_button.grid(row=2, column=0, columnspan=2, padx=20, pady=20, sticky='ew')
-
-# ENG: Label for last update timestamp
-# ESP: Etiqueta para la última marca de tiempo de actualización
-last_updated_label = ttk.Label(app, anchor='center')  # Setting text alignment to center
-last_updated_label.grid(row=3, column=0, columnspan=2, padx=20, pady=20, sticky='ew')  # Making the label expand horizontally
-
-# Structure
-app.grid_columnconfigure(0, weight=1)
-app.grid_columnconfigure(1, weight=1)
-
-app.grid_rowconfigure(0, weight=0)  
-app.grid_rowconfigure(1, weight=0) 
-app.grid_rowconfigure(2, weight=0)  
-app.grid_rowconfigure(3, weight=0)  
-app.grid_rowconfigure(4, weight=0)  
-
 # ENG: Function to reset all targets to 3 (uncategorized) in the database
 # ESP: Función para restablecer todos los objetivos a 3 (sin clasificar) en la base de datos
 def reset_all_targets_to_3():
@@ -387,38 +700,16 @@ def reset_all_targets_to_3():
 
 # ENG: Function to update the database with classified data
 # ESP: Función para actualizar la base de datos con datos clasificados
-def update_database():
-    num_updated = 0  # Initialize the count of updated documents
-    total_confidence = 0  # Sum of all confidences
-
-    documents = database.get_documents()
-    for doc in documents:
-        razon_text = doc['razon']
-        predicted_target, confidence = classifier.classify_text(razon_text)
-        if confidence < 0.60: # 60%
-            predicted_target = 4  # Set target to 4 if confidence is low
-
-        database.update_target(doc['_id'], predicted_target)
-        total_confidence += confidence
-        num_updated += 1  # Increment the count for each updated document
-
-    average_confidence = (total_confidence / num_updated) if num_updated else 0
-    database.log_update(num_updated, average_confidence)  # Modify this method to store average confidence
-    return num_updated, average_confidence  # Return the count of updated documents and average confidence
-
-
-
-
-
-# ENG: Label for the number of updated documents
-# ESP: Etiqueta para el número de documentos actualizados
-num_updated_label = ttk.Label(app, anchor='center')
-num_updated_label.grid(row=4, column=0, columnspan=2, padx=20, pady=2, sticky='ew')
+def update_database(progress_callback=None, cancel_event=None):
+    import pipeline  # Deferred so torch and the model are not loaded at startup
+    # Batch size, chunk size, worker processes and threads per worker come from pipeline's settings
+    # The run is recorded in the log collection by the pipeline itself
+    summary = pipeline.classify_pending(progress_callback=progress_callback, cancel_event=cancel_event)
+    return summary['num_updated'], summary['average_confidence']  # Return the count of updated documents and average confidence
 
 # ENG: Function to update num_updated_label based on the latest data
 # ESP: Función para actualizar num_updated_label basado en los datos más recientes
-def update_num_updated_label():
-    last_log = database.get_last_log()  # Get the latest log
+def update_num_updated_label(last_log):
     if last_log:
         num_updated = last_log['num_updated']
         average_confidence = last_log.get('average_confidence', 0) * 100  # Convert to percentage
@@ -426,8 +717,7 @@ def update_num_updated_label():
 
 # ENG: Function to initialize last updated label when the app is opened
 # ESP: Función para inicializar la etiqueta de última actualización cuando se abre la aplicación
-def initialize_last_updated_label():
-    last_log = database.get_last_log()
+def initialize_last_updated_label(last_log):
     if last_log:
         formatted_date = str(last_log['date']).split('.')[0]  # Convert to string and remove milliseconds
         # Set the last_updated_label text to show the last execution date.
@@ -435,36 +725,235 @@ def initialize_last_updated_label():
         last_updated_label.grid(row=3, column=0, columnspan=2, padx=20, pady=2, sticky='ew')
         
         # Call update_num_updated_label to set the text of num_updated_label.
-        update_num_updated_label()
+        update_num_updated_label(last_log)
     else:
         last_updated_label.configure(text="No hay logs disponibles.")
         last_updated_label.grid(row=3, column=0, columnspan=2, padx=20, pady=2, sticky='ew')
 
-        last_updated_label.grid(row=3, column=0, columnspan=2, padx=20, pady=2, sticky='ew')
-
-# Call to initialize the last updated label when the app starts
-initialize_last_updated_label()
-
-# ENG: Function to classify data and update the GUI accordingly
-# ESP: Función para clasificar datos y actualizar la GUI en consecuencia
+# Queue used by the classification worker to report back to the GUI thread
+progress_queue = queue.Queue()
+cancel_event = threading.Event()
+
+# ENG: Function to format a progress report for the progress label
+# ESP: Función para formatear un reporte de progreso para la etiqueta de progreso
+def format_progress(progress):
+    eta_text = str(timedelta(seconds=int(progress['eta']))) if progress['eta'] is not None else '--'
+    return (f"Clasificados: {progress['done']}/{progress['total']} datos ({progress['rate']:.1f} datos/s)\n"
+            f"Tiempo restante: {eta_text} - Confianza promedio: {progress['average_confidence'] * 100:.2f}%")
+
+# ENG: Function run on the worker thread; it never touches Tk widgets
+# ESP: Función ejecutada en el hilo de trabajo; nunca toca los widgets de Tk
+def run_classification_worker():
+    try:
+        result = update_database(progress_callback=lambda progress: progress_queue.put(('progress', progress)),
+                                 cancel_event=cancel_event)
+        progress_queue.put(('done', result))
+    except Exception as error:
+        progress_queue.put(('error', error))
+
+# ENG: Function to classify data on a background thread and update the GUI accordingly
+# ESP: Función para clasificar datos en un hilo de fondo y actualizar la GUI en consecuencia
 def classify_and_update():
-    num_updated, average_confidence = update_database()
-    database.log_update(num_updated, average_confidence)
-    last_log = database.get_last_log()
-    last_updated_label.configure(text=f"Última ejecución: {str(last_log['date']).split('.')[0]}")
-    refresh_stats()
+    cancel_event.clear()
+    classify_button.configure(state='disabled')
+    reset_targets_button.configure(state='disabled')
+    cancel_button.configure(state='normal')
+    progress_label.configure(text="Clasificando datos...")
+    threading.Thread(target=run_classification_worker, daemon=True).start()
+    app.after(PROGRESS_POLL_MS, poll_classification_progress)
+
+# ENG: Function to request cancellation of the running classification
+# ESP: Función para solicitar la cancelación de la clasificación en curso
+def cancel_classification():
+    cancel_event.set()
+    cancel_button.configure(state='disabled')
+    progress_label.configure(text="Cancelando tras el lote actual...")
+
+# ENG: Function to drain the progress queue from the Tk main loop
+# ESP: Función para vaciar la cola de progreso desde el bucle principal de Tk
+def poll_classification_progress():
+    finished = False
+    try:
+        while True:
+            kind, payload = progress_queue.get_nowait()
+            if kind == 'progress':
+                progress_label.configure(text=format_progress(payload))
+            elif kind == 'done':
+                num_updated, average_confidence = payload
+                status = "cancelada" if cancel_event.is_set() else "completada"
+                progress_label.configure(text=f"Clasificación {status}: {num_updated} datos")
+                finished = True
+            elif kind == 'error':
+                progress_label.configure(text=f"Error al clasificar: {payload}")
+                finished = True
+    except queue.Empty:
+        pass
+
+    if finished:
+        classify_button.configure(state='normal')
+        reset_targets_button.configure(state='normal')
+        cancel_button.configure(state='disabled')
+        refresh_stats()
+    else:
+        app.after(PROGRESS_POLL_MS, poll_classification_progress)
     
+# ENG: Function to create the indexes and load the model in the background once the window is shown
+# ESP: Función para crear los índices y cargar el modelo en segundo plano una vez mostrada la ventana
+def warm_up_model():
+    try:
+        database.ensure_indexes()
+    except Exception as error:
+        print(f"Could not create indexes: {error}")
+    import pipeline
+    # With worker processes each replica loads its own model, so the GUI process does not need one
+    if pipeline.NUM_WORKERS <= 1:
+        pipeline.classifier.warm_up()
+    print(f"Cold start: model ready after {time.perf_counter() - start_time:.2f}s")
+
+# ENG: Function to bring the local comment search index up to date in the background
+# ESP: Función para actualizar en segundo plano el índice local de búsqueda de comentarios
+def build_search_index():
+    try:
+        search_index.get_index().update()
+    except Exception as error:
+        print(f"Could not update the comment search index: {error}")
+
+# ENG: Function to bring the local snapshot of the collection up to date in the background
+# ESP: Función para actualizar en segundo plano la instantánea local de la colección
+def build_local_snapshot():
+    try:
+        import snapshot
+        snapshot.get_snapshot().sync()
+    except Exception as error:
+        print(f"Could not update the local snapshot: {error}")
+
+# ENG: Function run once the main window is on screen
+# ESP: Función ejecutada una vez que la ventana principal está en pantalla
+def on_window_shown():
+    print(f"Cold start: window shown after {time.perf_counter() - start_time:.2f}s")
+    # The statistics, including the last updated label, come from a single aggregation
+    refresh_stats()
+    threading.Thread(target=warm_up_model, daemon=True).start()
+    threading.Thread(target=build_search_index, daemon=True).start()
+    if USE_LOCAL_SNAPSHOT:
+        threading.Thread(target=build_local_snapshot, daemon=True).start()
+
 # ENG: Function to refresh the statistics displayed on the GUI
 # ESP: Función para refrescar las estadísticas mostradas en la GUI
 def refresh_stats():
-    total_docs_label.configure(text=f"Datos totales: {database.get_total_documents()}")
-    uncategorized_docs_label.configure(text=f"Datos sin clasificar: {database.get_uncategorized_documents()}")
-    initialize_last_updated_label()
-
-# ENG: Initialize the statistics on the GUI when the application starts
-# ESP: Inicializar las estadísticas en la GUI cuando la aplicación comienza
-refresh_stats()
-
-# ENG: Start the Tkinter main event loop
-# ESP: Iniciar el bucle principal de eventos de Tkinter
-app.mainloop()
\ No newline at end of file
+    stats = database.get_dashboard_stats()  # One aggregation instead of one count per label
+    total, labels = stats['total'], stats['labels']
+    total_docs_label.configure(text=f"Datos totales: {total}")
+    uncategorized_docs_label.configure(text=f"Datos sin clasificar: {labels[3]}")
+    initialize_last_updated_label(stats['last_run'])
+
+    # Share of each label over the whole collection
+    distribution = [f"{database.TARGET_TEXTS[target]}: {labels[target]} ({labels[target] / total:.0%})"
+                    for target in DISTRIBUTION_TARGETS] if total else []
+    distribution_label.configure(text="\n".join(distribution))
+
+    # Per health centre breakdown, one row per cesfam
+    cesfam_tree.delete(*cesfam_tree.get_children())
+    for cesfam, counts in sorted(stats['cesfam'].items()):
+        cesfam_tree.insert('', tk.END, values=(cesfam, *(counts.get(target, 0) for target in DISTRIBUTION_TARGETS)))
+
+# The window is only built when run as a script, so worker processes can import this module safely
+# La ventana solo se construye al ejecutar como script, para que los procesos de trabajo puedan importar este módulo
+if __name__ == '__main__':
+    # ENG: Required for worker processes to start from the PyInstaller bundle
+    # ESP: Necesario para iniciar procesos de trabajo desde el paquete de PyInstaller
+    multiprocessing.freeze_support()
+
+    # ENG: Main application window setup
+    # ESP: Configuración de la ventana principal de la aplicación
+    app = tk.Tk()  
+    app.geometry("520x680")
+    app.title("Clasificador de Datos")
+    app.minsize(520, 680)
+    # ENG: Apply the Azure theme with dark mode
+    # ESP: Aplicar el tema Azure con modo oscuro
+    app.iconbitmap(os.path.join(base_path, 'logo.ico'))
+    app.tk.call("source", os.path.join(base_path, "azure.tcl"))
+    app.tk.call("set_theme", "dark")
+
+    # ENG: Label for total documents in the database
+    # ESP: Etiqueta para el total de documentos en la base de datos
+    total_docs_label = ttk.Label(app)
+    total_docs_label.grid(row=0, column=0, padx=20, pady=20, sticky='w')
+
+    # ENG: Label for uncategorized documents in the database
+    # ESP: Etiqueta para documentos sin clasificar en la base de datos
+    uncategorized_docs_label = ttk.Label(app)
+    uncategorized_docs_label.grid(row=1, column=0, padx=20, pady=20, sticky='w')
+
+    # ENG: Button to classify data
+    # ESP: Botón para clasificar datos
+    classify_button = ttk.Button(app, text="Clasificar datos", command=lambda: classify_and_update())
+    classify_button.grid(row=0, column=1, padx=20, pady=20, sticky='ew')
+
+    # ENG: Button to explore data
+    # ESP: Botón para explorar datos
+    view_data_button = ttk.Button(app, text="Explorar datos", command=open_data_window)
+    view_data_button.grid(row=1, column=1, padx=20, pady=20, sticky='ew')
+
+    # ENG: Button to reset targets in the database
+    # ESP: Botón para restablecer objetivos en la base de datos
+    reset_targets_button = ttk.Button(app, text="Restaurar etiqueta de los datos", command=lambda: reset_all_targets_to_3())
+    reset_targets_button.grid(row=2, column=0, columnspan=2, padx=20, pady=20, sticky='ew')
+
+    # ENG: Label for last update timestamp
+    # ESP: Etiqueta para la última marca de tiempo de actualización
+    last_updated_label = ttk.Label(app, anchor='center')  # Setting text alignment to center
+    last_updated_label.grid(row=3, column=0, columnspan=2, padx=20, pady=20, sticky='ew')  # Making the label expand horizontally
+
+    # Structure
+    app.grid_columnconfigure(0, weight=1)
+    app.grid_columnconfigure(1, weight=1)
+
+    app.grid_rowconfigure(0, weight=0)  
+    app.grid_rowconfigure(1, weight=0) 
+    app.grid_rowconfigure(2, weight=0)  
+    app.grid_rowconfigure(3, weight=0)  
+    app.grid_rowconfigure(4, weight=0)  
+    app.grid_rowconfigure(5, weight=0)
+    app.grid_rowconfigure(6, weight=0)
+    app.grid_rowconfigure(7, weight=0)
+    app.grid_rowconfigure(8, weight=1)
+
+    # ENG: Label for the number of updated documents
+    # ESP: Etiqueta para el número de documentos actualizados
+    num_updated_label = ttk.Label(app, anchor='center')
+    num_updated_label.grid(row=4, column=0, columnspan=2, padx=20, pady=2, sticky='ew')
+
+    # ENG: Label for the progress of a running classification
+    # ESP: Etiqueta para el progreso de una clasificación en curso
+    progress_label = ttk.Label(app, anchor='center')
+    progress_label.grid(row=5, column=0, columnspan=2, padx=20, pady=2, sticky='ew')
+
+    # ENG: Button to cancel a running classification after the current batch
+    # ESP: Botón para cancelar una clasificación en curso tras el lote actual
+    cancel_button = ttk.Button(app, text="Cancelar clasificación", command=lambda: cancel_classification(), state='disabled')
+    cancel_button.grid(row=6, column=0, columnspan=2, padx=20, pady=10, sticky='ew')
+
+    # ENG: Label with the distribution of labels over all documents
+    # ESP: Etiqueta con la distribución de etiquetas sobre todos los documentos
+    distribution_label = ttk.Label(app, anchor='center', justify='center')
+    distribution_label.grid(row=7, column=0, columnspan=2, padx=20, pady=2, sticky='ew')
+
+    # ENG: Table with the label counts per health centre
+    # ESP: Tabla con los conteos de etiquetas por centro de salud
+    cesfam_columns = ('Centro de Salud', *(database.TARGET_TEXTS[target] for target in DISTRIBUTION_TARGETS))
+    cesfam_tree = ttk.Treeview(app, columns=cesfam_columns, show='headings', height=6)
+    for column in cesfam_columns:
+        cesfam_tree.heading(column, text=column)
+        cesfam_tree.column(column, width=70, anchor='center')
+    cesfam_tree.column('Centro de Salud', width=130, anchor='w')
+    cesfam_tree.grid(row=8, column=0, columnspan=2, padx=20, pady=10, sticky='nsew')
+
+    # ENG: Initialize the statistics and warm up the model once the window has been drawn
+    # ESP: Inicializar las estadísticas y precargar el modelo una vez dibujada la ventana
+    app.after(100, on_window_shown)
+
+    # ENG: Start the Tkinter main event loop
+    # ESP: Iniciar el bucle principal de eventos de Tkinter
+    app.mainloop()
@@ -0,0 +1,321 @@
+import collections
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import database
+import classifier
+import instrumentation
+from prediction_cache import PredictionCache
+from token_cache import TokenCache
+
+# Classification settings, configurable through the .env file loaded by database
+# Parámetros de clasificación, configurables mediante el archivo .env cargado por database
+BATCH_SIZE = int(os.getenv('CLASSIFIER_BATCH_SIZE', '32'))  # Comments per forward pass
+CHUNK_SIZE = int(os.getenv('CLASSIFIER_CHUNK_SIZE', '500'))  # Documents read and written back at a time
+NUM_WORKERS = int(os.getenv('CLASSIFIER_WORKERS', '1'))  # Model replicas, one per process
+THREADS_PER_WORKER = int(os.getenv('CLASSIFIER_THREADS_PER_WORKER', '0'))  # 0 lets torch decide
+CONFIDENCE_THRESHOLD = 0.60  # Below this confidence the target is set to 4
+USE_PREDICTION_CACHE = os.getenv('PREDICTION_CACHE', '1') == '1'  # Reuse predictions of already seen comments
+PREDICTION_CACHE_SIZE = int(os.getenv('PREDICTION_CACHE_SIZE', '200000'))  # Maximum cached comments
+USE_TOKEN_CACHE = os.getenv('TOKEN_CACHE', '1') == '1'  # Reuse the token ids of already tokenized documents
+CHECKPOINT_EVERY = int(os.getenv('CLASSIFIER_CHECKPOINT_EVERY', '1000'))  # Documents between run checkpoints
+# Seconds between checkpoints of a slow run, well under database.STALE_RUN_SECONDS so a live run never looks dead
+CHECKPOINT_INTERVAL = float(os.getenv('CLASSIFIER_CHECKPOINT_SECONDS', '60'))
+LEASE_SECONDS = int(os.getenv('CLASSIFIER_LEASE_SECONDS', '300'))  # Lease of claimed chunks in distributed mode
+
+def _init_worker(num_threads):
+    """ Pin the torch thread count of a worker process and load its model replica once. """
+    """ Fijar los hilos de torch de un proceso de trabajo y cargar su réplica del modelo una vez. """
+    classifier.set_num_threads(num_threads)
+    classifier.get_model()
+
+def _classify_sequences(sequences, batch_size):
+    """ Compute the probability vectors of a chunk of token id sequences inside a worker process. """
+    """ Calcular los vectores de probabilidad de un bloque de secuencias de tokens dentro de un proceso de trabajo. """
+    return classifier.predict_encoded(sequences, batch_size=batch_size)
+
+def _classified_chunks(items, batch_size, workers, threads_per_worker):
+    """ Yield (payload, results) for each (payload, sequences) item, in order, in this process or across a process pool. """
+    """ Generar (carga, resultados) por cada (carga, secuencias), en orden, en este proceso o en un grupo de procesos. """
+    if workers <= 1:
+        if threads_per_worker:
+            classifier.set_num_threads(threads_per_worker)
+        for payload, sequences in items:
+            with instrumentation.span('pipeline.classify_chunk'):
+                results = classifier.predict_encoded(sequences, batch_size=batch_size)
+            yield payload, results
+        return
+
+    threads = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker, initargs=(threads,))
+    pending = collections.deque()
+    try:
+        for payload, sequences in items:
+            pending.append((payload, executor.submit(_classify_sequences, sequences, batch_size)))
+            # Keep only two chunks in flight per worker so memory stays bounded by the chunk size
+            # Mantener solo dos bloques en curso por proceso para acotar la memoria
+            if len(pending) >= workers * 2:
+                payload, future = pending.popleft()
+                # Spans recorded inside the workers stay in their processes; this one measures the wait for them
+                with instrumentation.span('pipeline.classify_chunk'):
+                    results = future.result()
+                yield payload, results
+        while pending:
+            payload, future = pending.popleft()
+            with instrumentation.span('pipeline.classify_chunk'):
+                results = future.result()
+            yield payload, results
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def _uncached_sequences(chunks, cache, token_cache):
+    """ Yield ((documents, keys, known, missing_keys), sequences), the token ids of the unique uncached comments. """
+    """ Generar ((documentos, claves, conocidos, claves_faltantes), secuencias), los tokens de los comentarios sin caché. """
+    chunks = iter(chunks)
+    while True:
+        with instrumentation.span('pipeline.read_chunk'):
+            documents = next(chunks, None)
+        if documents is None:
+            return
+        instrumentation.count('pipeline.documents_read', len(documents))
+        if cache is None:
+            keys = [doc['razon'] for doc in documents]
+            known = {}
+        else:
+            keys = [cache.key(doc['razon']) for doc in documents]
+            with instrumentation.span('pipeline.cache_lookup'):
+                known = cache.get_many(keys)
+            if instrumentation.ENABLED:
+                instrumentation.count('pipeline.cache_hits', sum(key in known for key in keys))
+        # Identical comments within the chunk are classified only once
+        # Los comentarios idénticos dentro del bloque se clasifican solo una vez
+        missing = {}
+        for doc, key in zip(documents, keys):
+            if key not in known and key not in missing:
+                missing[key] = doc
+        if not missing:
+            sequences = []  # Every comment of the chunk was in the prediction cache
+        elif token_cache is None:
+            sequences = classifier.encode_texts(doc['razon'] for doc in missing.values())
+        else:
+            # Documents tokenized by an earlier run are read from the token cache instead
+            # Los documentos tokenizados en una ejecución anterior se leen de la caché de tokens
+            with instrumentation.span('pipeline.token_cache'):
+                sequences = token_cache.sequences(list(missing.values()), classifier.encode_texts)
+        yield (documents, keys, known, list(missing)), sequences
+
+def classify_pending(batch_size=BATCH_SIZE, chunk_size=CHUNK_SIZE, workers=NUM_WORKERS,
+                     threads_per_worker=THREADS_PER_WORKER, confidence_threshold=CONFIDENCE_THRESHOLD,
+                     max_documents=None, dry_run=False, after_id=None, progress_callback=None, cancel_event=None,
+                     resume=True, incremental=False, distributed=False, worker_id=None, lease_seconds=LEASE_SECONDS):
+    """
+    Classify every uncategorized document and write the targets back in bulk, recording the run in the log collection.
+    Clasifica todos los documentos sin categorizar y escribe los objetivos en bloque, registrando la ejecución.
+    An interrupted run is resumed from its last checkpoint. A dry run classifies without writing anything to Mongo.
+    An incremental run only reads documents after the watermark of the current model. A distributed run claims
+    its chunks under a lease, so several nodes can classify the same collection at once.
+    Returns a summary dict with num_updated, average_confidence, label_counts, elapsed_seconds,
+    docs_per_second, last_id and status, plus resumed_run (the _id of a resumed run, or None) and the stats
+    of the run: write_back (matched/modified), prediction_cache and token_cache (hits/misses/hit_rate, or None
+    when disabled) and lease_heartbeat_failures.
+    """
+    # Metrics accumulated before this run are subtracted from the summary stored in its log entry
+    metrics_start = instrumentation.snapshot() if instrumentation.ENABLED else None
+    fingerprint = classifier.model_fingerprint()
+    # Distributed runs rely on expiring leases instead of resuming a checkpoint
+    interrupted = database.get_interrupted_run() if resume and not dry_run and not distributed else None
+    if incremental and after_id is None:
+        # Documents up to the watermark were already classified by this model
+        # Los documentos hasta la marca de agua ya fueron clasificados por este modelo
+        after_id = database.get_watermark(fingerprint)
+    claimer = database.WorkClaimer(worker_id, lease_seconds=lease_seconds) if distributed and not dry_run else None
+    run_id = None
+    if interrupted:
+        run_id = interrupted['_id']
+    elif not dry_run:
+        settings = {
+            'batch_size': batch_size,
+            'chunk_size': chunk_size,
+            'workers': workers,
+            'threads_per_worker': threads_per_worker,
+            'confidence_threshold': confidence_threshold,
+            'max_documents': max_documents,
+            'incremental': incremental,
+            'model_fingerprint': fingerprint
+        }
+        if claimer is not None:
+            settings['worker_id'] = claimer.worker_id
+        run_id = database.start_run(settings)
+
+    # Progress carried over from the interrupted run, if any
+    # Progreso heredado de la ejecución interrumpida, si existe
+    progress = {
+        'last_id': interrupted['last_id'] if interrupted else after_id,
+        'num_updated': interrupted['num_updated'] if interrupted else 0,
+        'confidence_sum': interrupted['confidence_sum'] if interrupted else 0,
+        'label_counts': dict(interrupted['label_counts']) if interrupted else {},
+        'elapsed_seconds': interrupted['elapsed_seconds'] if interrupted else 0
+    }
+    base_elapsed = progress['elapsed_seconds']
+    session_updated = 0  # Documents classified by this session, for throughput and ETA
+    last_checkpoint = progress['num_updated']
+    last_checkpoint_time = time.perf_counter()
+    total_pending = database.get_uncategorized_documents() if progress_callback else 0
+    start_time = time.perf_counter()
+
+    cache = None
+    if USE_PREDICTION_CACHE:
+        cache = PredictionCache(fingerprint, max_entries=PREDICTION_CACHE_SIZE)
+    token_cache = TokenCache(classifier.tokenizer_fingerprint()) if USE_TOKEN_CACHE else None
+    if claimer is not None:
+        claimer.start()  # Renew the leases of claimed chunks while they are classified
+        chunks = claimer.iter_chunks(chunk_size=chunk_size, limit=max_documents)
+    else:
+        chunks = database.iter_document_chunks(chunk_size=chunk_size, after_id=progress['last_id'],
+                                               limit=max_documents)
+    classified = _classified_chunks(_uncached_sequences(chunks, cache, token_cache), batch_size, workers,
+                                    threads_per_worker)
+    status = 'completed'
+    try:
+        with database.BulkTargetUpdater(batch_size=chunk_size,
+                                        release_claims=claimer.worker_id if claimer is not None else None) as updater:
+            for (documents, keys, known, missing_keys), results in classified:
+                new_predictions = dict(zip(missing_keys, results))
+                if cache is not None:
+                    with instrumentation.span('pipeline.cache_store'):
+                        cache.put_many(new_predictions)
+                known.update(new_predictions)
+
+                for doc, key in zip(documents, keys):
+                    probabilities = known[key]
+                    predicted_target, confidence = classifier.top_prediction(probabilities)
+                    if confidence < confidence_threshold:
+                        predicted_target = 4  # Set target to 4 if confidence is low
+
+                    if not dry_run:
+                        # The probabilities are stored too, so database.rethreshold can change the threshold later
+                        updater.add(doc['_id'], predicted_target, probabilities, fingerprint)
+                    label = str(predicted_target)
+                    progress['label_counts'][label] = progress['label_counts'].get(label, 0) + 1
+                    progress['confidence_sum'] += confidence
+                    progress['num_updated'] += 1  # Increment the count for each updated document
+                    session_updated += 1
+                updater.flush()  # Write back each chunk as soon as it is classified
+                if claimer is not None:
+                    claimer.complete(doc['_id'] for doc in documents)
+
+                elapsed = time.perf_counter() - start_time
+                progress['last_id'] = documents[-1]['_id']
+                progress['elapsed_seconds'] = base_elapsed + elapsed
+                if run_id is not None and (progress['num_updated'] - last_checkpoint >= CHECKPOINT_EVERY or
+                                           time.perf_counter() - last_checkpoint_time >= CHECKPOINT_INTERVAL):
+                    database.checkpoint_run(run_id, progress)
+                    last_checkpoint = progress['num_updated']
+                    last_checkpoint_time = time.perf_counter()
+
+                if progress_callback:
+                    rate = session_updated / elapsed if elapsed else 0
+                    remaining = max(total_pending - session_updated, 0)
+                    progress_callback({
+                        'done': session_updated,
+                        'total': total_pending,
+                        'rate': rate,
+                        'eta': remaining / rate if rate else None,
+                        'average_confidence': progress['confidence_sum'] / progress['num_updated']
+                    })
+
+                # Stop cleanly between chunks once a cancellation was requested
+                if cancel_event is not None and cancel_event.is_set():
+                    status = 'cancelled'
+                    break
+    except BaseException:
+        # Leave the run open at its last written chunk so the next run resumes it
+        # Dejar la ejecución abierta en su último bloque escrito para que la siguiente la reanude
+        if run_id is not None:
+            database.checkpoint_run(run_id, progress)
+        raise
+    finally:
+        classified.close()
+        chunks.close()
+        if claimer is not None:
+            claimer.stop()  # Give back the chunks that were claimed but not written
+        if cache is not None:
+            cache.close()
+        if token_cache is not None:
+            token_cache.close()
+
+    progress['elapsed_seconds'] = base_elapsed + (time.perf_counter() - start_time)
+    # Returned with the summary and stored in the run's log entry; printing them is up to the caller
+    # Se devuelven con el resumen y se guardan en el registro de la ejecución; mostrarlos le corresponde a quien llama
+    stats = {
+        'write_back': {'matched': updater.matched_count, 'modified': updater.modified_count},
+        'prediction_cache': cache.stats() if cache is not None else None,
+        'token_cache': token_cache.stats() if token_cache is not None else None,
+        'lease_heartbeat_failures': claimer.heartbeat_failures if claimer is not None else 0
+    }
+    still_open = True
+    if run_id is not None:
+        metrics = instrumentation.summary(metrics_start) if metrics_start is not None else None
+        still_open = database.finish_run(run_id, progress, status=status, metrics=metrics, stats=stats)
+    # Distributed nodes finish out of _id order, so only single-node runs move the watermark.
+    # A reset during the run closed it and made earlier documents pending again, so the watermark stays cleared
+    if not dry_run and claimer is None and still_open and progress['last_id'] is not None:
+        # Every pending document up to last_id has been written, in _id order
+        database.set_watermark(fingerprint, progress['last_id'])
+
+    num_updated = progress['num_updated']
+    return {
+        'status': status,
+        'num_updated': num_updated,
+        'average_confidence': (progress['confidence_sum'] / num_updated) if num_updated else 0,
+        'label_counts': progress['label_counts'],
+        'elapsed_seconds': progress['elapsed_seconds'],
+        'docs_per_second': num_updated / progress['elapsed_seconds'] if progress['elapsed_seconds'] else 0,
+        'last_id': progress['last_id'],
+        'resumed_run': interrupted['_id'] if interrupted else None,
+        'resumed_after': interrupted['num_updated'] if interrupted else 0,
+        **stats
+    }
+
+def follow_new_documents(cancel_event, poll_interval=30, on_summary=None, catch_up=True, **settings):
+    """
+    Classify new survey documents as they arrive, until cancel_event is set.
+    Clasificar los nuevos documentos de encuestas a medida que llegan, hasta que se active cancel_event.
+    Inserts are picked up from a change stream, or by polling every poll_interval seconds against a standalone
+    mongod. Each pass is incremental; catch_up makes the first pass cover every pending document instead.
+    settings are passed on to classify_pending and on_summary receives the summary of each pass, with polling
+    set to True once no change stream is available.
+    """
+    # The stream is opened before the first pass so no insert made during a pass is missed
+    # El stream se abre antes de la primera pasada para no perder inserciones hechas durante una pasada
+    stream = database.open_insert_stream()
+    incremental = not catch_up
+    try:
+        while not cancel_event.is_set():
+            watermark = database.get_watermark(classifier.model_fingerprint()) if incremental else None
+            if database.has_uncategorized_after(watermark):
+                summary = classify_pending(cancel_event=cancel_event, incremental=incremental, **settings)
+                if on_summary:
+                    on_summary({**summary, 'polling': stream is None})
+                incremental = True
+                # A capped pass may have left documents behind, so look again before waiting
+                continue
+            incremental = True
+
+            if stream is None:
+                cancel_event.wait(poll_interval)
+                continue
+            # try_next waits up to max_await_time_ms, so cancellation is noticed within a second
+            while not cancel_event.is_set() and stream.alive:
+                if stream.try_next() is not None:
+                    break
+            if not stream.alive:
+                # The stream was closed by the server, keep going by polling
+                stream.close()
+                stream = None
+    finally:
+        if stream is not None:
+            stream.close()
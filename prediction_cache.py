@@ -0,0 +1,94 @@
+import hashlib
+from array import array
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+from app_data import data_dir
+
+cache_path = os.path.join(data_dir, 'predictions.sqlite')
+
+def normalize_text(text):
+    """ Normalize a comment so that near-exact duplicates share a cache entry. """
+    """ Normalizar un comentario para que los duplicados casi exactos compartan una entrada. """
+    return ' '.join(unicodedata.normalize('NFC', text).lower().split())
+
+class PredictionCache:
+    """ On-disk cache of class probability vectors keyed by normalized text and model fingerprint. """
+    """ Caché en disco de vectores de probabilidad indexada por texto normalizado y huella del modelo. """
+
+    def __init__(self, fingerprint, path=cache_path, max_entries=200000):
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS probabilities ('
+            'key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS probabilities_last_used ON probabilities (last_used)')
+        self._connection.commit()
+
+    def key(self, text):
+        """ Return the cache key of a text for the current model. """
+        """ Devolver la clave de caché de un texto para el modelo actual. """
+        return hashlib.sha256(f"{self.fingerprint}\0{normalize_text(text)}".encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """ Look up several keys at once, returning {key: probabilities} for the hits. """
+        """ Buscar varias claves a la vez, devolviendo {clave: probabilidades} para los aciertos. """
+        unique_keys = list(set(keys))
+        found = {}
+        with self._lock:
+            # SQLite limits the number of bound parameters per statement
+            for start in range(0, len(unique_keys), 500):
+                part = unique_keys[start:start + 500]
+                placeholders = ','.join('?' * len(part))
+                rows = self._connection.execute(
+                    f'SELECT key, vector FROM probabilities WHERE key IN ({placeholders})', part
+                )
+                found.update((key, tuple(array('f', vector))) for key, vector in rows)
+            if found:
+                # Refresh recency so that frequently seen comments survive eviction
+                now = time.time()
+                self._connection.executemany('UPDATE probabilities SET last_used = ? WHERE key = ?',
+                                             [(now, key) for key in found])
+                self._connection.commit()
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, predictions):
+        """ Store {key: probabilities} and evict the least recently used entries over the bound. """
+        """ Guardar {clave: probabilidades} y desalojar las entradas menos usadas sobre el límite. """
+        if not predictions:
+            return
+        now = time.time()
+        with self._lock:
+            # Vectors are stored as packed float32, 4 bytes per class
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO probabilities (key, vector, last_used) VALUES (?, ?, ?)',
+                [(key, array('f', vector).tobytes(), now) for key, vector in predictions.items()]
+            )
+            (count,) = self._connection.execute('SELECT COUNT(*) FROM probabilities').fetchone()
+            if count > self.max_entries:
+                self._connection.execute(
+                    'DELETE FROM probabilities WHERE key IN '
+                    '(SELECT key FROM probabilities ORDER BY last_used LIMIT ?)', (count - self.max_entries,)
+                )
+            self._connection.commit()
+
+    def stats(self):
+        """ Return the hit and miss counters of this cache instance. """
+        """ Devolver los contadores de aciertos y fallos de esta instancia. """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,168 @@
+import math
+import os
+import re
+import sqlite3
+import threading
+
+from bson import ObjectId
+
+import database
+from app_data import data_dir
+
+index_path = os.path.join(data_dir, 'search_index.sqlite')
+
+# BM25 ranking parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Searches matching more comments than this fall back to MongoDB, since ranking them all would be slow
+MAX_RESULTS = 50000
+# 'Todo' searches embed the matching _ids in the MongoDB filter, which every page fetch and count sends and the
+# query cache keys on; past this many ids the comment part of the filter uses the regex instead
+# Las búsquedas 'Todo' incluyen los _id en el filtro de MongoDB; sobre este número se usa el regex
+MAX_FILTER_IDS = 1000
+
+WORD = re.compile(r'\w+')
+
+def tokenize(text):
+    """ Split a comment into lowercase words, accents kept like the regex search keeps them. """
+    """ Dividir un comentario en palabras en minúscula, conservando las tildes como la búsqueda por regex. """
+    return WORD.findall((text or '').lower())
+
+class CommentIndex:
+    """ Inverted index of the razon comments, persisted in SQLite and updated incrementally by _id. """
+    """ Índice invertido de los comentarios razon, guardado en SQLite y actualizado por _id. """
+
+    def __init__(self, path=index_path):
+        self.path = path
+        self._build_lock = threading.Lock()
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        connection = self._connection()
+        connection.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS docs (doc INTEGER PRIMARY KEY, object_id TEXT UNIQUE, length INTEGER);
+            CREATE TABLE IF NOT EXISTS terms (term TEXT PRIMARY KEY) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT, doc INTEGER, tf INTEGER, PRIMARY KEY (term, doc)
+            ) WITHOUT ROWID;
+        ''')
+
+    def _connection(self):
+        # SQLite connections cannot be shared between threads; WAL lets searches read during an update
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def _meta(self, key, default=None):
+        row = self._connection().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def is_ready(self):
+        """ True once the index has been built at least once. """
+        return self._meta('last_id') is not None
+
+    def update(self, chunk_size=2000, blocking=True):
+        """
+        Index the comments added since the last update. Returns False if another update is running.
+        Indexar los comentarios agregados desde la última actualización. Devuelve False si hay otra en curso.
+        """
+        if not self._build_lock.acquire(blocking=blocking):
+            return False
+        try:
+            connection = self._connection()
+            last_id = self._meta('last_id')
+            doc_count = int(self._meta('doc_count', 0))
+            total_length = int(self._meta('total_length', 0))
+            for documents in database.iter_comment_chunks(chunk_size, ObjectId(last_id) if last_id else None):
+                with connection:
+                    for doc in documents:
+                        tokens = tokenize(doc.get('razon') if isinstance(doc.get('razon'), str) else '')
+                        cursor = connection.execute('INSERT OR IGNORE INTO docs (object_id, length) VALUES (?, ?)',
+                                                    (str(doc['_id']), len(tokens)))
+                        if not cursor.rowcount:
+                            continue
+                        counts = {}
+                        for token in tokens:
+                            counts[token] = counts.get(token, 0) + 1
+                        connection.executemany('INSERT OR IGNORE INTO terms (term) VALUES (?)',
+                                               [(term,) for term in counts])
+                        connection.executemany('INSERT INTO postings (term, doc, tf) VALUES (?, ?, ?)',
+                                               [(term, cursor.lastrowid, tf) for term, tf in counts.items()])
+                        doc_count += 1
+                        total_length += len(tokens)
+                    # Progress is committed per chunk, so an interrupted build continues where it stopped
+                    connection.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', [
+                        ('last_id', str(documents[-1]['_id'])),
+                        ('doc_count', str(doc_count)),
+                        ('total_length', str(total_length))
+                    ])
+            if last_id is None and self._meta('last_id') is None:
+                # Mark an empty collection as indexed too
+                with connection:
+                    connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_id', '')")
+            return True
+        finally:
+            self._build_lock.release()
+
+    def search(self, query):
+        """
+        Return the _ids (as strings) of the comments containing the query, best BM25 score first.
+        Devolver los _id (como texto) de los comentarios que contienen la consulta, mejor puntaje BM25 primero.
+        Matches exactly what the case-insensitive regex of database.comment_filter matches, anywhere in a word
+        ("bu" and "tención" find "buena atención"). A query of letters and digits alone can only match inside
+        a single word, so it is looked up in the vocabulary; anything else (several words, punctuation, regex
+        syntax) returns None, and the caller uses the regex instead.
+        """
+        term = str(query).strip().lower()
+        if not WORD.fullmatch(term) or not self.is_ready() or self._build_lock.locked():
+            return None
+
+        connection = self._connection()
+        # The vocabulary holds each distinct word once, so scanning it is cheap next to the postings
+        # El vocabulario tiene cada palabra distinta una vez, así que recorrerlo es barato frente a las entradas
+        terms = [row[0] for row in connection.execute('SELECT term FROM terms WHERE instr(term, ?) > 0', (term,))]
+        doc_count = int(self._meta('doc_count', 0)) or 1
+        average_length = int(self._meta('total_length', 0)) / doc_count or 1
+
+        weights = {}  # doc -> [(idf, tf) per matching word]
+        for matched_term in terms:
+            postings = connection.execute('SELECT doc, tf FROM postings WHERE term = ?', (matched_term,)).fetchall()
+            idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc, tf in postings:
+                weights.setdefault(doc, []).append((idf, tf))
+            if len(weights) > MAX_RESULTS:
+                return None
+
+        lengths = {}
+        object_ids = {}
+        candidate_list = list(weights)
+        for start in range(0, len(candidate_list), 500):
+            part = candidate_list[start:start + 500]
+            rows = connection.execute(
+                f'SELECT doc, object_id, length FROM docs WHERE doc IN ({",".join("?" * len(part))})', part
+            )
+            for doc, object_id, length in rows:
+                object_ids[doc] = object_id
+                lengths[doc] = length
+
+        def bm25(doc):
+            normalizer = BM25_K1 * (1 - BM25_B + BM25_B * lengths[doc] / average_length)
+            return sum(idf * tf * (BM25_K1 + 1) / (tf + normalizer) for idf, tf in weights[doc])
+
+        return [object_ids[doc] for doc in sorted(weights, key=bm25, reverse=True)]
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index():
+    """ Return the shared comment index, opening it on first use. """
+    """ Devolver el índice de comentarios compartido, abriéndolo en el primer uso. """
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = CommentIndex()
+    return _index
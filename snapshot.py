@@ -0,0 +1,467 @@
+import json
+import operator
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+from bson import ObjectId
+
+import database
+from app_data import data_dir
+
+# ENG: Optional local columnar copy of the survey collection, so explorer filters are answered without MongoDB
+# ESP: Copia local columnar opcional de la colección de encuestas, para responder filtros sin MongoDB
+
+snapshot_path = os.path.join(data_dir, 'snapshot')
+
+# Rows per segment written by a sync; past MAX_SEGMENTS segments they are merged into one
+# Filas por segmento escrito en una sincronización; sobre MAX_SEGMENTS segmentos se fusionan en uno
+SEGMENT_ROWS = 200000
+MAX_SEGMENTS = 16
+
+# Seconds between background syncs triggered by searches
+SYNC_INTERVAL = float(os.getenv('LOCAL_SNAPSHOT_SYNC_SECONDS', '30'))
+
+NUMERIC_FIELDS = ('edad', 'satisfaccion', 'recomendacion')
+CATEGORICAL_FIELDS = tuple(database.CATEGORICAL_FIELDS)
+# One .npy file per column; the target column is versioned because classification rewrites it
+COLUMNS = ('id',) + NUMERIC_FIELDS + CATEGORICAL_FIELDS + ('razon_offsets', 'razon_data', 'date')
+
+COMPARISONS = {'$eq': operator.eq, '$gt': operator.gt, '$gte': operator.ge, '$lt': operator.lt, '$lte': operator.le}
+
+class Unsupported(Exception):
+    """ Raised for filters the snapshot cannot evaluate; the caller then asks MongoDB. """
+
+def _load(path):
+    # numpy cannot memory-map an empty array
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        return np.load(path)
+
+def _number(value):
+    # Numbers are stored as float64 so missing values can be NaN, which never compares equal
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return np.nan
+
+class _Segment:
+    """ The memory-mapped columns of one segment. """
+
+    def __init__(self, path, entry):
+        directory = os.path.join(path, entry['name'])
+        self.columns = {column: _load(os.path.join(directory, f"{column}.npy")) for column in COLUMNS}
+        self.columns['target'] = _load(os.path.join(directory, entry['target']))
+        self.rows = len(self.columns['id'])
+
+    def texts(self):
+        """ Decode every comment of the segment, in order. """
+        offsets = self.columns['razon_offsets']
+        data = self.columns['razon_data'].tobytes()
+        return (data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(self.rows))
+
+class Snapshot:
+    """ Columnar snapshot in memory-mapped NumPy segments, synced incrementally by _id. """
+    """ Instantánea columnar en segmentos NumPy mapeados en memoria, sincronizada por _id. """
+
+    def __init__(self, path=snapshot_path):
+        self.path = path
+        self._sync_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._masks = OrderedDict()
+        self._last_sync = None
+        os.makedirs(path, exist_ok=True)
+        self._meta = self._read_meta()
+        self._open(self._meta)
+        self._remove_unused_files()
+
+    # ENG: Storage
+    # ESP: Almacenamiento
+
+    def _read_meta(self):
+        try:
+            with open(os.path.join(self.path, 'meta.json'), encoding='utf-8') as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return self._empty_meta()
+
+    @staticmethod
+    def _empty_meta():
+        return {'segments': [], 'vocab': {field: [] for field in CATEGORICAL_FIELDS}, 'last_id': None, 'rows': 0,
+                'synced_at': None, 'next_segment': 0, 'target_version': 0}
+
+    def _write_meta(self, meta):
+        temporary = os.path.join(self.path, 'meta.json.tmp')
+        with open(temporary, 'w', encoding='utf-8') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(temporary, os.path.join(self.path, 'meta.json'))
+
+    def _open(self, meta):
+        """ Swap in the segments of meta; readers holding the previous list keep using it. """
+        segments = [_Segment(self.path, entry) for entry in meta['segments']]
+        ids = np.concatenate([segment.columns['id'] for segment in segments]) if segments else np.zeros(0, 'S12')
+        with self._lock:
+            self._segments = segments
+            self._starts = np.cumsum([0] + [segment.rows for segment in segments])
+            self._ids = ids
+            self._vocab = {field: list(values) for field, values in meta['vocab'].items()}
+            self._codes = {field: {value: code for code, value in enumerate(values)}
+                           for field, values in self._vocab.items()}
+            self._masks.clear()
+
+    def _remove_unused_files(self):
+        # Files replaced while memory-mapped (e.g. on Windows) are removed on a later start
+        in_use = {entry['name']: entry['target'] for entry in self._meta['segments']}
+        for name in os.listdir(self.path):
+            directory = os.path.join(self.path, name)
+            if not os.path.isdir(directory):
+                continue
+            if name not in in_use:
+                shutil.rmtree(directory, ignore_errors=True)
+                continue
+            for file_name in os.listdir(directory):
+                if file_name.startswith('target-') and file_name != in_use[name]:
+                    try:
+                        os.remove(os.path.join(directory, file_name))
+                    except OSError:
+                        pass
+
+    def _encode(self, documents, vocab, codes):
+        """ Turn a chunk of projected documents into column arrays, growing the categorical vocabularies. """
+        columns = {'id': np.array([doc['_id'].binary for doc in documents], dtype='S12')}
+        for field in NUMERIC_FIELDS:
+            columns[field] = np.array([_number(doc.get(field)) for doc in documents], dtype=np.float64)
+        for field in CATEGORICAL_FIELDS:
+            field_codes = codes[field]
+            encoded = []
+            for doc in documents:
+                value = doc.get(field)
+                if not isinstance(value, str):
+                    encoded.append(-1)
+                    continue
+                if value not in field_codes:
+                    field_codes[value] = len(vocab[field])
+                    vocab[field].append(value)
+                encoded.append(field_codes[value])
+            columns[field] = np.array(encoded, dtype=np.int32)
+        comments = [(doc.get('razon') if isinstance(doc.get('razon'), str) else '').encode('utf-8')
+                    for doc in documents]
+        columns['razon_lengths'] = np.array([len(comment) for comment in comments], dtype=np.int64)
+        columns['razon_data'] = np.frombuffer(b''.join(comments), dtype=np.uint8)
+        columns['date'] = np.array([np.datetime64(doc['date'], 'ms') if isinstance(doc.get('date'), datetime)
+                                    else np.datetime64('NaT', 'ms') for doc in documents], dtype='datetime64[ms]')
+        columns['target'] = np.array([doc['target'] if isinstance(doc.get('target'), int) else -1
+                                      for doc in documents], dtype=np.int8)
+        return columns
+
+    def _write_segment(self, meta, parts):
+        """ Write encoded chunks as a new segment and return its meta entry. """
+        name = f"segment-{meta['next_segment']:06d}"
+        meta['next_segment'] += 1
+        directory = os.path.join(self.path, name)
+        os.makedirs(directory, exist_ok=True)
+        columns = {column: np.concatenate([part[column] for part in parts])
+                   for column in parts[0] if column != 'razon_lengths'}
+        lengths = np.concatenate([part['razon_lengths'] for part in parts])
+        columns['razon_offsets'] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        target_file = f"target-{meta['target_version']}.npy"
+        np.save(os.path.join(directory, target_file), columns.pop('target'))
+        for column, values in columns.items():
+            np.save(os.path.join(directory, f"{column}.npy"), values)
+        return {'name': name, 'rows': len(columns['id']), 'target': target_file}
+
+    def _merge_segments(self, meta):
+        """ Rewrite every segment as a single one, so masks are computed over fewer, larger arrays. """
+        segments = [_Segment(self.path, entry) for entry in meta['segments']]
+        parts = []
+        for segment in segments:
+            part = {column: np.asarray(segment.columns[column]) for column in COLUMNS if column != 'razon_offsets'}
+            part['razon_lengths'] = np.diff(segment.columns['razon_offsets'])
+            part['target'] = np.asarray(segment.columns['target'])
+            parts.append(part)
+        meta['segments'] = [self._write_segment(meta, parts)]
+
+    def _refresh_targets(self, meta, chunk_size):
+        """ Re-read every target (a two-field projection) and rewrite the target files that changed. """
+        segments = [_Segment(self.path, entry) for entry in meta['segments']]
+        if not segments:
+            return
+        ids = np.concatenate([segment.columns['id'] for segment in segments])
+        targets = np.concatenate([segment.columns['target'] for segment in segments])
+        for documents in database.iter_target_chunks(chunk_size):
+            keys = np.array([doc['_id'].binary for doc in documents], dtype='S12')
+            values = np.array([doc['target'] if isinstance(doc.get('target'), int) else -1 for doc in documents],
+                              dtype=np.int8)
+            positions = np.minimum(np.searchsorted(ids, keys), len(ids) - 1)
+            found = ids[positions] == keys
+            targets[positions[found]] = values[found]
+
+        meta['target_version'] += 1
+        start = 0
+        for segment, entry in zip(segments, meta['segments']):
+            updated = targets[start:start + segment.rows]
+            start += segment.rows
+            if np.array_equal(updated, segment.columns['target']):
+                continue
+            # A new file name, since the current one may still be memory-mapped by readers
+            entry['target'] = f"target-{meta['target_version']}.npy"
+            np.save(os.path.join(self.path, entry['name'], entry['target']), updated)
+
+    def _local_label_counts(self):
+        counts = {}
+        for segment in self._segments:
+            labels, label_counts = np.unique(segment.columns['target'], return_counts=True)
+            for label, count in zip(labels.tolist(), label_counts.tolist()):
+                if label >= 0:
+                    counts[label] = counts.get(label, 0) + count
+        return counts
+
+    def is_ready(self):
+        """ True once the snapshot has been synced at least once. """
+        return self._meta['synced_at'] is not None
+
+    def sync(self, chunk_size=5000, blocking=True):
+        """
+        Append the documents inserted since the last sync, and refresh the targets if they changed.
+        Agregar los documentos insertados desde la última sincronización y refrescar las etiquetas si cambiaron.
+        Returns False if another sync is running.
+        """
+        if not self._sync_lock.acquire(blocking=blocking):
+            return False
+        try:
+            started_at = datetime.now()
+            meta = json.loads(json.dumps(self._meta))  # Work on a copy until everything is written
+            if meta['rows'] > database.get_total_documents():
+                # Documents were deleted, which a sync by _id cannot see: start over
+                # Se eliminaron documentos, lo que una sincronización por _id no detecta: empezar de nuevo
+                meta = dict(self._empty_meta(), next_segment=meta['next_segment'])
+
+            vocab = {field: list(values) for field, values in meta['vocab'].items()}
+            codes = {field: {value: code for code, value in enumerate(values)} for field, values in vocab.items()}
+            after_id = ObjectId(meta['last_id']) if meta['last_id'] else None
+            parts, pending_rows = [], 0
+            for documents in database.iter_row_chunks(chunk_size, after_id):
+                parts.append(self._encode(documents, vocab, codes))
+                pending_rows += len(documents)
+                meta['last_id'] = str(documents[-1]['_id'])
+                if pending_rows >= SEGMENT_ROWS:
+                    meta['segments'].append(self._write_segment(meta, parts))
+                    parts, pending_rows = [], 0
+            if parts:
+                meta['segments'].append(self._write_segment(meta, parts))
+            meta['vocab'] = vocab
+            meta['rows'] = sum(entry['rows'] for entry in meta['segments'])
+
+            if len(meta['segments']) > MAX_SEGMENTS:
+                self._merge_segments(meta)
+            self._open(meta)
+
+            # Targets change in place when documents are classified or reset. They are refreshed when the
+            # label counts differ, or when a classification run finished since the previous sync
+            last_run = database.get_last_log()
+            previous_sync = datetime.fromisoformat(self._meta['synced_at']) if self._meta['synced_at'] else None
+            remote_counts = {label: count for label, count in database.get_label_counts().items()
+                             if isinstance(label, int)}
+            if remote_counts != self._local_label_counts() or (
+                    previous_sync is not None and last_run is not None and last_run['date'] > previous_sync):
+                self._refresh_targets(meta, chunk_size * 4)
+                self._open(meta)
+
+            meta['synced_at'] = started_at.isoformat()
+            self._write_meta(meta)
+            self._meta = meta
+            self._last_sync = time.monotonic()
+            self._remove_unused_files()
+            return True
+        finally:
+            self._sync_lock.release()
+
+    def sync_in_background(self, max_age=SYNC_INTERVAL):
+        """ Start a sync on a daemon thread unless one ran in the last max_age seconds. """
+        """ Iniciar una sincronización en un hilo de fondo salvo que haya una de hace menos de max_age segundos. """
+        if self._last_sync is not None and time.monotonic() - self._last_sync < max_age:
+            return
+        self._last_sync = time.monotonic()
+        threading.Thread(target=self.sync, kwargs={'blocking': False}, daemon=True).start()
+
+    # ENG: Filters as vectorized masks
+    # ESP: Filtros como máscaras vectorizadas
+
+    def _column(self, segment, field):
+        if field == '_id':
+            return segment.columns['id']
+        if field in segment.columns and field not in ('razon_offsets', 'razon_data'):
+            return segment.columns[field]
+        raise Unsupported(field)
+
+    def _encode_value(self, field, value):
+        """ Convert a filter value into the column's representation, or None if it cannot match anything. """
+        if field == '_id':
+            return value.binary if isinstance(value, ObjectId) else None
+        if field in NUMERIC_FIELDS or field == 'target':
+            number = _number(value)
+            return None if np.isnan(number) else number
+        if field in CATEGORICAL_FIELDS:
+            return self._codes[field].get(value) if isinstance(value, str) else None
+        if field == 'date':
+            return np.datetime64(value, 'ms') if isinstance(value, datetime) else None
+        raise Unsupported(field)
+
+    def _compare(self, segment, field, op, value):
+        column = self._column(segment, field)
+        if op == '$in':
+            encoded = [item for item in (self._encode_value(field, entry) for entry in value) if item is not None]
+            if not encoded:
+                return np.zeros(segment.rows, dtype=bool)
+            return np.isin(column, np.array(encoded, dtype=column.dtype))
+        encoded = self._encode_value(field, value)
+        if encoded is None:
+            return np.zeros(segment.rows, dtype=bool)
+        if field in CATEGORICAL_FIELDS and op != '$eq':
+            raise Unsupported(op)  # Codes are in insertion order, not value order
+        return COMPARISONS[op](column, encoded)
+
+    def _regex_mask(self, segment, field, pattern, options):
+        try:
+            compiled = re.compile(pattern, re.IGNORECASE if 'i' in options else 0)
+        except re.error:
+            raise Unsupported(pattern)
+        if field in CATEGORICAL_FIELDS:
+            # The pattern is tested once per distinct value instead of once per row
+            matching = [code for code, value in enumerate(self._vocab[field]) if compiled.search(value)]
+            return np.isin(segment.columns[field], np.array(matching, dtype=np.int32))
+        if field == 'razon':
+            return np.fromiter((compiled.search(text) is not None for text in segment.texts()), dtype=bool,
+                               count=segment.rows)
+        if field in NUMERIC_FIELDS or field in ('_id', 'target', 'date'):
+            return np.zeros(segment.rows, dtype=bool)  # A regex only matches strings
+        raise Unsupported(field)
+
+    def _field_mask(self, segment, field, condition):
+        if not (isinstance(condition, dict) and any(key.startswith('$') for key in condition)):
+            return self._compare(segment, field, '$eq', condition)
+        mask = np.ones(segment.rows, dtype=bool)
+        for op, value in condition.items():
+            if op == '$options':
+                continue
+            if op == '$regex':
+                mask &= self._regex_mask(segment, field, value, condition.get('$options', ''))
+            elif op == '$in' or op in COMPARISONS:
+                mask &= self._compare(segment, field, op, value)
+            else:
+                raise Unsupported(op)
+        return mask
+
+    def _mask(self, segment, search_filter):
+        mask = np.ones(segment.rows, dtype=bool)
+        for key, condition in search_filter.items():
+            if key == '$or':
+                part = np.zeros(segment.rows, dtype=bool)
+                for clause in condition:
+                    part |= self._mask(segment, clause)
+            elif key == '$and':
+                part = np.ones(segment.rows, dtype=bool)
+                for clause in condition:
+                    part &= self._mask(segment, clause)
+            elif key.startswith('$'):
+                raise Unsupported(key)
+            else:
+                part = self._field_mask(segment, key, condition)
+            mask &= part
+        return mask
+
+    def _filter_mask(self, search_filter):
+        """ Evaluate a MongoDB filter over every segment; the last few masks are kept for paging. """
+        key = repr(search_filter)
+        with self._lock:
+            if key in self._masks:
+                self._masks.move_to_end(key)
+                return self._masks[key]
+            segments = self._segments
+        parts = [self._mask(segment, search_filter or {}) for segment in segments]
+        mask = np.concatenate(parts) if parts else np.zeros(0, dtype=bool)
+        with self._lock:
+            if segments is self._segments:
+                self._masks[key] = mask
+                while len(self._masks) > 8:
+                    self._masks.popitem(last=False)
+        return mask
+
+    def supports(self, search_filter):
+        """ True if the filter can be answered locally (its mask is computed and kept for the next calls). """
+        try:
+            self._filter_mask(search_filter)
+            return True
+        except Unsupported:
+            return False
+
+    # ENG: Explorer queries, with the same signatures as their database counterparts
+    # ESP: Consultas del explorador, con las mismas firmas que sus equivalentes en database
+
+    def _row(self, position):
+        with self._lock:
+            segments, starts, vocab = self._segments, self._starts, self._vocab
+        index = int(np.searchsorted(starts, position, side='right')) - 1
+        columns, i = segments[index].columns, position - starts[index]
+        # numpy strips trailing zero bytes from fixed-width bytes
+        document = {'_id': ObjectId(bytes(columns['id'][i]).ljust(12, b'\0'))}
+        for field in NUMERIC_FIELDS:
+            value = float(columns[field][i])
+            if not np.isnan(value):
+                document[field] = int(value) if value.is_integer() else value
+        for field in CATEGORICAL_FIELDS:
+            code = int(columns[field][i])
+            if code >= 0:
+                document[field] = vocab[field][code]
+        offsets = columns['razon_offsets']
+        document['razon'] = columns['razon_data'][offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+        if not np.isnat(columns['date'][i]):
+            document['date'] = columns['date'][i].item()
+        if columns['target'][i] >= 0:
+            document['target'] = int(columns['target'][i])
+        return database.to_row(document)
+
+    # handle is accepted for compatibility; local queries are short and not cancelled
+    def count_matching_documents(self, search_filter, handle=None):
+        return int(np.count_nonzero(self._filter_mask(search_filter)))
+
+    def find_rows(self, search_filter):
+        return (self._row(position) for position in np.flatnonzero(self._filter_mask(search_filter)))
+
+    def get_rows_by_ids(self, ids, handle=None):
+        keys = np.array([ObjectId(document_id).binary for document_id in ids], dtype='S12')
+        all_ids = self._ids
+        if not len(keys) or not len(all_ids):
+            return []
+        positions = np.minimum(np.searchsorted(all_ids, keys), len(all_ids) - 1)
+        return [self._row(int(position)) for position, found in zip(positions, all_ids[positions] == keys) if found]
+
+    def get_page(self, search_filter, page_size, after_id=None, before_id=None, from_end=False, handle=None):
+        positions = np.flatnonzero(self._filter_mask(search_filter))
+        all_ids = self._ids
+        if after_id is not None:
+            start = np.searchsorted(all_ids, after_id.binary, side='right')
+            positions = positions[np.searchsorted(positions, start):]
+        if before_id is not None:
+            end = np.searchsorted(all_ids, before_id.binary, side='left')
+            positions = positions[:np.searchsorted(positions, end)]
+        backward = before_id is not None or from_end
+        positions = positions[-page_size:] if backward else positions[:page_size]
+        return [self._row(int(position)) for position in positions]
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+def get_snapshot():
+    """ Return the shared snapshot, opening it on first use. """
+    """ Devolver la instantánea compartida, abriéndola en el primer uso. """
+    global _snapshot
+    with _snapshot_lock:
+        if _snapshot is None:
+            _snapshot = Snapshot()
+    return _snapshot
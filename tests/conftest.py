@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+
+import mongomock
+import pytest
+from mongomock import aggregate
+from pymongo import UpdateOne
+
+import database
+
+# ENG: Shared fixtures: an in-memory MongoDB (mongomock) behind database.get_collection(), and a server clock
+# ESP: Fixtures compartidas: un MongoDB en memoria (mongomock) detrás de database.get_collection(), y un reloj del servidor
+
+class _BulkResult:
+    def __init__(self):
+        self.matched_count = 0
+        self.modified_count = 0
+
+def _bulk_write(collection, requests, ordered=True, **kwargs):
+    # mongomock's bulk_write does not accept the UpdateOne of recent pymongo versions (its sort option)
+    result = _BulkResult()
+    for request in requests:
+        assert isinstance(request, UpdateOne), request
+        update = collection.update_one(request._filter, request._doc, upsert=request._upsert)
+        result.matched_count += update.matched_count
+        result.modified_count += update.modified_count
+    return result
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """ Route database.get_collection() and friends to a fresh mongomock client. """
+    monkeypatch.setattr(database, '_client', mongomock.MongoClient())
+    monkeypatch.setattr(mongomock.collection.Collection, 'bulk_write', _bulk_write)
+    database.query_cache.clear()
+    yield database.get_client()
+    database.query_cache.clear()
+
+class ServerClock:
+    """ The value of $$NOW on the mocked server, moved forward by the test instead of waiting. """
+
+    def __init__(self):
+        self.now = datetime(2026, 1, 1)
+
+    def advance(self, seconds):
+        self.now += timedelta(seconds=seconds)
+
+_REMOVE = object()
+
+@pytest.fixture
+def server_clock(monkeypatch):
+    """ Teach mongomock the $$NOW and $$REMOVE variables and date arithmetic used by the lease updates. """
+    clock = ServerClock()
+    parse_variable = aggregate._Parser._parse_basic_expression
+    arithmetic = aggregate._Parser._handle_arithmetic_operator
+    add_fields = aggregate._handle_add_fields_stage
+
+    def parse_basic_expression(self, expression):
+        if expression == '$$NOW':
+            return clock.now
+        if expression == '$$REMOVE':
+            return _REMOVE
+        return parse_variable(self, expression)
+
+    def handle_arithmetic_operator(self, operator, values):
+        if operator == '$add' and isinstance(values, list):
+            parsed = list(self.parse_many(values))
+            dates = [value for value in parsed if isinstance(value, datetime)]
+            if dates:
+                milliseconds = sum(value for value in parsed if not isinstance(value, datetime))
+                return dates[0] + timedelta(milliseconds=milliseconds)
+        return arithmetic(self, operator, values)
+
+    def add_fields_stage(in_collection, database_, options):
+        return [{field: value for field, value in document.items() if value is not _REMOVE}
+                for document in add_fields(in_collection, database_, options)]
+
+    monkeypatch.setattr(aggregate._Parser, '_parse_basic_expression', parse_basic_expression)
+    monkeypatch.setattr(aggregate._Parser, '_handle_arithmetic_operator', handle_arithmetic_operator)
+    monkeypatch.setitem(aggregate._PIPELINE_HANDLERS, '$set', add_fields_stage)
+    monkeypatch.setitem(aggregate._PIPELINE_HANDLERS, '$addFields', add_fields_stage)
+    return clock
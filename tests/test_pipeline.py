@@ -0,0 +1,117 @@
+import importlib
+import sys
+import types
+from datetime import timedelta
+
+import pytest
+
+import database
+
+# ENG: Resuming interrupted runs and incremental runs: every pending document is classified once, none is skipped
+# ESP: Reanudación de ejecuciones interrumpidas y ejecuciones incrementales: cada documento pendiente se clasifica una vez
+
+FINGERPRINT = 'test-model'
+
+def _fake_classifier():
+    """ A stand-in for the BERT classifier (whose weights are not in the repository), scoring by comment length. """
+    fake = types.ModuleType('classifier')
+    fake.model_fingerprint = lambda: FINGERPRINT
+    fake.tokenizer_fingerprint = lambda: 'test-tokenizer'
+    fake.set_num_threads = lambda num_threads: None
+    fake.get_model = lambda: None
+    fake.encode_texts = lambda texts: [[len(text)] for text in texts]
+
+    def predict_encoded(sequences, batch_size=32, loaded_model=None):
+        vectors = []
+        for sequence in sequences:
+            vector = [0.05, 0.05, 0.05]
+            vector[sequence[0] % 3] = 0.9
+            vectors.append(vector)
+        return vectors
+
+    def top_prediction(probabilities):
+        confidence = max(probabilities)
+        return probabilities.index(confidence), confidence
+
+    fake.predict_encoded = predict_encoded
+    fake.top_prediction = top_prediction
+    return fake
+
+@pytest.fixture
+def pipeline(mongo, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'classifier', _fake_classifier())
+    monkeypatch.delitem(sys.modules, 'pipeline', raising=False)
+    module = importlib.import_module('pipeline')
+    # The on-disk caches are covered by their own tests
+    monkeypatch.setattr(module, 'USE_PREDICTION_CACHE', False)
+    monkeypatch.setattr(module, 'USE_TOKEN_CACHE', False)
+    return module
+
+def _insert(count, start=0):
+    collection = database.get_collection()
+    ids = collection.insert_many([{'razon': f"comentario {i}", 'target': 3}
+                                  for i in range(start, start + count)]).inserted_ids
+    return list(ids)
+
+def _pending(ids):
+    collection = database.get_collection()
+    return [document_id for document_id in ids if collection.find_one({'_id': document_id})['target'] == 3]
+
+def _interrupted_run(ids, heartbeat_age):
+    """ Ledger entry of a run that classified ids and checkpointed heartbeat_age seconds ago. """
+    run_id = database.start_run({'model_fingerprint': FINGERPRINT})
+    progress = {'last_id': ids[-1], 'num_updated': len(ids), 'confidence_sum': 0.9 * len(ids),
+                'label_counts': {'1': len(ids)}, 'elapsed_seconds': 5.0}
+    database.checkpoint_run(run_id, progress)
+    database.get_log_collection().update_one(
+        {'_id': run_id}, {'$set': {'heartbeat_at': database._utc_now() - timedelta(seconds=heartbeat_age)}})
+    return run_id
+
+def test_interrupted_run_resumes_after_its_checkpoint(pipeline):
+    ids = _insert(30)
+    # The first ten were written before the crash; left pending here to show the resumed run does not reread them
+    run_id = _interrupted_run(ids[:10], heartbeat_age=database.STALE_RUN_SECONDS + 60)
+
+    summary = pipeline.classify_pending(workers=1, chunk_size=7)
+
+    assert summary['resumed_run'] == run_id
+    assert summary['num_updated'] == 30 and summary['last_id'] == ids[-1]
+    assert _pending(ids) == ids[:10]
+    runs = list(database.get_log_collection().find())
+    assert len(runs) == 1 and runs[0]['status'] == 'completed' and runs[0]['num_updated'] == 30
+    assert database.get_interrupted_run() is None
+
+def test_live_run_is_not_resumed(pipeline):
+    ids = _insert(10)
+    live_run = _interrupted_run(ids[:5], heartbeat_age=1)
+
+    summary = pipeline.classify_pending(workers=1)
+
+    assert summary['resumed_run'] is None and summary['num_updated'] == 10
+    assert _pending(ids) == []
+    assert database.get_log_collection().find_one({'_id': live_run})['status'] == 'running'
+
+def test_incremental_run_starts_after_the_watermark(pipeline):
+    ids = _insert(20)
+    database.set_watermark(FINGERPRINT, ids[9])
+
+    summary = pipeline.classify_pending(workers=1, incremental=True)
+
+    assert summary['num_updated'] == 10
+    assert _pending(ids) == ids[:10]
+    assert database.get_watermark(FINGERPRINT) == ids[-1]
+
+    # Documents inserted later are picked up by the next incremental run, and only they
+    new_ids = _insert(5, start=20)
+    assert pipeline.classify_pending(workers=1, incremental=True)['num_updated'] == 5
+    assert _pending(new_ids) == []
+    assert database.get_watermark(FINGERPRINT) == new_ids[-1]
+
+def test_reset_makes_incremental_runs_start_over(pipeline):
+    ids = _insert(10)
+    pipeline.classify_pending(workers=1, incremental=True)
+    database.reset_all_targets_to_3()
+
+    assert database.get_watermark(FINGERPRINT) is None
+    assert pipeline.classify_pending(workers=1, incremental=True)['num_updated'] == 10
+    assert _pending(ids) == []
@@ -0,0 +1,36 @@
+import threading
+
+from database import QueryCache
+
+# ENG: A query result computed while a write cleared the cache must not be served after the write
+# ESP: Un resultado calculado mientras una escritura vaciaba la caché no debe servirse después de la escritura
+
+def test_results_computed_across_a_clear_are_not_stored():
+    cache = QueryCache(ttl_seconds=60)
+    computing, written = threading.Event(), threading.Event()
+    stored = {'count': 10}
+
+    def slow_query():
+        result = dict(stored)  # Read before the write...
+        computing.set()
+        assert written.wait(5)  # ...and returned after it
+        return result
+
+    results = []
+    reader = threading.Thread(target=lambda: results.append(cache.get_or_compute('count', slow_query)))
+    reader.start()
+    assert computing.wait(5)
+    stored['count'] = 11  # The write...
+    cache.clear()        # ...and its invalidation
+    written.set()
+    reader.join(5)
+
+    assert results == [{'count': 10}]  # The caller still gets its (pre-write) result
+    assert cache.get_or_compute('count', lambda: dict(stored)) == {'count': 11}
+    assert cache.stats()['misses'] == 2
+
+def test_results_are_stored_without_a_clear():
+    cache = QueryCache(ttl_seconds=60)
+    assert cache.get_or_compute('count', lambda: 10) == 10
+    assert cache.get_or_compute('count', lambda: 11) == 10
+    assert cache.stats()['hits'] == 1
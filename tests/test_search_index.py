@@ -0,0 +1,40 @@
+import pytest
+
+import database
+from search_index import CommentIndex
+
+# ENG: The local comment index must return exactly what the regex search returns, or None to defer to it
+# ESP: El índice local debe devolver exactamente lo que devuelve la búsqueda por regex, o None para cederle el paso
+
+COMMENTS = ['Buena atención del personal', 'Mucha espera en la ATENCIÓN', 'Sin comentarios', 'excelente trato',
+            'el médico no llegó', 'Todo bien, gracias', 'atencion rapida', 'Muy buena', 'bus lleno', '', None]
+
+@pytest.fixture
+def collection(mongo):
+    collection = database.get_collection()
+    collection.insert_many([{'razon': COMMENTS[i % len(COMMENTS)], 'target': 3} for i in range(200)])
+    return collection
+
+@pytest.fixture
+def index(collection, tmp_path):
+    index = CommentIndex(path=str(tmp_path / 'search_index.sqlite'))
+    index.update()
+    return index
+
+def _regex_ids(collection, query):
+    return sorted(str(document['_id']) for document in collection.find(database.comment_filter(query), {'_id': 1}))
+
+@pytest.mark.parametrize('query', ['bu', 'b', 'tención', 'aten', 'ATENCIÓN', 'atencion', 'llegó', 'zzz', ' trato '])
+def test_word_queries_match_the_regex(collection, index, query):
+    ids = index.search(query)
+    assert ids is not None
+    assert sorted(ids) == _regex_ids(collection, query)
+
+@pytest.mark.parametrize('query', ['buena atención', 'bien, gracias', 'b.en', 'aten*'])
+def test_other_queries_defer_to_the_regex(index, query):
+    assert index.search(query) is None
+
+def test_new_comments_are_found_after_an_update(collection, index):
+    collection.insert_one({'razon': 'Atención de urgencia', 'target': 3})
+    index.update()
+    assert sorted(index.search('urgen')) == _regex_ids(collection, 'urgen')
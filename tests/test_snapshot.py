@@ -0,0 +1,91 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+from snapshot import Snapshot
+
+# ENG: The local snapshot must answer every filter built by build_search_filter exactly like MongoDB
+# ESP: La instantánea local debe responder cada filtro de build_search_filter igual que MongoDB
+
+GENEROS = ['Femenino', 'Masculino', 'Otro']
+CESFAMS = ['Cesfam Barón', 'Cesfam Placeres', 'Cesfam Rodelillo', 'Hospital Van Buren']
+FRECUENCIAS = ['Primera vez', 'Mensual', 'Anual']
+COMMENTS = ['Buena atención del personal', 'Mucha espera en la ATENCIÓN', 'Sin comentarios', 'excelente trato',
+            'el médico no llegó', 'Todo bien, gracias']
+START = datetime(2024, 1, 1)
+
+def _documents(count, seed=7):
+    rng = random.Random(seed)
+    documents = []
+    for i in range(count):
+        document = {
+            'edad': rng.randint(15, 90),
+            'genero': rng.choice(GENEROS),
+            'cesfam': rng.choice(CESFAMS),
+            'frecuencia': rng.choice(FRECUENCIAS),
+            'satisfaccion': rng.randint(1, 7),
+            'recomendacion': rng.randint(1, 10),
+            'razon': f"{rng.choice(COMMENTS)} {i}",
+            'date': START + timedelta(hours=rng.randint(0, 24 * 60)),
+            'target': rng.choice([0, 1, 2, 3])
+        }
+        # Missing and mistyped values, as found in older survey imports
+        if i % 17 == 0:
+            del document['cesfam']
+        if i % 23 == 0:
+            document['edad'] = None
+        documents.append(document)
+    return documents
+
+@pytest.fixture
+def collection(mongo):
+    collection = database.get_collection()
+    collection.insert_many(_documents(400))
+    return collection
+
+@pytest.fixture
+def snapshot(collection, tmp_path):
+    snapshot = Snapshot(path=str(tmp_path / 'snapshot'))
+    snapshot.sync()
+    return snapshot
+
+SEARCHES = [
+    ('Todo', 'aten'),
+    ('Todo', 'barón'),
+    ('Todo', '7'),
+    ('Todo', 'zzz'),
+    ('Edad', '42'),
+    ('Género', 'fem'),
+    ('Centro de Salud', 'cesfam'),
+    ('Frecuencia', 'Mensual'),
+    ('Satisfacción', '5'),
+    ('Recomendación', '10'),
+    ('Comentario Abierto', 'ATENCIÓN'),
+    ('Comentario Abierto', 'llegó'),
+    ('Fecha', {'$gte': START + timedelta(days=10), '$lt': START + timedelta(days=20)}),
+    ('Etiqueta', '1'),
+    ('Etiqueta', '3'),
+]
+
+@pytest.mark.parametrize('column, query', SEARCHES)
+def test_snapshot_matches_mongo(collection, snapshot, column, query):
+    search_filter = database.build_search_filter(query, column)
+    assert snapshot.supports(search_filter)
+    expected = sorted(str(document['_id']) for document in collection.find(search_filter, {'_id': 1}))
+    assert snapshot.count_matching_documents(search_filter) == len(expected)
+    assert sorted(str(row.id) for row in snapshot.find_rows(search_filter)) == expected
+
+def test_snapshot_matches_mongo_with_comment_ids(collection, snapshot):
+    comment_ids = [str(document['_id']) for document in collection.find({'razon': {'$regex': 'trato'}}, {'_id': 1})]
+    search_filter = database.build_search_filter('trato', 'Todo', comment_ids=comment_ids)
+    expected = sorted(str(document['_id']) for document in collection.find(search_filter, {'_id': 1}))
+    assert expected == sorted(comment_ids)
+    assert sorted(str(row.id) for row in snapshot.find_rows(search_filter)) == expected
+
+def test_snapshot_follows_label_changes(collection, snapshot):
+    collection.update_many({'target': 3}, {'$set': {'target': 1}})
+    snapshot.sync()
+    search_filter = database.build_search_filter('1', 'Etiqueta')
+    assert snapshot.count_matching_documents(search_filter) == collection.count_documents(search_filter)
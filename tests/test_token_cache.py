@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+from bson import ObjectId
+
+import token_cache
+from token_cache import TokenCache
+
+# ENG: Several processes share the token cache directory; a merge must never hand out another document's tokens
+# ESP: Varios procesos comparten el directorio de la caché; una fusión nunca debe entregar tokens de otro documento
+
+def _tokenize(texts):
+    return [[ord(character) for character in text] for text in texts]
+
+def _documents(start, count):
+    return [{'_id': ObjectId(f"{i:024x}"), 'razon': f"comentario número {i} " + 'x' * (i % 7)}
+            for i in range(start, start + count)]
+
+def _assert_cached(path, documents):
+    reader = TokenCache('tk', path=path)
+    try:
+        found = reader.sequences(documents, lambda texts: [[-1]] * len(texts))
+        assert reader.misses == 0
+        for document, tokens in zip(documents, found):
+            assert np.array_equal(tokens, _tokenize([document['razon']])[0])
+    finally:
+        reader.close()
+
+def test_compaction_keeps_the_segment_of_a_live_writer(tmp_path):
+    path = str(tmp_path)
+    writer = TokenCache('tk', path=path)
+    writer.sequences(_documents(0, 50), _tokenize)
+
+    # Finished runs (e.g. --watch passes) leave enough sealed segments to trigger a merge on the next open
+    for run in range(token_cache.MAX_SEGMENTS + 1):
+        finished = TokenCache('tk', path=path)
+        finished.sequences(_documents(1000 + run * 10, 10), _tokenize)
+        finished.close()
+    compacting = TokenCache('tk', path=path)
+    assert any('-merged-' in name for name in compacting._segment_names())
+    assert writer._segment in compacting._segment_names()
+    compacting.close()
+
+    writer.sequences(_documents(100, 50), _tokenize)
+    writer.close()
+    _assert_cached(path, _documents(0, 50) + _documents(100, 50) + _documents(1000, 90))
+
+def test_writer_moves_to_a_new_segment_when_its_files_are_removed(tmp_path):
+    path = str(tmp_path)
+    writer = TokenCache('tk', path=path)
+    writer.sequences(_documents(0, 50), _tokenize)
+    old_segment = writer._segment
+    # What a merge by another process did to a live segment: its files disappear and the next open recreates them
+    for extension in ('index', 'tokens'):
+        os.remove(os.path.join(writer.path, f"{old_segment}.{extension}"))
+
+    writer.sequences(_documents(100, 50), _tokenize)
+    assert writer._segment != old_segment
+    writer.close()
+    _assert_cached(path, _documents(100, 50))
+
+def test_records_past_the_end_of_their_tokens_are_misses(tmp_path):
+    path = str(tmp_path)
+    writer = TokenCache('tk', path=path)
+    writer.sequences(_documents(0, 20), _tokenize)
+    writer.close()
+    segment = writer._segment_names()[0]
+    with open(os.path.join(writer.path, f"{segment}.tokens"), 'r+b') as tokens_file:
+        tokens_file.truncate(0)
+
+    reader = TokenCache('tk', path=path)
+    found = reader.sequences(_documents(0, 20), _tokenize)
+    assert reader.hits == 0
+    assert [list(tokens) for tokens in found] == _tokenize([doc['razon'] for doc in _documents(0, 20)])
+    reader.close()
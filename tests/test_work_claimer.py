@@ -0,0 +1,85 @@
+import time
+from datetime import timedelta
+
+import pytest
+
+import database
+from database import BulkTargetUpdater, WorkClaimer
+
+# ENG: Lease protocol of distributed classification: each pending document goes to one worker at a time
+# ESP: Protocolo de arriendos de la clasificación distribuida: cada documento pendiente va a un solo nodo a la vez
+
+LEASE_SECONDS = 60
+
+@pytest.fixture
+def collection(mongo, server_clock):
+    collection = database.get_collection()
+    collection.insert_many([{'razon': f"comentario {i}", 'target': 3} for i in range(10)])
+    collection.insert_one({'razon': 'ya clasificado', 'target': 1})
+    return collection
+
+def _ids(documents):
+    return [document['_id'] for document in documents]
+
+def _holders(collection):
+    return {document['_id']: document.get('claimed_by') for document in collection.find({'target': 3})}
+
+def test_claim_renew_release(collection, server_clock):
+    worker = WorkClaimer('a', lease_seconds=LEASE_SECONDS)
+    claimed = worker.claim(4)
+    assert len(claimed) == 4 and set(worker.held_ids) == set(_ids(claimed))
+    first = collection.find_one({'_id': claimed[0]['_id']})
+    assert first['claimed_by'] == 'a'
+    assert first['lease_expires'] == server_clock.now + timedelta(seconds=LEASE_SECONDS)
+
+    # Renewed before it expires, the lease outlives its first expiry
+    server_clock.advance(LEASE_SECONDS - 10)
+    worker.renew()
+    server_clock.advance(20)
+    other = WorkClaimer('b', lease_seconds=LEASE_SECONDS)
+    assert not set(_ids(other.claim(10))) & set(_ids(claimed))
+
+    # Released documents can be claimed right away
+    worker.release()
+    assert not worker.held_ids
+    assert all(holder != 'a' for holder in _holders(collection).values())
+    assert set(_ids(WorkClaimer('c', lease_seconds=LEASE_SECONDS).claim(10))) == set(_ids(claimed))
+
+def test_heartbeat_renews_in_the_background(collection, server_clock):
+    worker = WorkClaimer('a', lease_seconds=LEASE_SECONDS, heartbeat_seconds=0.01)
+    claimed = worker.claim(3)
+    server_clock.advance(30)
+    worker.start()
+    expected = server_clock.now + timedelta(seconds=LEASE_SECONDS)
+    deadline = time.monotonic() + 5
+    while collection.find_one({'_id': claimed[0]['_id']})['lease_expires'] != expected:
+        assert time.monotonic() < deadline, "the heartbeat did not renew the lease"
+        time.sleep(0.01)
+    worker.stop()
+    assert worker.heartbeat_failures == 0
+    assert all(holder is None for holder in _holders(collection).values())
+
+def test_leased_documents_cannot_be_claimed(collection):
+    first = WorkClaimer('a', lease_seconds=LEASE_SECONDS)
+    assert len(first.claim(10)) == 10
+    assert WorkClaimer('b', lease_seconds=LEASE_SECONDS).claim(10) == []
+    # Neither by their own holder: they are already being classified
+    assert first.claim(10) == []
+
+def test_expired_leases_are_reclaimed(collection, server_clock):
+    crashed = WorkClaimer('a', lease_seconds=LEASE_SECONDS)
+    claimed = crashed.claim(5)
+    server_clock.advance(LEASE_SECONDS + 1)
+
+    survivor = WorkClaimer('b', lease_seconds=LEASE_SECONDS)
+    assert _ids(survivor.claim(5)) == _ids(claimed)
+    # A late write by the first worker labels the document but leaves the new holder's lease alone
+    with BulkTargetUpdater(release_claims='a') as updater:
+        updater.add(claimed[0]['_id'], 1)
+    late = collection.find_one({'_id': claimed[0]['_id']})
+    assert late['target'] == 1 and late['claimed_by'] == 'b'
+    # The holder's own write drops its lease
+    with BulkTargetUpdater(release_claims='b') as updater:
+        updater.add(claimed[1]['_id'], 2)
+    written = collection.find_one({'_id': claimed[1]['_id']})
+    assert written['target'] == 2 and 'claimed_by' not in written and 'lease_expires' not in written
@@ -0,0 +1,226 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from app_data import data_dir
+
+# ENG: Append-only, memory-mapped store of token ids per document, shared by every model with the same vocabulary
+# ESP: Almacén de solo anexado y mapeado en memoria de los tokens de cada documento, compartido por modelos con el mismo vocabulario
+
+token_cache_path = os.path.join(data_dir, 'tokens')
+
+# One index record per tokenized document; its tokens are <segment>.tokens[offset:offset + length]
+INDEX_DTYPE = np.dtype([('id', 'S12'), ('text_hash', 'S8'), ('offset', '<i8'), ('length', '<i4')])
+TOKEN_DTYPE = np.dtype('<i4')
+
+# Every cache instance appends to a segment of its own, so processes sharing the directory (the GUI and a cron run,
+# or several workers on one machine) never write to the same file. Only segments whose writer is done with them are
+# merged: those sealed on close, and those untouched for STALE_SEGMENT_SECONDS (their writer crashed). They are merged
+# on open past MAX_SEGMENTS, or once superseded records (comments that were edited) are more than COMPACT_RATIO of them
+# Cada instancia escribe en su propio segmento, así que los procesos que comparten el directorio nunca escriben
+# en el mismo archivo. Solo se fusionan los segmentos cuyo escritor terminó: los sellados al cerrar y los
+# inactivos por STALE_SEGMENT_SECONDS (su escritor se cayó)
+MAX_SEGMENTS = 8
+COMPACT_RATIO = 0.5
+STALE_SEGMENT_SECONDS = 24 * 3600
+
+def text_hash(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest()
+
+def _map(path, dtype):
+    # Only whole records: another process may be appending to the end of the file right now
+    count = os.path.getsize(path) // dtype.itemsize if os.path.exists(path) else 0
+    if not count:
+        return np.zeros(0, dtype)  # numpy cannot memory-map an empty file
+    return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+class TokenCache:
+    """ Token ids of already tokenized documents, keyed by _id and text hash, read straight from memory-mapped files. """
+    """ Tokens de documentos ya tokenizados, por _id y hash del texto, leídos directamente de archivos mapeados. """
+
+    def __init__(self, tokenizer_fingerprint, path=token_cache_path):
+        # Only the vocabulary and truncation matter, so a retrained model with the same vocab reuses the cache
+        # Solo importan el vocabulario y el truncado, así que un modelo reentrenado con el mismo vocabulario la reutiliza
+        self.path = os.path.join(path, tokenizer_fingerprint)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._segment = None  # Name of the segment this instance appends to, created on the first write
+        self._write_offset = 0
+        os.makedirs(self.path, exist_ok=True)
+        self._open()
+        self._compact_if_needed()
+
+    @staticmethod
+    def _new_segment_name():
+        # Names sort in creation order, which decides the newest record of a document
+        return f"{time.time_ns():020d}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+    def _file(self, name, extension):
+        return os.path.join(self.path, f"{name}.{extension}")
+
+    def _is_finished(self, name):
+        """ True if no writer will append to the segment any more (sealed, or abandoned by a crashed writer). """
+        if os.path.exists(self._file(name, 'sealed')):
+            return True
+        try:
+            modified = max(os.path.getmtime(self._file(name, extension)) for extension in ('index', 'tokens'))
+        except OSError:
+            return False
+        return time.time() - modified > STALE_SEGMENT_SECONDS
+
+    def _segment_names(self):
+        return sorted(name[:-len('.index')] for name in os.listdir(self.path) if name.endswith('.index'))
+
+    def _open(self):
+        self._segments = []
+        for name in self._segment_names():
+            index = _map(self._file(name, 'index'), INDEX_DTYPE)
+            tokens = _map(self._file(name, 'tokens'), TOKEN_DTYPE)
+            self._segments.append((name, index, tokens))
+        parts = [index for _, index, _ in self._segments]
+        self._ids = np.concatenate([index['id'] for index in parts]) if parts else np.zeros(0, 'S12')
+        self._segment_of = np.concatenate([np.full(len(index), number, dtype=np.int32)
+                                           for number, index in enumerate(parts)]) if parts else np.zeros(0, np.int32)
+        self._row_of = np.concatenate([np.arange(len(index)) for index in parts]) if parts else np.zeros(0, np.int64)
+        # Sorted view of the ids for vectorized lookups; with a stable sort the last record of an id is the newest
+        self._order = np.argsort(self._ids, kind='stable')
+        self._sorted_ids = self._ids[self._order]
+
+    def _record(self, position):
+        _, index, tokens = self._segments[self._segment_of[position]]
+        record = index[self._row_of[position]]
+        return record, tokens
+
+    def _compact_if_needed(self):
+        finished = [number for number, (name, _, _) in enumerate(self._segments) if self._is_finished(name)]
+        if not finished:
+            return
+        # Positions of the records of the finished segments, in segment order, and the newest one of each id
+        positions = np.flatnonzero(np.isin(self._segment_of, finished))
+        ids = self._ids[positions]
+        order = np.argsort(ids, kind='stable')
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = ids[order][1:] != ids[order][:-1]
+        keep = np.sort(positions[order[last]])
+        if len(finished) > MAX_SEGMENTS or (len(positions) and 1 - len(keep) / len(positions) > COMPACT_RATIO):
+            self._compact([self._segments[number][0] for number in finished], keep)
+
+    def _compact(self, names, keep):
+        """ Merge finished segments into a sealed one with only the newest record of each of their documents. """
+        records = np.zeros(len(keep), INDEX_DTYPE)
+        parts = []
+        for row, position in enumerate(keep):
+            record, tokens = self._record(position)
+            records[row] = record
+            parts.append(np.array(tokens[record['offset']:record['offset'] + record['length']]))
+        lengths = records['length'].astype('<i8')
+        records['offset'] = np.concatenate(([0], np.cumsum(lengths)[:-1])) if len(lengths) else lengths
+        merged = np.concatenate(parts) if parts else np.zeros(0, TOKEN_DTYPE)
+        # Release the maps before removing the files, which Windows refuses while they are mapped
+        del parts
+        self._segments = []
+        # Sorted right after the newest merged segment, so records of later segments still take precedence
+        # Se ordena justo después del segmento fusionado más nuevo, para que los segmentos posteriores sigan primando
+        name = f"{names[-1][:20]}-merged-{time.time_ns():020d}"
+        for extension, data in (('tokens', merged), ('index', records), ('sealed', np.zeros(0, np.uint8))):
+            temporary = f"{self._file(name, extension)}.tmp"
+            with open(temporary, 'wb') as output:
+                output.write(data.tobytes())
+            os.replace(temporary, self._file(name, extension))
+        for old_name in names:
+            for extension in ('index', 'tokens', 'sealed'):
+                try:
+                    os.remove(self._file(old_name, extension))
+                except OSError:
+                    pass  # Still open in another process (Windows); its records are duplicates of the merged ones
+        self._open()
+
+    def _lookup(self, keys, hashes):
+        """ Return the tokens of each key whose stored text hash still matches, or None. """
+        found = [None] * len(keys)
+        if len(self._sorted_ids):
+            positions = np.searchsorted(self._sorted_ids, keys, side='right') - 1
+            for i, position in enumerate(positions):
+                if position >= 0 and self._sorted_ids[position] == keys[i]:
+                    record, tokens = self._record(self._order[position])
+                    # A record past the end of its tokens file is never trusted (the file was replaced under its writer)
+                    if record['text_hash'] == hashes[i] and record['offset'] + record['length'] <= len(tokens):
+                        # A plain ndarray view: no copy, and it pickles to worker processes as a regular array
+                        found[i] = np.asarray(tokens[record['offset']:record['offset'] + record['length']])
+        return found
+
+    def _open_tokens_file(self):
+        """ Open this instance's tokens file for appending, moving to a new segment if the current one was replaced. """
+        if self._segment is not None:
+            tokens_file = open(self._file(self._segment, 'tokens'), 'ab')
+            if tokens_file.tell() == self._write_offset * TOKEN_DTYPE.itemsize:
+                return tokens_file
+            # The segment was merged away under this writer: offsets into another file would point at wrong tokens
+            # El segmento se fusionó bajo este escritor: los desplazamientos apuntarían a tokens equivocados
+            tokens_file.close()
+            if os.path.getsize(self._file(self._segment, 'tokens')) == 0:
+                os.remove(self._file(self._segment, 'tokens'))  # Created just now by the open above
+        self._segment = self._new_segment_name()
+        self._write_offset = 0
+        return open(self._file(self._segment, 'tokens'), 'ab')
+
+    def _append(self, keys, hashes, sequences):
+        arrays = [np.asarray(sequence, dtype=TOKEN_DTYPE) for sequence in sequences]
+        # Tokens first: a crash or a reader in between only sees tokens without an index record yet
+        # Primero los tokens: una caída o un lector intermedio solo ve tokens aún sin registro en el índice
+        with self._open_tokens_file() as tokens_file:
+            records = np.zeros(len(sequences), INDEX_DTYPE)
+            records['id'] = keys
+            records['text_hash'] = hashes
+            records['length'] = [len(array) for array in arrays]
+            records['offset'] = self._write_offset + np.concatenate(
+                ([0], np.cumsum(records['length'], dtype='<i8')[:-1]))
+            for array in arrays:
+                tokens_file.write(array.tobytes())
+        with open(self._file(self._segment, 'index'), 'ab') as index_file:
+            index_file.write(records.tobytes())
+        self._write_offset += int(records['length'].sum())
+        return arrays
+
+    def sequences(self, documents, tokenize):
+        """
+        Return the token ids of each document ({_id, razon}) in order, calling tokenize(texts) only for the
+        documents that are new or whose comment changed, and storing their tokens for later runs.
+        Devolver los tokens de cada documento en orden, llamando a tokenize(textos) solo para los documentos
+        nuevos o cuyo comentario cambió, y guardar sus tokens para las siguientes ejecuciones.
+        """
+        if not documents:
+            return []
+        keys = np.array([doc['_id'].binary for doc in documents], dtype='S12')
+        # Compared as S8 array elements on both sides, since NumPy drops trailing null bytes of stored values
+        hashes = np.array([text_hash(doc['razon']) for doc in documents], dtype='S8')
+        with self._lock:
+            # Documents appended by this instance are not looked up again: a run reads each document once
+            found = self._lookup(keys, hashes)
+            missing = [i for i, tokens in enumerate(found) if tokens is None]
+            self.hits += len(documents) - len(missing)
+            self.misses += len(missing)
+            if missing:
+                tokenized = tokenize([documents[i]['razon'] for i in missing])
+                stored = self._append([keys[i] for i in missing], [hashes[i] for i in missing], tokenized)
+                for i, tokens in zip(missing, stored):
+                    found[i] = tokens
+        return found
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0}
+
+    def close(self):
+        """ Seal the segment written by this instance, so a later instance may merge it, and release the maps. """
+        with self._lock:
+            if self._segment is not None:
+                open(self._file(self._segment, 'sealed'), 'wb').close()
+                self._segment = None
+            self._segments = []
+            self._ids = self._sorted_ids = np.zeros(0, 'S12')